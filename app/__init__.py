@@ -15,6 +15,9 @@
 #   limitations under the License.
 
 import os
+from .request_queue_lib import RequestQueue
+from .request_coalescing_lib import InFlightRequests
+from .job_store_lib import JobStore, RequestStatusDict
 
 __version__ = '1.0.0'
 
@@ -22,12 +25,58 @@ __version__ = '1.0.0'
 __hardklor_config_file__ = 'Hardklor.conf'      # filename for Hardklor config file
 __hardklor_results_file__ = 'scans.hk'          # filename for Hardklor results file
 __bullseye_results_file__ = 'scans.be'          # filename for Bullseye results file
-__ms1_file__ = 'scans.ms1'                      # filename for ms1 file made from spectr output
-__ms2_file__ = 'scans.ms2'                      # filename for ms2 file made from spectr output
+__ms1_file__ = 'scans.ms1'                      # filename for ms1 file made from spectr output, written as text
+__ms2_file__ = 'scans.ms2'                      # filename for ms2 file made from spectr output, written as text
+__trace_file__ = 'trace.jsonl'                  # filename for the trace of how the request was processed
+__profile_file__ = 'profile.folded'             # filename for the stacks sampled by the profiler
 
 # environmental variable for the number of scans to process at a time from spectr
 __spectr_batch_size_env_key__ = 'SPECTR_BATCH_SIZE'
 
+# environmental variables for the number of decimal places to write for peak m/z and intensity values
+# in the ms1 and ms2 files. if not set, the full precision of the value from spectr is written
+__ms_file_mz_decimal_places_env_key__ = 'MS_FILE_MZ_DECIMAL_PLACES'
+__ms_file_intensity_decimal_places_env_key__ = 'MS_FILE_INTENSITY_DECIMAL_PLACES'
+
+# environmental variable for the format of the ms1 and ms2 files, one of:
+#   'text': .ms1 and .ms2 files
+#   'binary': MSToolkit .bms1 and .bms2 files
+#   'compressed': MSToolkit .cms1 and .cms2 files, with zlib compressed peak lists
+__ms_file_format_env_key__ = 'MS_FILE_FORMAT'
+
+# environmental variable for how to export the ms1 and ms2 files, one of:
+#   'separate': export the ms1 file then the ms2 file, each in their own pass over spectr
+#   'combined': export both files together in a single pass over spectr
+__spectr_export_mode_env_key__ = 'SPECTR_EXPORT_MODE'
+
+# environmental variables for the cache of exported ms1 and ms2 files. the cache is disabled if no
+# directory is set. place it on the same filesystem as the work dir so files can be hardlinked.
+__spectral_file_cache_dir_env_key__ = 'SPECTRAL_FILE_CACHE_DIR'
+__spectral_file_cache_max_size_mb_env_key__ = 'SPECTRAL_FILE_CACHE_MAX_SIZE_MB'
+__spectral_file_cache_max_size_mb_default__ = 102400
+
+# environmental variables for the cache of Hardklor results, disabled if no directory is set
+__hardklor_results_cache_dir_env_key__ = 'HARDKLOR_RESULTS_CACHE_DIR'
+__hardklor_results_cache_max_size_mb_env_key__ = 'HARDKLOR_RESULTS_CACHE_MAX_SIZE_MB'
+__hardklor_results_cache_max_size_mb_default__ = 10240
+
+# environmental variable for the number of batch requests to have in flight at a time to spectr
+__spectr_max_concurrent_requests_env_key__ = 'SPECTR_MAX_CONCURRENT_REQUESTS'
+__spectr_max_concurrent_requests_default__ = 4
+
+# environmental variable for the number of parsed scans that may wait to be written to disk at a time
+__spectr_scan_queue_size_env_key__ = 'SPECTR_SCAN_QUEUE_SIZE'
+__spectr_scan_queue_size_default__ = 250
+
+# environmental variables for the pooled http connections used to talk to spectr
+__spectr_http_pool_size_env_key__ = 'SPECTR_HTTP_POOL_SIZE'
+__spectr_http_pool_size_default__ = 10
+__spectr_http_connect_timeout_env_key__ = 'SPECTR_HTTP_CONNECT_TIMEOUT'
+__spectr_http_connect_timeout_default__ = 30
+__spectr_http_read_timeout_env_key__ = 'SPECTR_HTTP_READ_TIMEOUT'
+__spectr_http_read_timeout_default__ = 600
+__spectr_http_keep_alive_env_key__ = 'SPECTR_HTTP_KEEP_ALIVE'
+
 # environmental variable name for the port to use for this web service
 __webapp_port_env_key__ = 'WEBAPP_PORT'
 
@@ -38,12 +87,39 @@ __spectr_get_scan_numbers_env_key__ = 'SPECTR_GET_SCAN_NUMBERS_URL'
 # the hardklor timeout
 __hardklor_timeout_env_key__ = 'HARDKLOR_TIMEOUT'
 
+# environmental variable for the number of hardklor processes to run at the same time for a request,
+# each over its own range of scans. 1 runs a single hardklor process over all scans
+__hardklor_shards_env_key__ = 'HARDKLOR_SHARDS'
+__hardklor_shards_default__ = 1
+
+# environmental variable for the number of bullseye processes to run at the same time for a request,
+# each over the ms2 scans in its own precursor m/z range. 1 runs a single bullseye process over all scans
+__bullseye_shards_env_key__ = 'BULLSEYE_SHARDS'
+__bullseye_shards_default__ = 1
+
 # environmental variable name for the full path to the work dir
 __workdir_env_key__ = 'APP_WORKDIR'
 
+# environmental variables for placing each request's work dir on a memory backed filesystem, such as
+# /dev/shm, when its estimated size fits in the memory budget shared by all requests being processed.
+# disabled if no directory is set. the peaks per scan are used to estimate the size of the ms1 and ms2 files
+__ram_workdir_env_key__ = 'APP_RAM_WORKDIR'
+__ram_workdir_max_size_mb_env_key__ = 'APP_RAM_WORKDIR_MAX_SIZE_MB'
+__ram_workdir_max_size_mb_default__ = 4096
+__ram_workdir_ms1_peaks_per_scan_env_key__ = 'APP_RAM_WORKDIR_MS1_PEAKS_PER_SCAN'
+__ram_workdir_ms1_peaks_per_scan_default__ = 5000
+__ram_workdir_ms2_peaks_per_scan_env_key__ = 'APP_RAM_WORKDIR_MS2_PEAKS_PER_SCAN'
+__ram_workdir_ms2_peaks_per_scan_default__ = 500
+
 # environmental variable name for the full path to the final dir to place files
 __final_dir_env_key__ = 'FINAL_DIR'
 
+# environmental variable for how to compress the result files placed in the final dir, one of:
+#   'none': place the files as they are
+#   'gzip': gzip the files, adding .gz to their names
+#   'zstd': compress the files with zstandard, adding .zst to their names
+__final_dir_compression_env_key__ = 'FINAL_DIR_COMPRESSION'
+
 # environmental variable name for full path to Hardklor and Bullseye executables
 __hardklor_filter_executable_path_env_key__ = 'HARDKLOR_EXEC_PATH'
 __bullseye_filter_executable_path_env_key__ = 'BULLSEYE_EXEC_PATH'
@@ -51,21 +127,44 @@ __bullseye_filter_executable_path_env_key__ = 'BULLSEYE_EXEC_PATH'
 # environmental variable for whether or not to clean the working directory after each request
 __clean_working_directory_env_key__ = 'APP_CLEAN_WORKDIR'
 
-# how long (in seconds) to sleep between checking for new requests to process
-__request_check_delay__ = 10
+# environmental variable for how often, in milliseconds, to sample the stacks of the python threads while a
+# request is processed, for a profile published with its results. 0 turns off the profiler
+__trace_profile_interval_ms_env_key__ = 'APP_TRACE_PROFILE_INTERVAL_MS'
+__trace_profile_interval_ms_default__ = 0
+
+# environmental variable for the full path to the SQLite database the requests and their status are kept
+# in, so queued requests are run and statuses can be looked up after a restart. kept in memory if not set
+__job_store_file_env_key__ = 'APP_JOB_STORE_FILE'
 
-# array of dicts, each dict: {id: request id, data: the xml data of the request}
-request_queue = []
+# environmental variable for the least number of seconds between saving the progress of an ms1 or ms2 export,
+# which flushes and fsyncs the files, so an interrupted export resumes from there. 0 saves after every batch
+__export_checkpoint_interval_seconds_env_key__ = 'APP_EXPORT_CHECKPOINT_INTERVAL_SECONDS'
+__export_checkpoint_interval_seconds_default__ = 30
+
+# environmental variable for the number of requests to process at the same time
+__request_worker_count_env_key__ = 'APP_REQUEST_WORKERS'
+__request_worker_count_default__ = 1
+
+# queue of dicts, each dict: {id: request id, data: the xml data of the request}
+# hold request_queue.lock when changing a request's status between queued and processing
+request_queue = RequestQueue()
+
+# index of the requests that are queued or being processed. identical requests submitted
+# while one of them is in flight are attached to it rather than queued
+in_flight_requests = InFlightRequests(request_queue)
+
+# the store requests and their status are kept in, None if they are only kept in memory
+job_store = JobStore(os.getenv(__job_store_file_env_key__)) if os.getenv(__job_store_file_env_key__) else None
 
 # dict of:
 #   request id : {
+#       project_id: the project id of the request
 #       status: one of 'queued', 'processing', 'not found', 'success', 'error'
 #       message: file path if successful, error message otherwise
+#       data: {data for job}, to queue the request again after a restart
 #   }
-request_status_dict = {}
-
-# whether or not the request queue processing has been started up
-request_queue_status = {'started': False}
+# a RequestStatusDict that keeps the statuses in the job store if there is one
+request_status_dict = {} if job_store is None else RequestStatusDict(job_store)
 
 # ensure all environmental variables are present
 env_var_names = [
@@ -0,0 +1,361 @@
+"""Methods for running Bullseye as several processes, each over its own precursor m/z range of MS2 scans"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import contextlib
+import heapq
+import os
+from . import general_utils, process_utils, mass_utils, ms_file_utils, __hardklor_results_file__,\
+    __bullseye_results_file__, __bullseye_shards_env_key__, __bullseye_shards_default__
+
+# the files Bullseye writes the MS2 scans that did and did not match a persistent peptide to
+bullseye_matches_file = 'matches.ms2'
+bullseye_no_matches_file = 'nomatches.ms2'
+
+# Hardklor peaks within this many m/z of a shard's precursor m/z range are given to that shard, so
+# every persistent peptide an MS2 scan of the shard could match is found whole in that shard
+_precursor_mz_padding = 5.0
+
+
+class BullseyeShard:
+    def __init__(self, shard_number, min_precursor_mz, max_precursor_mz):
+        """Create a BullseyeShard object, the MS2 scans with a precursor m/z in a range and the
+        Hardklor peaks near that range
+
+        Parameters:
+            shard_number (int): The number of this shard, starting at 1
+            min_precursor_mz (float): The lowest precursor m/z of this shard, None for no limit
+            max_precursor_mz (float): Precursor m/z of this shard are below this, None for no limit
+
+        Returns:
+            Populated BullseyeShard object
+        """
+        self.shard_number = shard_number
+        self.min_precursor_mz = min_precursor_mz
+        self.max_precursor_mz = max_precursor_mz
+
+        prefix = 'bullseye.shard' + str(shard_number) + '.'
+        self.hardklor_results_file = prefix + __hardklor_results_file__
+        self.ms2_file = prefix + ms_file_utils.get_ms2_file_name()
+        self.results_file = prefix + __bullseye_results_file__
+        self.matches_file = prefix + bullseye_matches_file
+        self.no_matches_file = prefix + bullseye_no_matches_file
+
+    def has_precursor_mz(self, precursor_mz):
+        """Whether an MS2 scan with this precursor m/z belongs to this shard
+
+        Parameters:
+            precursor_mz (float): The precursor m/z
+
+        Returns:
+            bool
+        """
+
+        return (self.min_precursor_mz is None or precursor_mz >= self.min_precursor_mz) and\
+            (self.max_precursor_mz is None or precursor_mz < self.max_precursor_mz)
+
+    def overlaps_mz_range(self, low_mz, high_mz):
+        """Whether a Hardklor peak spanning this m/z range could match an MS2 scan of this shard
+
+        Parameters:
+            low_mz (float): The lowest m/z of the peak
+            high_mz (float): The highest m/z of the peak
+
+        Returns:
+            bool
+        """
+
+        return (self.min_precursor_mz is None or high_mz + _precursor_mz_padding >= self.min_precursor_mz) and\
+            (self.max_precursor_mz is None or low_mz - _precursor_mz_padding < self.max_precursor_mz)
+
+
+def get_bullseye_shard_count():
+    """Get the number of Bullseye processes to run at the same time for a request. 1 runs a
+    single Bullseye process over all scans.
+
+    Returns:
+        int
+    """
+
+    shard_count = general_utils.get_int_env_var(__bullseye_shards_env_key__, __bullseye_shards_default__)
+    if shard_count < 1:
+        raise ValueError('Must be at least 1:', __bullseye_shards_env_key__)
+
+    return shard_count
+
+
+def plan_bullseye_shards(workdir, shard_count):
+    """Split the MS2 scans into precursor m/z ranges with about the same number of scans each
+
+    Parameters:
+        workdir (string): Full path to workdir
+        shard_count (int): The number of shards to make
+
+    Returns:
+        list: BullseyeShard objects in precursor m/z order, fewer than shard_count if there are
+              few distinct precursor m/z
+    """
+
+    ms2_file = ms_file_utils.read_ms_file(os.path.join(workdir, ms_file_utils.get_ms2_file_name()))
+
+    # skip the header
+    next(ms2_file)
+
+    precursor_mzs = sorted(precursor_mz for _, precursor_mz, _ in ms2_file)
+
+    # scans with the same precursor m/z are always in the same shard
+    boundaries = []
+    for shard_index in range(1, shard_count):
+        boundary = precursor_mzs[len(precursor_mzs) * shard_index // shard_count]
+        if boundary > precursor_mzs[0] and boundary not in boundaries:
+            boundaries.append(boundary)
+
+    lower_bounds = [None] + boundaries
+    upper_bounds = boundaries + [None]
+
+    return [BullseyeShard(i + 1, lower_bounds[i], upper_bounds[i]) for i in range(len(lower_bounds))]
+
+
+def write_bullseye_shard_input_files(shards, workdir):
+    """Write the MS2 and Hardklor results files for each shard. Every shard gets all the scan
+    lines of the Hardklor results, so gaps in persistence are counted as in a single run.
+
+    Parameters:
+        shards (list): BullseyeShard objects
+        workdir (string): Full path to workdir
+
+    Returns:
+        NoneType
+    """
+
+    ms2_files = [open(os.path.join(workdir, shard.ms2_file), 'wb') for shard in shards]
+
+    try:
+        ms2_file = ms_file_utils.read_ms_file(os.path.join(workdir, ms_file_utils.get_ms2_file_name()))
+
+        header = next(ms2_file)
+        for f in ms2_files:
+            f.write(header)
+
+        for _, precursor_mz, scan in ms2_file:
+            for shard, f in zip(shards, ms2_files):
+                if shard.has_precursor_mz(precursor_mz):
+                    f.write(scan)
+
+    finally:
+        for f in ms2_files:
+            f.close()
+
+    hardklor_results_files = [open(os.path.join(workdir, shard.hardklor_results_file), 'wb') for shard in shards]
+
+    try:
+        with open(os.path.join(workdir, __hardklor_results_file__), 'rb') as hardklor_results_file:
+            for line in hardklor_results_file:
+                if line.startswith(b'P\t'):
+                    low_mz, high_mz = _get_peak_mz_range(line)
+                    targets = [f for shard, f in zip(shards, hardklor_results_files)
+                               if shard.overlaps_mz_range(low_mz, high_mz)]
+                else:
+                    targets = hardklor_results_files
+
+                for target in targets:
+                    target.write(line)
+
+    finally:
+        for f in hardklor_results_files:
+            f.close()
+
+
+def run_bullseye_shards(bullseye_executable, bullseye_parameters, shards, workdir, progress_callback=None):
+    """Run a Bullseye process for every shard at the same time. If one fails, the others are killed.
+
+    Parameters:
+        bullseye_executable (string): Full path to the Bullseye executable
+        bullseye_parameters (list): The user's command line parameters for Bullseye
+        shards (list): BullseyeShard objects, their input files already written
+        workdir (string): Full path to workdir
+        progress_callback (function): Called with the process_utils.ProcessProgress of the shard
+                                      furthest behind as the shards progress, may be None
+
+    Returns:
+        NoneType
+    """
+
+    process_utils.run_processes_in_parallel(
+        'Bullseye',
+        [[bullseye_executable] + bullseye_parameters + [
+            '-o',
+            shard.results_file,
+            shard.hardklor_results_file,
+            shard.ms2_file,
+            shard.matches_file,
+            shard.no_matches_file
+        ] for shard in shards],
+        workdir,
+        None,
+        progress_callback
+    )
+
+    for shard in shards:
+        general_utils.verify_file_exists(os.path.join(workdir, shard.results_file))
+
+
+def merge_bullseye_shard_results(shards, workdir):
+    """Merge the results of all shards into the Bullseye results, matches and no matches files.
+    MS2 scans are written in scan order. A persistent peptide matched by scans of more than one
+    shard is written once, with the scans of all shards. The output is the same for the same
+    inputs, whatever order the shards finished in.
+
+    Parameters:
+        shards (list): BullseyeShard objects in precursor m/z order
+        workdir (string): Full path to workdir
+
+    Returns:
+        NoneType
+    """
+
+    _merge_ms2_files([shard.matches_file for shard in shards], bullseye_matches_file, workdir)
+    _merge_ms2_files([shard.no_matches_file for shard in shards], bullseye_no_matches_file, workdir)
+    _merge_bullseye_results_files(shards, workdir)
+
+    for shard in shards:
+        for filename in (shard.hardklor_results_file, shard.ms2_file, shard.results_file, shard.matches_file,
+                         shard.no_matches_file):
+            os.remove(os.path.join(workdir, filename))
+
+
+def _merge_ms2_files(shard_file_names, merged_file_name, workdir):
+    # the scans of each shard are read one at a time as they are merged, so only one scan per shard is in memory
+    with contextlib.ExitStack() as stack:
+        merged_file = stack.enter_context(open(os.path.join(workdir, merged_file_name), 'wb'))
+        shard_scans = []
+
+        for shard_number, shard_file_name in enumerate(shard_file_names):
+            shard_file = stack.enter_context(open(os.path.join(workdir, shard_file_name), 'rb'))
+            header, first_scan_line = _read_ms2_header(shard_file)
+
+            if shard_number == 0:
+                merged_file.write(b''.join(header))
+
+            shard_scans.append(_iterate_ms2_scans(shard_file, first_scan_line))
+
+        for _, scan_lines in heapq.merge(*shard_scans, key=lambda scan: scan[0]):
+            merged_file.write(b''.join(scan_lines))
+
+
+def _read_ms2_header(ms2_file):
+    header = []
+
+    for line in ms2_file:
+        if line.startswith(b'S\t'):
+            return header, line
+
+        header.append(line)
+
+    return header, None
+
+
+def _iterate_ms2_scans(ms2_file, first_scan_line):
+    if first_scan_line is None:
+        return
+
+    scan_lines = [first_scan_line]
+
+    for line in ms2_file:
+        if line.startswith(b'S\t'):
+            yield _get_scan_number(scan_lines[0]), scan_lines
+            scan_lines = [line]
+        else:
+            scan_lines.append(line)
+
+    yield _get_scan_number(scan_lines[0]), scan_lines
+
+
+def _get_scan_number(scan_line):
+    return int(scan_line.split(b'\t', 2)[1])
+
+
+def _merge_bullseye_results_files(shards, workdir):
+    header = None
+    shard_peptides = []
+    ms2_scans_by_peptide = {}
+
+    for shard in shards:
+        shard_header = []
+        peptides = []
+
+        with open(os.path.join(workdir, shard.results_file), 'rb') as results_file:
+            # the lines up to and including the column names describe the run, one line per peptide follows
+            for line in results_file:
+                if len(shard_header) < 1 or not shard_header[-1].startswith(b'MonoisotopicMass\t'):
+                    shard_header.append(line)
+                    continue
+
+                fields = line.rstrip(b'\r\n').split(b'\t')
+                if len(fields) < 5:
+                    continue
+
+                peptide = tuple(fields[:-1])
+                peptides.append(peptide)
+
+                ms2_scans = ms2_scans_by_peptide.setdefault(peptide, set())
+                ms2_scans.update(int(scan) for scan in fields[-1].split(b';') if scan)
+
+        if len(shard_header) < 1 or not shard_header[-1].startswith(b'MonoisotopicMass\t'):
+            raise ValueError('Column names not found in:', shard.results_file)
+
+        if header is None:
+            header = [_replace_shard_file_names(line, shard) for line in shard_header]
+
+        shard_peptides.append(peptides)
+
+    with open(os.path.join(workdir, __bullseye_results_file__), 'wb') as merged_file:
+        merged_file.write(b''.join(header))
+
+        # keep the order bullseye wrote each shard's peptides in, which is close to m/z order
+        for peptide in heapq.merge(*shard_peptides, key=_get_peptide_mz):
+            if peptide not in ms2_scans_by_peptide:
+                continue
+
+            ms2_scans = b';'.join(str(scan).encode() for scan in sorted(ms2_scans_by_peptide.pop(peptide)))
+            merged_file.write(b'\t'.join(peptide + (ms2_scans,)) + b'\n')
+
+
+def _get_peptide_mz(peptide):
+    return float(peptide[0]) / max(int(peptide[1]), 1)
+
+
+def _replace_shard_file_names(line, shard):
+    for shard_file_name, file_name in ((shard.hardklor_results_file, __hardklor_results_file__),
+                                       (shard.ms2_file, ms_file_utils.get_ms2_file_name()),
+                                       (shard.matches_file, bullseye_matches_file),
+                                       (shard.no_matches_file, bullseye_no_matches_file)):
+        line = line.replace(shard_file_name.encode(), file_name.encode())
+
+    return line
+
+
+def _get_peak_mz_range(peak_line):
+    # P <monoisotopic mass> <charge> <intensity> <base isotope peak m/z> <window low m/z>-<window high m/z> ...
+    fields = peak_line.split(b'\t')
+
+    mass = float(fields[1])
+    charge = max(int(fields[2]), 1)
+    mz_values = [mass / charge + mass_utils.proton_mass, float(fields[4])]
+
+    if len(fields) > 5 and b'-' in fields[5]:
+        mz_values.extend(float(value) for value in fields[5].split(b'-', 1))
+
+    return min(mz_values), max(mz_values)
@@ -0,0 +1,298 @@
+"""Methods for recording the progress of a pipeline run in its workdir, so an interrupted run can resume"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import hashlib
+import json
+import os
+import time
+from . import general_utils, __export_checkpoint_interval_seconds_env_key__, \
+    __export_checkpoint_interval_seconds_default__
+
+# the directory in the workdir checkpoints are kept in
+_checkpoint_dir_name = '.checkpoints'
+
+# the number of bytes read at a time to checksum a file
+_read_size = 1024 * 1024
+
+
+def is_step_complete(workdir, step_name):
+    """Whether a pipeline step was completed in this workdir and every file it wrote is still
+    there with the same size and modification time, and the same checksum if one was recorded
+
+    Parameters:
+        workdir (string): Full path to workdir
+        step_name (string): The name of the pipeline step
+
+    Returns:
+        bool
+    """
+
+    checkpoint = _read_checkpoint(_get_step_checkpoint_path(workdir, step_name))
+    if checkpoint is None:
+        return False
+
+    for filename, expected in checkpoint['files'].items():
+        file_path = os.path.join(workdir, filename)
+
+        if not os.path.exists(file_path):
+            print('Output of completed step', step_name, 'is missing, running it again:', filename)
+            return False
+
+        file_stat = os.stat(file_path)
+        if file_stat.st_size != expected['bytes'] or file_stat.st_mtime_ns != expected['mtime_ns']:
+            print('Output of completed step', step_name, 'has changed, running it again:', filename)
+            return False
+
+        if 'sha256' in expected and get_file_sha256(file_path) != expected['sha256']:
+            print('Output of completed step', step_name, 'has changed, running it again:', filename)
+            return False
+
+    return True
+
+
+def mark_step_complete(workdir, step_name, filenames, record_sha256=False):
+    """Record that a pipeline step is complete, with the size and modification time of each
+    file it wrote that is in the workdir. Their checksums are only recorded if asked for, as
+    that reads each file in full.
+
+    Parameters:
+        workdir (string): Full path to workdir
+        step_name (string): The name of the pipeline step
+        filenames (list): The names of the files the step may have written to the workdir
+        record_sha256 (bool): Whether to record the sha256 of each file
+
+    Returns:
+        NoneType
+    """
+
+    files = {}
+    for filename in filenames:
+        file_path = os.path.join(workdir, filename)
+
+        if os.path.exists(file_path):
+            file_stat = os.stat(file_path)
+            files[filename] = {'bytes': file_stat.st_size, 'mtime_ns': file_stat.st_mtime_ns}
+
+            if record_sha256:
+                files[filename]['sha256'] = get_file_sha256(file_path)
+
+    _write_checkpoint(_get_step_checkpoint_path(workdir, step_name), {'files': files})
+
+
+def get_recorded_file(workdir, step_name, filename):
+    """Get the size and sha256 of a file as it was when the pipeline step that wrote it completed,
+    if the step recorded its sha256
+
+    Parameters:
+        workdir (string): Full path to workdir
+        step_name (string): The name of the pipeline step
+        filename (string): The name of the file in the workdir
+
+    Returns:
+        dict: {'bytes': size, 'sha256': hex digest}, or None if the step is not complete, did not write
+              the file or did not record its sha256
+    """
+
+    checkpoint = _read_checkpoint(_get_step_checkpoint_path(workdir, step_name))
+    if checkpoint is None or 'sha256' not in checkpoint['files'].get(filename, {}):
+        return None
+
+    return checkpoint['files'][filename]
+
+
+def remove_step_outputs(workdir, step_name, filenames):
+    """Remove the files an incomplete pipeline step may have partly written, so later steps do not
+    mistake them for its results
+
+    Parameters:
+        workdir (string): Full path to workdir
+        step_name (string): The name of the pipeline step
+        filenames (list): The names of the files the step may have written to the workdir
+
+    Returns:
+        NoneType
+    """
+
+    for filename in filenames:
+        file_path = os.path.join(workdir, filename)
+
+        if os.path.exists(file_path):
+            print('Removing output of incomplete step', step_name + ':', filename)
+            os.remove(file_path)
+
+
+def get_export_progress(workdir, filenames, scan_sets, settings):
+    """Get how far an interrupted export of the files got. The export only resumes if it is
+    for the same scan sets and settings.
+
+    Parameters:
+        workdir (string): Full path to workdir
+        filenames (list): The names of the files being exported
+        scan_sets (list): The lists of scan numbers requested from spectr, one per request
+        settings (string): Anything else that changes the contents of the files
+
+    Returns:
+        dict: {'scan_sets': number of scan sets completely written, 'bytes': {filename: size of the
+              file after the last complete scan set}}, or None if the export has to start over
+    """
+
+    progress = _read_checkpoint(_get_export_checkpoint_path(workdir, filenames))
+    if progress is None or progress['key'] != _get_export_key(scan_sets, settings):
+        return None
+
+    # the files must hold at least everything written up to the last complete scan set
+    for filename in filenames:
+        file_path = os.path.join(workdir, filename)
+
+        if not os.path.exists(file_path) or os.path.getsize(file_path) < progress['bytes'][filename]:
+            return None
+
+    return progress
+
+
+def get_export_progress_interval_seconds():
+    """Get the least number of seconds between saving the progress of an export, 0 to save it
+    each time a scan set is written
+
+    Returns:
+        int
+    """
+
+    interval_seconds = general_utils.get_int_env_var(__export_checkpoint_interval_seconds_env_key__,
+                                                     __export_checkpoint_interval_seconds_default__)
+    if interval_seconds < 0:
+        raise ValueError('Must be at least 0:', __export_checkpoint_interval_seconds_env_key__)
+
+    return interval_seconds
+
+
+def get_export_progress_saver(workdir, filenames, files, scan_sets, settings, scan_sets_done):
+    """Get a method that records the progress of an export when a scan set is completely
+    written, for a pipeline_utils.ScanFetchPipeline to call. Saving flushes the files and syncs
+    the record to disk, so it is only done once the configured interval has passed since the
+    last save. An interrupted export resumes from the last save.
+
+    Parameters:
+        workdir (string): Full path to workdir
+        filenames (list): The names of the files being exported
+        files (list): The open files, in the order of filenames. Each must have flush() and fileno()
+        scan_sets (list): The lists of scan numbers requested from spectr, one per request
+        settings (string): Anything else that changes the contents of the files
+        scan_sets_done (int): The number of scan sets written before the pipeline started
+
+    Returns:
+        function: Takes the number of scan sets the pipeline has completely written
+    """
+
+    export_key = _get_export_key(scan_sets, settings)
+    interval_seconds = get_export_progress_interval_seconds()
+    last_save_time = time.monotonic()
+
+    def save_export_progress(pipeline_scan_sets_done):
+        nonlocal last_save_time
+
+        if time.monotonic() - last_save_time < interval_seconds:
+            return
+
+        last_save_time = time.monotonic()
+
+        file_sizes = []
+        for f in files:
+            f.flush()
+            file_sizes.append(os.fstat(f.fileno()).st_size)
+
+        _write_checkpoint(
+            _get_export_checkpoint_path(workdir, filenames),
+            {
+                'key': export_key,
+                'scan_sets': scan_sets_done + pipeline_scan_sets_done,
+                'bytes': dict(zip(filenames, file_sizes))
+            }
+        )
+
+    return save_export_progress
+
+
+def remove_export_progress(workdir, filenames):
+    """Remove the record of an export's progress once it is finished
+
+    Parameters:
+        workdir (string): Full path to workdir
+        filenames (list): The names of the files that were exported
+
+    Returns:
+        NoneType
+    """
+
+    checkpoint_path = _get_export_checkpoint_path(workdir, filenames)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+
+def get_file_sha256(file_path):
+    """Get the sha256 of a file's contents
+
+    Parameters:
+        file_path (string): Full path to the file
+
+    Returns:
+        string: hex digest
+    """
+
+    sha256 = hashlib.sha256()
+
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(_read_size)
+            if not chunk:
+                break
+
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def _get_export_key(scan_sets, settings):
+    return hashlib.sha256(json.dumps([scan_sets, settings]).encode('utf-8')).hexdigest()
+
+
+def _get_step_checkpoint_path(workdir, step_name):
+    return os.path.join(workdir, _checkpoint_dir_name, 'step.' + step_name.replace(' ', '_') + '.json')
+
+
+def _get_export_checkpoint_path(workdir, filenames):
+    return os.path.join(workdir, _checkpoint_dir_name, 'export.' + '.'.join(filenames) + '.json')
+
+
+def _read_checkpoint(checkpoint_path):
+    try:
+        with open(checkpoint_path, 'r') as checkpoint_file:
+            return json.load(checkpoint_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_checkpoint(checkpoint_path, checkpoint):
+    os.makedirs(os.path.dirname(checkpoint_path), exist_ok=True)
+
+    # write to a temporary file and rename it, so a checkpoint is never partly written
+    temp_path = checkpoint_path + '.tmp'
+    with open(temp_path, 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+
+    os.rename(temp_path, checkpoint_path)
@@ -0,0 +1,337 @@
+"""Persistent, size-bounded LRU cache of files on disk"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from . import general_utils, __spectral_file_cache_dir_env_key__, __spectral_file_cache_max_size_mb_env_key__, \
+    __spectral_file_cache_max_size_mb_default__, __hardklor_results_cache_dir_env_key__, \
+    __hardklor_results_cache_max_size_mb_env_key__, __hardklor_results_cache_max_size_mb_default__
+
+# name of the file in each cache entry directory that describes the entry
+_entry_file_name = 'entry.json'
+
+# prefix of the directories entries are assembled in before being added to the cache
+_temp_dir_prefix = '.tmp-'
+
+# ioctl request to clone (reflink) a file on filesystems that support it, such as btrfs and xfs
+_ficlone = 0x40049409
+
+# the caches shared by all threads, created on first use
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_spectral_file_cache():
+    """Get the shared cache of exported ms1 and ms2 files
+
+    Returns:
+        FileCache: The cache, or None if no cache directory is configured
+    """
+
+    return _get_cache(
+        __spectral_file_cache_dir_env_key__,
+        __spectral_file_cache_max_size_mb_env_key__,
+        __spectral_file_cache_max_size_mb_default__
+    )
+
+
+def get_hardklor_results_cache():
+    """Get the shared cache of Hardklor results
+
+    Returns:
+        FileCache: The cache, or None if no cache directory is configured
+    """
+
+    return _get_cache(
+        __hardklor_results_cache_dir_env_key__,
+        __hardklor_results_cache_max_size_mb_env_key__,
+        __hardklor_results_cache_max_size_mb_default__
+    )
+
+
+def _get_cache(cache_dir_env_key, max_size_mb_env_key, max_size_mb_default):
+    cache_dir = os.getenv(cache_dir_env_key)
+    if cache_dir is None or not cache_dir:
+        return None
+
+    with _caches_lock:
+        if cache_dir_env_key not in _caches:
+            max_size_mb = general_utils.get_int_env_var(max_size_mb_env_key, max_size_mb_default)
+            if max_size_mb < 1:
+                raise ValueError('Must be at least 1:', max_size_mb_env_key)
+
+            _caches[cache_dir_env_key] = FileCache(cache_dir, max_size_mb * 1024 * 1024)
+
+        return _caches[cache_dir_env_key]
+
+
+class FileCache:
+    def __init__(self, cache_dir, max_bytes):
+        """Create a FileCache object. Each entry is a set of files stored under a directory named
+        by the sha256 of the entry's key. When the total size goes over max_bytes the least
+        recently used entries are evicted. Entries already in cache_dir are loaded, using the
+        modification time of their entry file as the time they were last used.
+
+        Parameters:
+            cache_dir (string): Full path to the directory holding the cache, created if needed
+            max_bytes (int): The maximum total size of all files in the cache
+
+        Returns:
+            Populated FileCache object
+        """
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+        # entry directory name -> total size of its files, least recently used first
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_entries()
+
+    def link_files_into(self, key, filenames, destination_dir):
+        """If the cache holds all the named files for this key, place them in destination_dir.
+        Files are hardlinked if possible, else reflinked, else copied. Reflinks and copies are
+        made after the cache lock is released, so other lookups are not held up by them.
+
+        Parameters:
+            key (string): The key of the cache entry
+            filenames (list): The names of the files wanted from the entry
+            destination_dir (string): Full path to the directory to place the files in
+
+        Returns:
+            bool: True on a cache hit, False on a miss
+        """
+
+        entry_dir_name = get_entry_dir_name(key)
+
+        # files that could not be hardlinked, opened so they can be copied after the lock is released
+        # even if the entry is evicted in the meantime
+        files_to_copy = []
+
+        try:
+            with self._lock:
+                entry_dir = os.path.join(self._cache_dir, entry_dir_name)
+                entry = self._read_entry(entry_dir_name) if entry_dir_name in self._entries else None
+
+                if entry is None or entry['key'] != key or not set(filenames).issubset(entry['files']):
+                    self._misses += 1
+                    return False
+
+                for filename in filenames:
+                    source_path = os.path.join(entry_dir, filename)
+                    destination_path = os.path.join(destination_dir, filename)
+
+                    if not _link_file(source_path, destination_path):
+                        files_to_copy.append((open(source_path, 'rb'), destination_path))
+
+                # mark as most recently used, on disk too so the order survives a restart
+                self._entries.move_to_end(entry_dir_name)
+                os.utime(os.path.join(entry_dir, _entry_file_name))
+
+                self._hits += 1
+
+            for source_file, destination_path in files_to_copy:
+                _clone_or_copy_file(source_file, destination_path)
+
+            return True
+
+        finally:
+            for source_file, destination_path in files_to_copy:
+                source_file.close()
+
+    def add_files(self, key, source_dir, filenames):
+        """Add the named files in source_dir to the cache under this key, replacing any
+        existing entry, then evict entries until the cache fits in its maximum size. Files are
+        hardlinked into the cache if possible, so this is cheap when source_dir is on the same
+        filesystem. Entries larger than the whole cache are not added.
+
+        Parameters:
+            key (string): The key of the cache entry
+            source_dir (string): Full path to the directory containing the files
+            filenames (list): The names of the files to add
+
+        Returns:
+            bool: True if the files were added
+        """
+
+        file_sizes = {filename: os.path.getsize(os.path.join(source_dir, filename)) for filename in filenames}
+        entry_bytes = sum(file_sizes.values())
+
+        if entry_bytes > self._max_bytes:
+            print('Not caching', filenames, 'for', key, 'larger than the cache size')
+            return False
+
+        entry_dir_name = get_entry_dir_name(key)
+
+        # assemble the entry in a temp directory so it appears in the cache all at once
+        temp_dir = os.path.join(self._cache_dir, _temp_dir_prefix + str(uuid.uuid4()))
+        os.mkdir(temp_dir)
+
+        try:
+            for filename in filenames:
+                link_or_copy_file(os.path.join(source_dir, filename), os.path.join(temp_dir, filename))
+
+            with open(os.path.join(temp_dir, _entry_file_name), 'w') as entry_file:
+                json.dump({'key': key, 'files': file_sizes}, entry_file)
+
+            with self._lock:
+                self._remove_entry(entry_dir_name)
+
+                os.rename(temp_dir, os.path.join(self._cache_dir, entry_dir_name))
+                self._entries[entry_dir_name] = entry_bytes
+                self._total_bytes += entry_bytes
+
+                self._evict()
+
+        finally:
+            if os.path.exists(temp_dir):
+                shutil.rmtree(temp_dir, ignore_errors=True)
+
+        return True
+
+    def get_stats(self):
+        """Get the counters for this cache
+
+        Returns:
+            dict: {'hits', 'misses', 'hit_rate', 'evictions', 'entries', 'bytes', 'max_bytes'}
+        """
+
+        with self._lock:
+            lookups = self._hits + self._misses
+
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': round(self._hits / lookups, 3) if lookups > 0 else None,
+                'evictions': self._evictions,
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'max_bytes': self._max_bytes
+            }
+
+    def _load_entries(self):
+        loaded_entries = []
+
+        for entry_dir_name in os.listdir(self._cache_dir):
+            entry_dir = os.path.join(self._cache_dir, entry_dir_name)
+
+            # left behind by an add that did not finish
+            if entry_dir_name.startswith(_temp_dir_prefix):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+
+            entry = self._read_entry(entry_dir_name)
+            if entry is None:
+                continue
+
+            last_used = os.path.getmtime(os.path.join(entry_dir, _entry_file_name))
+            loaded_entries.append((last_used, entry_dir_name, sum(entry['files'].values())))
+
+        for last_used, entry_dir_name, entry_bytes in sorted(loaded_entries):
+            self._entries[entry_dir_name] = entry_bytes
+            self._total_bytes += entry_bytes
+
+        self._evict()
+
+    def _read_entry(self, entry_dir_name):
+        try:
+            with open(os.path.join(self._cache_dir, entry_dir_name, _entry_file_name), 'r') as entry_file:
+                return json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+
+    def _remove_entry(self, entry_dir_name):
+        if entry_dir_name in self._entries:
+            self._total_bytes -= self._entries.pop(entry_dir_name)
+
+        entry_dir = os.path.join(self._cache_dir, entry_dir_name)
+        if os.path.exists(entry_dir):
+            shutil.rmtree(entry_dir)
+
+    def _evict(self):
+        while self._total_bytes > self._max_bytes and len(self._entries) > 0:
+            entry_dir_name = next(iter(self._entries))
+            print('Evicting cache entry:', os.path.join(self._cache_dir, entry_dir_name))
+
+            self._remove_entry(entry_dir_name)
+            self._evictions += 1
+
+
+def get_entry_dir_name(key):
+    """Get the name of the directory holding the cache entry for this key
+
+    Parameters:
+        key (string): The key of the cache entry
+
+    Returns:
+        string
+    """
+
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def link_or_copy_file(source_path, destination_path):
+    """Place a file at destination_path with the contents of source_path, using a hardlink if
+    both are on the same filesystem, else a reflink if the filesystem supports it, else a copy
+
+    Parameters:
+        source_path (string): Full path to the existing file
+        destination_path (string): Full path to the new file, replaced if it exists
+
+    Returns:
+        NoneType
+    """
+
+    if _link_file(source_path, destination_path):
+        return
+
+    with open(source_path, 'rb') as source_file:
+        _clone_or_copy_file(source_file, destination_path)
+
+
+def _link_file(source_path, destination_path):
+    # never write through an existing file, it may be a hardlink to source_path
+    if os.path.lexists(destination_path):
+        os.remove(destination_path)
+
+    try:
+        os.link(source_path, destination_path)
+        return True
+    except OSError:
+        return False
+
+
+def _clone_or_copy_file(source_file, destination_path):
+    with open(destination_path, 'wb') as destination_file:
+        try:
+            fcntl.ioctl(destination_file.fileno(), _ficlone, source_file.fileno())
+            return
+        except OSError:
+            pass
+
+        shutil.copyfileobj(source_file, destination_file, 1024 * 1024)
@@ -34,3 +34,24 @@ def verify_file_exists(file_path):
 
     if not os.path.exists(file_path):
         raise ValueError('Expected file not found:', file_path)
+
+
+def get_int_env_var(env_key, default_value):
+    """Get the integer value of an optional environmental variable
+
+    Parameters:
+        env_key (string): The name of the environmental variable
+        default_value (int): The value to use if the variable is not set or is empty
+
+    Returns:
+        int
+    """
+
+    value = os.getenv(env_key)
+    if value is None or not value.strip():
+        return default_value
+
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError('Expected an integer for environmental variable:', env_key, value)
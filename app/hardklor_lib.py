@@ -0,0 +1,220 @@
+"""Methods for running Hardklor as several processes, each over its own range of scans"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+from . import general_utils, hardklor_utils, process_utils, ms_file_utils, __hardklor_results_file__,\
+    __hardklor_shards_env_key__, __hardklor_shards_default__
+
+
+class HardklorShard:
+    def __init__(self, shard_number, first_scan, last_scan, run_first_scan, run_last_scan):
+        """Create a HardklorShard object, one of the scan ranges Hardklor is run over. With boxcar
+        averaging the range Hardklor is run over is wider than the range the shard owns, so the
+        scans at the edges are averaged with the same neighbors as in a single run.
+
+        Parameters:
+            shard_number (int): The number of this shard, starting at 1
+            first_scan (int): The first scan number whose results are kept from this shard
+            last_scan (int): The last scan number whose results are kept from this shard
+            run_first_scan (int): The first scan number Hardklor is run over
+            run_last_scan (int): The last scan number Hardklor is run over
+
+        Returns:
+            Populated HardklorShard object
+        """
+        self.shard_number = shard_number
+        self.first_scan = first_scan
+        self.last_scan = last_scan
+        self.run_first_scan = run_first_scan
+        self.run_last_scan = run_last_scan
+        self.config_file = 'Hardklor.shard' + str(shard_number) + '.conf'
+        self.results_file = 'scans.shard' + str(shard_number) + '.hk'
+
+
+def get_hardklor_shard_count():
+    """Get the number of Hardklor processes to run at the same time for a request. 1 runs a
+    single Hardklor process over all scans.
+
+    Returns:
+        int
+    """
+
+    shard_count = general_utils.get_int_env_var(__hardklor_shards_env_key__, __hardklor_shards_default__)
+    if shard_count < 1:
+        raise ValueError('Must be at least 1:', __hardklor_shards_env_key__)
+
+    return shard_count
+
+
+def get_ms1_scan_numbers(workdir):
+    """Read the scan numbers of the scans in the ms1 file, in file order
+
+    Parameters:
+        workdir (string): Full path to workdir
+
+    Returns:
+        list: int scan numbers
+    """
+
+    ms1_file = ms_file_utils.read_ms_file(os.path.join(workdir, ms_file_utils.get_ms1_file_name()))
+
+    # skip the header
+    next(ms1_file)
+
+    return [scan_number for scan_number, _, _ in ms1_file]
+
+
+def plan_hardklor_shards(scan_numbers, hardklor_config, shard_count):
+    """Split the ms1 scans Hardklor would process into shards with about the same number of
+    scans each. Honors any scan range set in the Hardklor config. If boxcar averaging is on,
+    each shard is run over that many extra scans on both sides.
+
+    Parameters:
+        scan_numbers (list): int scan numbers of the ms1 file, in file order
+        hardklor_config (string): Contents of the Hardklor config file
+        shard_count (int): The number of shards to make
+
+    Returns:
+        list: HardklorShard objects in scan order, fewer than shard_count if there are few scans
+    """
+
+    parameters, _ = hardklor_utils.convert_hardklor_config_to_dict(hardklor_config)
+
+    # hardklor treats 0 as no limit
+    scan_range_min = _get_int_parameter(parameters, 'scan_range_min', 0)
+    scan_range_max = _get_int_parameter(parameters, 'scan_range_max', 0)
+    boxcar_scans = _get_int_parameter(parameters, 'boxcar_averaging', 0)
+
+    scan_numbers = sorted(scan_numbers)
+    selected_indexes = [i for i, scan_number in enumerate(scan_numbers)
+                        if scan_number >= scan_range_min and (scan_range_max < 1 or scan_number <= scan_range_max)]
+
+    shard_count = min(shard_count, len(selected_indexes))
+    shards = []
+
+    for shard_index in range(shard_count):
+        first_index = selected_indexes[len(selected_indexes) * shard_index // shard_count]
+        last_index = selected_indexes[len(selected_indexes) * (shard_index + 1) // shard_count - 1]
+
+        # a single run only averages scans in the configured scan range, so the shards do too
+        run_first_index = max(first_index - boxcar_scans, selected_indexes[0])
+        run_last_index = min(last_index + boxcar_scans, selected_indexes[-1])
+
+        shards.append(HardklorShard(
+            shard_index + 1,
+            scan_numbers[first_index],
+            scan_numbers[last_index],
+            scan_numbers[run_first_index],
+            scan_numbers[run_last_index]
+        ))
+
+    return shards
+
+
+def write_hardklor_shard_config_files(hardklor_config, shards, workdir):
+    """Write a Hardklor config file for each shard, limited to the scans of that shard and
+    writing to that shard's results file
+
+    Parameters:
+        hardklor_config (string): Contents of the Hardklor config file
+        shards (list): HardklorShard objects
+        workdir (string): Full path to workdir
+
+    Returns:
+        NoneType
+    """
+
+    for shard in shards:
+        shard_config = hardklor_utils.make_hardklor_config_for_scan_range(
+            hardklor_config,
+            shard.run_first_scan,
+            shard.run_last_scan,
+            ms_file_utils.get_ms1_file_name(),
+            shard.results_file
+        )
+
+        with open(os.path.join(workdir, shard.config_file), 'w') as config_file:
+            config_file.write(shard_config)
+
+
+def run_hardklor_shards(hardklor_executable, shards, workdir, timeout, progress_callback=None):
+    """Run a Hardklor process for every shard at the same time. If one fails or the timeout
+    passes, the others are killed.
+
+    Parameters:
+        hardklor_executable (string): Full path to the Hardklor executable
+        shards (list): HardklorShard objects, their config files already written
+        workdir (string): Full path to workdir
+        timeout (int): Seconds all shards together may run for, None for no limit
+        progress_callback (function): Called with the process_utils.ProcessProgress of the shard
+                                      furthest behind as the shards progress, may be None
+
+    Returns:
+        NoneType
+    """
+
+    process_utils.run_processes_in_parallel(
+        'Hardklor',
+        [[hardklor_executable, shard.config_file] for shard in shards],
+        workdir,
+        timeout,
+        progress_callback
+    )
+
+    for shard in shards:
+        general_utils.verify_file_exists(os.path.join(workdir, shard.results_file))
+
+
+def merge_hardklor_shard_results(shards, workdir):
+    """Write the results of all shards to the Hardklor results file, in scan order. From each
+    shard only the results for the scans it owns are kept, dropping the extra scans it was run
+    over for boxcar averaging.
+
+    Parameters:
+        shards (list): HardklorShard objects in scan order
+        workdir (string): Full path to workdir
+
+    Returns:
+        NoneType
+    """
+
+    with open(os.path.join(workdir, __hardklor_results_file__), 'wb') as results_file:
+        for shard in shards:
+            with open(os.path.join(workdir, shard.results_file), 'rb') as shard_results_file:
+                # lines before the first scan are only written once
+                keep_lines = shard.shard_number == 1
+
+                for line in shard_results_file:
+                    if line.startswith(b'S\t'):
+                        scan_number = int(line.split(b'\t', 2)[1])
+                        keep_lines = shard.first_scan <= scan_number <= shard.last_scan
+
+                    if keep_lines:
+                        results_file.write(line)
+
+    for shard in shards:
+        for filename in (shard.config_file, shard.results_file):
+            os.remove(os.path.join(workdir, filename))
+
+
+def _get_int_parameter(parameters, name, default_value):
+    if name not in parameters:
+        return default_value
+
+    try:
+        return int(parameters[name])
+    except ValueError:
+        raise ValueError('Expected an integer for Hardklor parameter:', name, parameters[name])
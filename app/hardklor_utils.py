@@ -0,0 +1,108 @@
+"""Utility functions for working with Hardklor config files"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import hashlib
+import json
+
+
+def convert_hardklor_config_to_dict(hardklor_config):
+    """Read the lines of a Hardklor config file. Each parameter line is in the form of
+    <parameter> = <value>, anything after a '#' is a comment. If a parameter is set more
+    than once the last value is used, as Hardklor does. Other non-empty lines name the
+    input and output files.
+
+    Parameters:
+        hardklor_config (string): Contents of a Hardklor config file, new lines included
+
+    Returns:
+        tuple: (dict of parameter -> value, list of input/output file lines in order). All
+               runs of whitespace are collapsed to a single space
+    """
+
+    if hardklor_config is None or len(hardklor_config) < 1:
+        return {}, []
+
+    parameters = {}
+    file_lines = []
+
+    for line in hardklor_config.replace("\r\n", "\n").replace("\r", "\n").split("\n"):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+
+        if "=" in line:
+            key, value = line.split("=", 1)
+            parameters[key.strip()] = " ".join(value.split())
+        else:
+            file_lines.append(" ".join(line.split()))
+
+    return parameters, file_lines
+
+
+def get_hardklor_config_hash(hardklor_config):
+    """Get a hash of the settings in a Hardklor config file that does not change with
+    whitespace, comments or the order of the parameters
+
+    Parameters:
+        hardklor_config (string): Contents of a Hardklor config file, new lines included
+
+    Returns:
+        string: sha256 hex digest
+    """
+
+    parameters, file_lines = convert_hardklor_config_to_dict(hardklor_config)
+    canonical_config = json.dumps([sorted(parameters.items()), file_lines], separators=(',', ':'))
+
+    return hashlib.sha256(canonical_config.encode('utf-8')).hexdigest()
+
+
+def make_hardklor_config_for_scan_range(hardklor_config, scan_range_min, scan_range_max, ms1_file, results_file):
+    """Make a copy of a Hardklor config file that only processes the scans in the given range
+    and reads and writes the given files. Any scan range and input/output file lines in the
+    original config are replaced.
+
+    Parameters:
+        hardklor_config (string): Contents of a Hardklor config file, new lines included
+        scan_range_min (int): The first scan number to process
+        scan_range_max (int): The last scan number to process
+        ms1_file (string): The name of the ms1 file to read
+        results_file (string): The name of the results file to write
+
+    Returns:
+        string: Contents of the new Hardklor config file
+    """
+
+    lines = []
+
+    for line in hardklor_config.replace("\r\n", "\n").replace("\r", "\n").split("\n"):
+        setting = line.split("#", 1)[0].strip()
+
+        if setting and "=" not in setting:
+            continue
+
+        if setting and setting.split("=", 1)[0].strip() in ('scan_range_min', 'scan_range_max'):
+            continue
+
+        lines.append(line)
+
+    while len(lines) > 0 and not lines[-1].strip():
+        lines.pop()
+
+    lines.append('scan_range_min = ' + str(scan_range_min))
+    lines.append('scan_range_max = ' + str(scan_range_max))
+    lines.append(ms1_file + "\t" + results_file)
+
+    return "\n".join(lines) + "\n"
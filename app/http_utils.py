@@ -0,0 +1,209 @@
+"""Shared, connection-pooled http client used for all calls to spectr"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from . import general_utils, __spectr_http_pool_size_env_key__, __spectr_http_pool_size_default__, \
+    __spectr_http_connect_timeout_env_key__, __spectr_http_connect_timeout_default__, \
+    __spectr_http_read_timeout_env_key__, __spectr_http_read_timeout_default__, __spectr_http_keep_alive_env_key__
+
+# the client shared by all threads, created on first use
+_http_client = None
+_http_client_lock = threading.Lock()
+
+
+def get_http_client():
+    """Get the shared PooledHttpClient, creating it from the environmental variables on first use
+
+    Returns:
+        PooledHttpClient
+    """
+
+    global _http_client
+
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = PooledHttpClient(
+                pool_size=get_pool_size(),
+                connect_timeout=get_timeout(__spectr_http_connect_timeout_env_key__, __spectr_http_connect_timeout_default__),
+                read_timeout=get_timeout(__spectr_http_read_timeout_env_key__, __spectr_http_read_timeout_default__),
+                keep_alive=get_keep_alive()
+            )
+
+        return _http_client
+
+
+def get_pool_size():
+    """Get the maximum number of connections to keep open per host
+
+    Returns:
+        int
+    """
+
+    pool_size = general_utils.get_int_env_var(__spectr_http_pool_size_env_key__, __spectr_http_pool_size_default__)
+    if pool_size < 1:
+        raise ValueError('Must be at least 1:', __spectr_http_pool_size_env_key__)
+
+    return pool_size
+
+
+def get_timeout(env_key, default_value):
+    """Get a timeout in seconds from the environment. A value of 0 disables the timeout.
+
+    Parameters:
+        env_key (string): The name of the environmental variable
+        default_value (int): The timeout to use if the variable is not set
+
+    Returns:
+        int or NoneType
+    """
+
+    timeout = general_utils.get_int_env_var(env_key, default_value)
+    if timeout < 0:
+        raise ValueError('Timeout may not be negative:', env_key)
+
+    if timeout == 0:
+        return None
+
+    return timeout
+
+
+def get_keep_alive():
+    """Determine whether connections to spectr should be kept alive between requests. Uses
+    the environmental variable, which may be 'yes' or 'no'. Defaults to 'yes' if not set.
+
+    Returns:
+        bool
+    """
+
+    keep_alive = os.getenv(__spectr_http_keep_alive_env_key__)
+
+    if keep_alive is None or not keep_alive:
+        return True
+
+    if keep_alive == 'yes':
+        return True
+
+    if keep_alive == 'no':
+        return False
+
+    raise ValueError('Got unknown value for env var:', __spectr_http_keep_alive_env_key__)
+
+
+class PooledHttpClient:
+    def __init__(self, pool_size, connect_timeout, read_timeout, keep_alive):
+        """Create a PooledHttpClient object. A single connection pool is shared by all threads,
+        each thread gets its own requests.Session mounted on that pool.
+
+        Parameters:
+            pool_size (int): Maximum number of connections to keep open per host
+            connect_timeout (int): Seconds to wait to establish a connection, None to wait forever
+            read_timeout (int): Seconds to wait between bytes from the server, None to wait forever
+            keep_alive (bool): Whether to reuse connections between requests
+
+        Returns:
+            Populated PooledHttpClient object
+        """
+        self._timeout = (connect_timeout, read_timeout)
+        self._keep_alive = keep_alive
+        self._adapter = _CountingHTTPAdapter(self._count_new_connection, pool_connections=pool_size, pool_maxsize=pool_size)
+        self._thread_local = threading.local()
+
+        self._counter_lock = threading.Lock()
+        self._connections_opened = 0
+        self._requests_sent = 0
+
+    def post(self, url, **kwargs):
+        """Send a POST request using a pooled connection. Takes the same arguments as requests.post
+
+        Parameters:
+            url (string): The URL to post to
+
+        Returns:
+            requests.Response
+        """
+
+        kwargs.setdefault('timeout', self._timeout)
+
+        if not self._keep_alive:
+            headers = dict(kwargs.get('headers') or {})
+            headers['Connection'] = 'close'
+            kwargs['headers'] = headers
+
+        with self._counter_lock:
+            self._requests_sent += 1
+
+        return self._get_session().post(url, **kwargs)
+
+    def get_connection_stats(self):
+        """Get counters for the connections used by this client
+
+        Returns:
+            dict: {'requests': int, 'connections_opened': int, 'connections_reused': int}
+        """
+
+        with self._counter_lock:
+            return {
+                'requests': self._requests_sent,
+                'connections_opened': self._connections_opened,
+                'connections_reused': max(self._requests_sent - self._connections_opened, 0)
+            }
+
+    def _get_session(self):
+        session = getattr(self._thread_local, 'session', None)
+
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self._adapter)
+            session.mount('https://', self._adapter)
+            self._thread_local.session = session
+
+        return session
+
+    def _count_new_connection(self):
+        with self._counter_lock:
+            self._connections_opened += 1
+
+
+class _CountingHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools report every connection they open to the server"""
+
+    def __init__(self, on_new_connection, **kwargs):
+        self._on_new_connection = on_new_connection
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _make_counting_pool_class(HTTPConnectionPool, self._on_new_connection),
+            'https': _make_counting_pool_class(HTTPSConnectionPool, self._on_new_connection)
+        }
+
+
+def _make_counting_pool_class(pool_class, on_new_connection):
+    class CountingConnection(pool_class.ConnectionCls):
+        def connect(self):
+            on_new_connection()
+            return super().connect()
+
+    class CountingConnectionPool(pool_class):
+        ConnectionCls = CountingConnection
+
+    return CountingConnectionPool
@@ -0,0 +1,303 @@
+"""A job store that keeps the requests and their status in a SQLite database, so they survive restarts"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import MutableMapping
+
+# the keys of a request's status and whether each is stored as json
+_status_keys = {
+    'project_id': True,
+    'status': False,
+    'message': False,
+    'end_user_message': False,
+    'data': True
+}
+
+# statuses of requests that have not finished, they are queued again when the service starts
+_unfinished_statuses = ('queued', 'processing')
+
+_schema = [
+    """CREATE TABLE IF NOT EXISTS requests (
+        sequence_number INTEGER PRIMARY KEY AUTOINCREMENT,
+        request_id TEXT NOT NULL UNIQUE,
+        project_id TEXT,
+        status TEXT,
+        message TEXT,
+        end_user_message TEXT,
+        data TEXT,
+        created_time REAL NOT NULL,
+        updated_time REAL NOT NULL
+    )""",
+    'CREATE INDEX IF NOT EXISTS requests_project_id ON requests (project_id)',
+    'CREATE INDEX IF NOT EXISTS requests_status ON requests (status, sequence_number)'
+]
+
+
+class JobStore:
+    def __init__(self, db_path):
+        """Create a JobStore object, opening the SQLite database at db_path and creating its
+        tables if needed. The database is in WAL mode, so status reads do not wait for writes.
+        Each request is a row, looked up by its request id. Rows are numbered in the order the
+        requests were added, which is the order unfinished requests are queued again.
+
+        Parameters:
+            db_path (string): Full path to the database file, its directory is created if needed
+
+        Returns:
+            Populated JobStore object
+        """
+        self.db_path = db_path
+        self._lock = threading.Lock()
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        # one connection shared by all threads, each statement is its own transaction
+        self._connection = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+
+        for statement in _schema:
+            self._connection.execute(statement)
+
+    def put_status(self, request_id, status):
+        """Add a request with the given status, replacing any request with the same id
+
+        Parameters:
+            request_id (string): The request id
+            status (dict): The request's status, keys may be any of project_id, status, message,
+                           end_user_message and data
+
+        Returns:
+            NoneType
+        """
+
+        _check_status_keys(status)
+
+        keys = list(status.keys())
+        now = time.time()
+
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO requests (request_id, ' + ', '.join(keys) + ', created_time, updated_time) '
+                'VALUES (?, ' + ', '.join('?' for _ in keys) + ', ?, ?)',
+                [request_id] + [_to_column(key, status[key]) for key in keys] + [now, now]
+            )
+
+    def get_status(self, request_id):
+        """Get the status of a request
+
+        Parameters:
+            request_id (string): The request id
+
+        Returns:
+            dict: The request's status, or None if there is no request with this id
+        """
+
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT ' + ', '.join(_status_keys) + ' FROM requests WHERE request_id = ?',
+                (request_id,)
+            ).fetchone()
+
+        return None if row is None else _to_status(row)
+
+    def update_status(self, request_id, key, value):
+        """Change one value of a request's status
+
+        Parameters:
+            request_id (string): The request id
+            key (string): One of project_id, status, message, end_user_message and data
+            value: The new value
+
+        Returns:
+            bool: True if the request was found
+        """
+
+        _check_status_keys([key])
+
+        with self._lock:
+            cursor = self._connection.execute(
+                'UPDATE requests SET ' + key + ' = ?, updated_time = ? WHERE request_id = ?',
+                (_to_column(key, value), time.time(), request_id)
+            )
+
+        return cursor.rowcount > 0
+
+    def delete(self, request_id):
+        """Remove a request
+
+        Parameters:
+            request_id (string): The request id
+
+        Returns:
+            bool: True if the request was found and removed
+        """
+
+        with self._lock:
+            cursor = self._connection.execute('DELETE FROM requests WHERE request_id = ?', (request_id,))
+
+        return cursor.rowcount > 0
+
+    def contains(self, request_id):
+        """Whether there is a request with this id
+
+        Parameters:
+            request_id (string): The request id
+
+        Returns:
+            bool
+        """
+
+        with self._lock:
+            return self._connection.execute(
+                'SELECT 1 FROM requests WHERE request_id = ?', (request_id,)
+            ).fetchone() is not None
+
+    def get_request_ids(self):
+        """Get the ids of all requests, in the order they were added
+
+        Returns:
+            list: request ids
+        """
+
+        with self._lock:
+            return [row[0] for row in self._connection.execute(
+                'SELECT request_id FROM requests ORDER BY sequence_number')]
+
+    def get_unfinished_requests(self):
+        """Get the requests that were queued or being processed, in the order they were added
+
+        Returns:
+            list: (request id, status dict) tuples
+        """
+
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT request_id, ' + ', '.join(_status_keys) + ' FROM requests WHERE status IN (' +
+                ', '.join('?' for _ in _unfinished_statuses) + ') ORDER BY sequence_number',
+                _unfinished_statuses
+            ).fetchall()
+
+        return [(row[0], _to_status(row[1:])) for row in rows]
+
+    def count(self):
+        """Get the number of requests
+
+        Returns:
+            int
+        """
+
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM requests').fetchone()[0]
+
+
+class RequestStatusDict(MutableMapping):
+    def __init__(self, job_store):
+        """Create a RequestStatusDict object, a drop in replacement for the dict of request id ->
+        status dict that keeps the statuses in a JobStore. Getting a request's status reads it
+        from the store. Changing a value of the returned status writes it to the store.
+
+        Parameters:
+            job_store (JobStore): The store the statuses are kept in
+
+        Returns:
+            Populated RequestStatusDict object
+        """
+        self.job_store = job_store
+
+    def __getitem__(self, request_id):
+        status = self.job_store.get_status(request_id)
+        if status is None:
+            raise KeyError(request_id)
+
+        return RequestStatus(self.job_store, request_id, status)
+
+    def __setitem__(self, request_id, status):
+        self.job_store.put_status(request_id, status)
+
+    def __delitem__(self, request_id):
+        if not self.job_store.delete(request_id):
+            raise KeyError(request_id)
+
+    def __contains__(self, request_id):
+        return self.job_store.contains(request_id)
+
+    def __iter__(self):
+        return iter(self.job_store.get_request_ids())
+
+    def __len__(self):
+        return self.job_store.count()
+
+    def __repr__(self):
+        return 'RequestStatusDict(' + self.job_store.db_path + ', ' + str(len(self)) + ' requests)'
+
+
+class RequestStatus(dict):
+    def __init__(self, job_store, request_id, status):
+        """Create a RequestStatus object, the status of one request that writes every change
+        to the job store
+
+        Parameters:
+            job_store (JobStore): The store the status is kept in
+            request_id (string): The request id
+            status (dict): The status as read from the store
+
+        Returns:
+            Populated RequestStatus object
+        """
+        super().__init__(status)
+        self._job_store = job_store
+        self._request_id = request_id
+
+    def __setitem__(self, key, value):
+        # status requests set the message every time, only write it if it changed
+        if key in self and self[key] == value:
+            return
+
+        self._job_store.update_status(self._request_id, key, value)
+        super().__setitem__(key, value)
+
+
+def _check_status_keys(keys):
+    for key in keys:
+        if key not in _status_keys:
+            raise ValueError('Unknown request status key:', key)
+
+
+def _to_column(key, value):
+    if value is None:
+        return None
+
+    return json.dumps(value) if _status_keys[key] else value
+
+
+def _to_status(row):
+    status = {}
+
+    for (key, is_json), value in zip(_status_keys.items(), row):
+        # the end user message is only set once processing starts
+        if value is None and key == 'end_user_message':
+            continue
+
+        status[key] = json.loads(value) if is_json and value is not None else value
+
+    return status
@@ -0,0 +1,159 @@
+"""Methods for incrementally parsing large JSON documents as they are read"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import codecs
+import json
+
+_whitespace = ' \t\n\r'
+
+
+def iterate_array_in_object(chunks, array_key):
+    """Incrementally parse a JSON object and yield the items of the array found under
+    array_key one at a time. Only one item (plus the unread part of the current chunk)
+    is held in memory at a time. All other values in the object are parsed and ignored.
+
+    Parameters:
+        chunks (iterable): Yields the JSON document as bytes, in pieces of any size
+        array_key (string): The key of the array in the top-level object to iterate over
+
+    Returns:
+        generator: Yields each item of the array, decoded as by json.loads
+    """
+
+    reader = JsonStreamReader(chunks)
+
+    reader.expect('{')
+    if reader.peek() == '}':
+        reader.expect('}')
+        return
+
+    while True:
+        key = reader.read_value()
+        reader.expect(':')
+
+        if key == array_key and reader.peek() == '[':
+            reader.expect('[')
+
+            if reader.peek() == ']':
+                reader.expect(']')
+            else:
+                while True:
+                    yield reader.read_value()
+                    if reader.expect(',]') == ']':
+                        break
+        else:
+            reader.read_value()
+
+        if reader.expect(',}') == '}':
+            return
+
+
+class JsonStreamReader:
+    def __init__(self, chunks):
+        """Create a JsonStreamReader object
+
+        Parameters:
+            chunks (iterable): Yields the JSON document as bytes, in pieces of any size
+
+        Returns:
+            Populated JsonStreamReader object
+        """
+        self._chunks = iter(chunks)
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json_decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._position = 0
+        self._eof = False
+
+    def peek(self):
+        """Skip whitespace and return the next character without consuming it
+
+        Returns:
+            string: The next character, or '' at the end of the document
+        """
+
+        while True:
+            while self._position < len(self._buffer) and self._buffer[self._position] in _whitespace:
+                self._position += 1
+
+            if self._position < len(self._buffer) or self._eof:
+                return self._buffer[self._position:self._position + 1]
+
+            self._read_chunk()
+
+    def expect(self, allowed_characters):
+        """Skip whitespace and consume the next character, which must be one of allowed_characters
+
+        Parameters:
+            allowed_characters (string): The characters that are valid at this point in the document
+
+        Returns:
+            string: The character that was consumed
+        """
+
+        character = self.peek()
+        if not character or character not in allowed_characters:
+            raise ValueError('Invalid JSON, expected one of "' + allowed_characters + '" but found:', character)
+
+        self._position += 1
+        return character
+
+    def read_value(self):
+        """Skip whitespace and decode the next complete JSON value, reading more of the
+        document until the value is complete
+
+        Returns:
+            The decoded value
+        """
+
+        self.peek()
+
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._buffer, self._position)
+
+                # a number at the very end of the buffer may continue in the next chunk
+                if end < len(self._buffer) or self._eof:
+                    self._position = end
+                    return value
+
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+
+            # grow the buffer geometrically so large values are not re-parsed too many times
+            self._read_chunk(minimum_length=2 * (len(self._buffer) - self._position))
+
+    def _read_chunk(self, minimum_length=0):
+        # drop the part of the buffer that has already been consumed
+        pieces = [self._buffer[self._position:]]
+        length = len(pieces[0])
+        self._position = 0
+
+        while not self._eof:
+            chunk = next(self._chunks, None)
+
+            if chunk is None:
+                self._eof = True
+                pieces.append(self._text_decoder.decode(b'', final=True))
+            else:
+                pieces.append(self._text_decoder.decode(chunk))
+
+            length += len(pieces[-1])
+            if length > minimum_length:
+                break
+
+        self._buffer = ''.join(pieces)
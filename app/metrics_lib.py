@@ -0,0 +1,373 @@
+"""Counters, gauges, histograms and summaries reported in the Prometheus text format"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import bisect
+import collections
+import math
+import threading
+from . import file_cache_lib
+
+# the content type of the text returned by render_metrics()
+content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+# upper bounds, in seconds, of the buckets of the pipeline step and request duration histograms
+_duration_buckets = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400)
+
+# the quantiles reported for the latency of spectr batch requests, over the most recent requests
+_latency_quantiles = (0.5, 0.9, 0.99)
+_latency_window_size = 1024
+
+# all metrics, in the order they were created
+_metrics = []
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        """Create a Counter object, a value per set of label values that only goes up. A method
+        may be set that is called for the values each time the metrics are rendered, for values
+        counted elsewhere.
+
+        Parameters:
+            name (string): The metric name
+            help_text (string): A description of the metric
+            label_names (tuple): The names of the labels, in the order their values are given
+
+        Returns:
+            Populated Counter object
+        """
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._function = None
+
+        # an unlabelled value is reported as zero until it is first changed
+        self._values = {} if len(self.label_names) > 0 else {(): 0}
+
+        _metrics.append(self)
+
+    def inc(self, amount=1, *label_values):
+        """Add to the value for the given label values
+
+        Parameters:
+            amount (float): The amount to add
+            label_values: The values of the labels
+
+        Returns:
+            NoneType
+        """
+
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def set_function(self, function):
+        """Set the method called for the values of this metric each time the metrics are rendered
+
+        Parameters:
+            function (function): Takes no arguments and returns a dict of label values tuple -> value
+
+        Returns:
+            NoneType
+        """
+
+        self._function = function
+
+    def get_samples(self):
+        if self._function is not None:
+            return [(self.name, label_values, (), value) for label_values, value in self._function().items()]
+
+        with self._lock:
+            return [(self.name, label_values, (), value) for label_values, value in self._values.items()]
+
+    def get_type(self):
+        return 'counter'
+
+
+class Gauge(Counter):
+    """A value per set of label values that may go up and down"""
+
+    def dec(self, amount=1, *label_values):
+        """Subtract from the value for the given label values
+
+        Parameters:
+            amount (float): The amount to subtract
+            label_values: The values of the labels
+
+        Returns:
+            NoneType
+        """
+
+        self.inc(-amount, *label_values)
+
+    def get_type(self):
+        return 'gauge'
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets, label_names=()):
+        """Create a Histogram object, which counts observed values in buckets of increasing
+        upper bounds, per set of label values
+
+        Parameters:
+            name (string): The metric name
+            help_text (string): A description of the metric
+            buckets (tuple): The upper bounds of the buckets, in increasing order
+            label_names (tuple): The names of the labels, in the order their values are given
+
+        Returns:
+            Populated Histogram object
+        """
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._buckets = tuple(buckets)
+        self._lock = threading.Lock()
+
+        # label values -> [bucket counts, sum of observed values]
+        self._values = {}
+
+        _metrics.append(self)
+
+    def observe(self, value, *label_values):
+        """Count a value in the buckets for the given label values
+
+        Parameters:
+            value (float): The observed value
+            label_values: The values of the labels
+
+        Returns:
+            NoneType
+        """
+
+        bucket_index = bisect.bisect_left(self._buckets, value)
+
+        with self._lock:
+            if label_values not in self._values:
+                self._values[label_values] = [[0] * (len(self._buckets) + 1), 0.0]
+
+            values = self._values[label_values]
+            values[0][bucket_index] += 1
+            values[1] += value
+
+    def get_samples(self):
+        samples = []
+
+        with self._lock:
+            for label_values, (bucket_counts, value_sum) in self._values.items():
+                cumulative_count = 0
+
+                for upper_bound, bucket_count in zip(self._buckets + (math.inf,), bucket_counts):
+                    cumulative_count += bucket_count
+                    samples.append((self.name + '_bucket', label_values, (('le', upper_bound),), cumulative_count))
+
+                samples.append((self.name + '_sum', label_values, (), value_sum))
+                samples.append((self.name + '_count', label_values, (), cumulative_count))
+
+        return samples
+
+    def get_type(self):
+        return 'histogram'
+
+
+class Summary:
+    def __init__(self, name, help_text, quantiles, window_size, label_names=()):
+        """Create a Summary object, which reports quantiles of the most recently observed values,
+        and the count and sum of all observed values, per set of label values
+
+        Parameters:
+            name (string): The metric name
+            help_text (string): A description of the metric
+            quantiles (tuple): The quantiles to report, e.g., 0.5 for the median
+            window_size (int): The number of most recent values the quantiles are taken from
+            label_names (tuple): The names of the labels, in the order their values are given
+
+        Returns:
+            Populated Summary object
+        """
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._quantiles = tuple(quantiles)
+        self._window_size = window_size
+        self._lock = threading.Lock()
+
+        # label values -> [recent values, count of observed values, sum of observed values]
+        self._values = {}
+
+        _metrics.append(self)
+
+    def observe(self, value, *label_values):
+        """Record a value for the given label values
+
+        Parameters:
+            value (float): The observed value
+            label_values: The values of the labels
+
+        Returns:
+            NoneType
+        """
+
+        with self._lock:
+            if label_values not in self._values:
+                self._values[label_values] = [collections.deque(maxlen=self._window_size), 0, 0.0]
+
+            values = self._values[label_values]
+            values[0].append(value)
+            values[1] += 1
+            values[2] += value
+
+    def get_samples(self):
+        samples = []
+
+        with self._lock:
+            values = [(label_values, sorted(recent_values), count, value_sum)
+                      for label_values, (recent_values, count, value_sum) in self._values.items()]
+
+        # sort outside the lock, so observations are not held up by rendering
+        for label_values, recent_values, count, value_sum in values:
+            for quantile in self._quantiles:
+                # nearest rank
+                index = max(0, math.ceil(quantile * len(recent_values)) - 1)
+                samples.append((self.name, label_values, (('quantile', quantile),), recent_values[index]))
+
+            samples.append((self.name + '_sum', label_values, (), value_sum))
+            samples.append((self.name + '_count', label_values, (), count))
+
+        return samples
+
+    def get_type(self):
+        return 'summary'
+
+
+def render_metrics():
+    """Render all metrics in the Prometheus text format
+
+    Returns:
+        string
+    """
+
+    lines = []
+
+    for metric in _metrics:
+        lines.append('# HELP ' + metric.name + ' ' + metric.help_text)
+        lines.append('# TYPE ' + metric.name + ' ' + metric.get_type())
+
+        for name, label_values, extra_labels, value in metric.get_samples():
+            labels = list(zip(metric.label_names, label_values)) + list(extra_labels)
+
+            if len(labels) > 0:
+                name += '{' + ','.join(key + '="' + _format_label_value(label_value) + '"'
+                                       for key, label_value in labels) + '}'
+
+            lines.append(name + ' ' + _format_value(value))
+
+    return '\n'.join(lines) + '\n'
+
+
+def _format_label_value(value):
+    if isinstance(value, float):
+        return _format_value(value)
+
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _get_file_cache_samples(get_stat):
+    samples = {}
+
+    for cache_name, cache in (('spectral_file', file_cache_lib.get_spectral_file_cache()),
+                              ('hardklor_results', file_cache_lib.get_hardklor_results_cache())):
+        if cache is not None:
+            samples[(cache_name,)] = get_stat(cache.get_stats())
+
+    return samples
+
+
+pipeline_step_duration_seconds = Histogram(
+    'pipeline_step_duration_seconds',
+    'Time taken by each step of the pipeline, including steps skipped because an earlier run completed them.',
+    _duration_buckets,
+    ('step',)
+)
+
+request_duration_seconds = Histogram(
+    'request_duration_seconds',
+    'Time taken to process each request, by outcome.',
+    _duration_buckets,
+    ('status',)
+)
+
+spectr_fetched_bytes_total = Counter(
+    'spectr_fetched_bytes_total',
+    'Bytes of scan data read from spectr.'
+)
+
+spectr_fetched_scans_total = Counter(
+    'spectr_fetched_scans_total',
+    'Scans read from spectr, including scans without peaks that are not written.'
+)
+
+spectr_batch_latency_seconds = Summary(
+    'spectr_batch_latency_seconds',
+    'Time from sending a batch request for scan data to spectr until its response starts, over recent requests.',
+    _latency_quantiles,
+    _latency_window_size
+)
+
+request_queue_depth = Gauge(
+    'request_queue_depth',
+    'Requests waiting to be processed.'
+)
+
+active_request_workers = Gauge(
+    'active_request_workers',
+    'Request workers that are processing a request.'
+)
+
+file_cache_hits_total = Counter(
+    'file_cache_hits_total',
+    'Lookups that found the files in the cache.',
+    ('cache',)
+)
+file_cache_hits_total.set_function(lambda: _get_file_cache_samples(lambda stats: stats['hits']))
+
+file_cache_misses_total = Counter(
+    'file_cache_misses_total',
+    'Lookups that did not find the files in the cache.',
+    ('cache',)
+)
+file_cache_misses_total.set_function(lambda: _get_file_cache_samples(lambda stats: stats['misses']))
+
+file_cache_hit_ratio = Gauge(
+    'file_cache_hit_ratio',
+    'Fraction of lookups that found the files in the cache since the service started.',
+    ('cache',)
+)
+file_cache_hit_ratio.set_function(lambda: _get_file_cache_samples(
+    lambda stats: stats['hit_rate'] if stats['hit_rate'] is not None else 0.0))
+
+file_cache_bytes = Gauge(
+    'file_cache_bytes',
+    'Total size of the files in the cache.',
+    ('cache',)
+)
+file_cache_bytes.set_function(lambda: _get_file_cache_samples(lambda stats: stats['bytes']))
@@ -14,7 +14,8 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-from . import spectr_utils, __spectr_batch_size_env_key__, __ms1_file__
+from . import pipeline_utils, peak_format_utils, checkpoint_lib, trace_lib, ms_binary_lib, ms_file_utils,\
+    __spectr_batch_size_env_key__
 from datetime import datetime
 import os
 
@@ -31,7 +32,7 @@ def create_ms1_file(spectr_file_id, ms1_scan_numbers, workdir):
         None
     """
 
-    ms1_file_name = __ms1_file__
+    ms1_file_name = ms_file_utils.get_ms1_file_name()
 
     scan_count_per_call = os.getenv(__spectr_batch_size_env_key__)
     if scan_count_per_call is None:
@@ -41,31 +42,53 @@ def create_ms1_file(spectr_file_id, ms1_scan_numbers, workdir):
 
     scan_sets = [ms1_scan_numbers[i:i + scan_count_per_call] for i in range(0, len(ms1_scan_numbers), scan_count_per_call)]
 
-    ms1_file = initialize_ms1_file(workdir, ms1_file_name)
+    peak_line_format = peak_format_utils.get_peak_line_format()
+
+    # resume an interrupted export after the last scan set it completely wrote
+    progress = checkpoint_lib.get_export_progress(workdir, [ms1_file_name], scan_sets, peak_line_format)
+
+    if progress is None:
+        scan_sets_done = 0
+        ms1_file = initialize_ms1_file(workdir, ms1_file_name)
+    else:
+        scan_sets_done = progress['scan_sets']
+        print('Resuming MS1 export after', scan_sets_done, 'of', len(scan_sets), 'scan sets')
+        ms1_file = reopen_ms1_file(workdir, ms1_file_name, progress['bytes'][ms1_file_name])
+
+    pipeline = pipeline_utils.ScanFetchPipeline(
+        spectr_file_id,
+        scan_sets[scan_sets_done:],
+        checkpoint_lib.get_export_progress_saver(workdir, [ms1_file_name], [ms1_file], scan_sets,
+                                                 peak_line_format, scan_sets_done),
+        trace_lib.get_request_trace(workdir)
+    )
 
     try:
-        for scan_array in scan_sets:
-            scan_data = spectr_utils.get_scan_data_for_scan_numbers(spectr_file_id, scan_array)
-
-            for ms2_scan in scan_data:
-                write_scan_to_ms1_file(
-                    ms1_file,
-                    ms2_scan.scan_number,
-                    ms2_scan.retention_time_seconds,
-                    ms2_scan.peak_list_mz,
-                    ms2_scan.peak_list_intensity
-                )
+        for ms2_scan in pipeline:
+            write_scan_to_ms1_file(
+                ms1_file,
+                ms2_scan.scan_number,
+                ms2_scan.retention_time_seconds,
+                ms2_scan.peak_list_mz,
+                ms2_scan.peak_list_intensity,
+                peak_line_format
+            )
 
     finally:
         close_ms1_file(ms1_file)
 
+    checkpoint_lib.remove_export_progress(workdir, [ms1_file_name])
+
+    print('MS1 export pipeline stats:', pipeline.get_stats())
+
 
 def write_scan_to_ms1_file(
         ms1_file,
         scan_number,
         retention_time_seconds,
         peak_list_mz,
-        peak_list_intensity
+        peak_list_intensity,
+        peak_line_format=peak_format_utils.full_precision_peak_line_format
 ):
     """Write the supplied scan data to the ms1_file
 
@@ -81,21 +104,27 @@ def write_scan_to_ms1_file(
         403.9708 2495.277
 
     Parameters:
-        ms1_file (filehandle): ms1 file we are writing to
+        ms1_file (filehandle): ms1 file we are writing to, or a ms_binary_lib.BinaryMsFile
         scan_number (int): Scan number of the scan
         retention_time_seconds (float): Retention time in seconds
-        peak_list_mz (list): array of m/z values from scan
-        peak_list_intensity (list): array of intensities corresponding to m/z array
+        peak_list_mz (array): array of m/z values from scan
+        peak_list_intensity (array): array of intensities corresponding to m/z array
+        peak_line_format (string): Format for a single peak line, see peak_format_utils.get_peak_line_format()
 
     Returns:
         NoneType
     """
 
-    ms1_file.write("S\t" + str(scan_number) + "\t" + str(scan_number) + "\n")
-    ms1_file.write("I\tRTime\t" + str(retention_time_seconds / 60) + "\n")  # write retention time in minutes
+    if isinstance(ms1_file, ms_binary_lib.BinaryMsFile):
+        ms1_file.write_scan(scan_number, retention_time_seconds, peak_list_mz, peak_list_intensity)
+        return
 
-    for mz, intensity in zip(peak_list_mz, peak_list_intensity):
-        ms1_file.write(str(mz) + " " + str(intensity) + "\n")
+    # write the whole scan with a single call
+    ms1_file.write(
+        "S\t" + str(scan_number) + "\t" + str(scan_number) + "\n" +
+        "I\tRTime\t" + str(retention_time_seconds / 60) + "\n" +  # write retention time in minutes
+        peak_format_utils.format_peak_block(peak_list_mz, peak_list_intensity, peak_line_format)
+    )
 
 
 def close_ms1_file(ms1_file):
@@ -109,20 +138,45 @@ def close_ms1_file(ms1_file):
 
 def initialize_ms1_file(path_to_directory, filename):
     """Create a file at path_to_directory, filename and write header (H) lines
-    to it.
+    to it. Binary and compressed files are created for .bms1 and .cms1 file names.
 
     Returns:
-        io.TextIOWrapper: File handle to the created file for subsequent writes of scan data
+        io.TextIOWrapper: File handle to the created file for subsequent writes of scan data,
+                          or a ms_binary_lib.BinaryMsFile
     """
+    header_lines = [
+        ('CreationDate', datetime.now().strftime("%Y%m%d")),
+        ('Extractor', 'Limelight Spectr to MS1'),
+        ('Comments', 'See: https://github.com/yeastrc/limelight-pipeline-feature-detection-service')
+    ]
+
+    if ms_binary_lib.is_binary_file_name(filename):
+        return ms_binary_lib.BinaryMsFile(path_to_directory, filename, header_lines)
+
     ms1_file = open(os.path.join(path_to_directory, filename), 'w')
 
-    write_header_to_ms1_file(ms1_file, 'CreationDate', datetime.now().strftime("%Y%m%d"))
-    write_header_to_ms1_file(ms1_file, 'Extractor', 'Limelight Spectr to MS1')
-    write_header_to_ms1_file(ms1_file, 'Comments', 'See: https://github.com/yeastrc/limelight-pipeline-feature-detection-service')
+    for header_key, header_value in header_lines:
+        write_header_to_ms1_file(ms1_file, header_key, header_value)
 
     return ms1_file
 
 
+def reopen_ms1_file(path_to_directory, filename, size):
+    """Open an existing file at path_to_directory, filename to add more scans to, after cutting
+    it to size. Used to resume an interrupted export.
+
+    Returns:
+        io.TextIOWrapper: File handle to the file for subsequent writes of scan data,
+                          or a ms_binary_lib.BinaryMsFile
+    """
+    if ms_binary_lib.is_binary_file_name(filename):
+        return ms_binary_lib.BinaryMsFile(path_to_directory, filename, [], resume_size=size)
+
+    os.truncate(os.path.join(path_to_directory, filename), size)
+
+    return open(os.path.join(path_to_directory, filename), 'a')
+
+
 def write_header_to_ms1_file(ms1_file, header_key, header_value):
     """Append the supplied key/value pair as a header to the supplied file
     handle
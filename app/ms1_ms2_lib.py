@@ -0,0 +1,108 @@
+"""Methods for writing .ms1 and .ms2 files together in a single pass over spectr"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from . import pipeline_utils, ms1_lib, ms2_lib, checkpoint_lib, trace_lib, peak_format_utils, ms_file_utils,\
+    __spectr_batch_size_env_key__
+import os
+
+
+def create_ms1_and_ms2_files(spectr_file_id, scan_numbers, workdir):
+    """Create the MS1 and MS2 files from a spectr file id with one fetch pipeline. Each scan
+    is written to the MS1 or MS2 file according to its scan level, scans of any other level
+    are ignored.
+
+    Parameters:
+        spectr_file_id (string): A spectr file id
+        scan_numbers (list): Array of all MS1 and MS2 scan numbers to include
+        workdir (string): Full path to the working directory
+
+    Returns:
+        None
+    """
+
+    scan_count_per_call = os.getenv(__spectr_batch_size_env_key__)
+    if scan_count_per_call is None:
+        raise ValueError('Missing environmental variable:', __spectr_batch_size_env_key__)
+
+    scan_count_per_call = int(scan_count_per_call)
+
+    # write both files in scan order
+    scan_numbers = sorted(scan_numbers)
+
+    scan_sets = [scan_numbers[i:i + scan_count_per_call] for i in range(0, len(scan_numbers), scan_count_per_call)]
+
+    peak_line_format = peak_format_utils.get_peak_line_format()
+
+    filenames = [ms_file_utils.get_ms1_file_name(), ms_file_utils.get_ms2_file_name()]
+
+    # resume an interrupted export after the last scan set it completely wrote to both files
+    progress = checkpoint_lib.get_export_progress(workdir, filenames, scan_sets, peak_line_format)
+
+    if progress is None:
+        scan_sets_done = 0
+        ms1_file = ms1_lib.initialize_ms1_file(workdir, filenames[0])
+    else:
+        scan_sets_done = progress['scan_sets']
+        print('Resuming MS1 and MS2 export after', scan_sets_done, 'of', len(scan_sets), 'scan sets')
+        ms1_file = ms1_lib.reopen_ms1_file(workdir, filenames[0], progress['bytes'][filenames[0]])
+
+    try:
+        if progress is None:
+            ms2_file = ms2_lib.initialize_ms2_file(workdir, filenames[1])
+        else:
+            ms2_file = ms2_lib.reopen_ms2_file(workdir, filenames[1], progress['bytes'][filenames[1]])
+
+        pipeline = pipeline_utils.ScanFetchPipeline(
+            spectr_file_id,
+            scan_sets[scan_sets_done:],
+            checkpoint_lib.get_export_progress_saver(workdir, filenames, [ms1_file, ms2_file], scan_sets,
+                                                     peak_line_format, scan_sets_done),
+            trace_lib.get_request_trace(workdir)
+        )
+
+        try:
+            for scan in pipeline:
+                if scan.msn_level == 1:
+                    ms1_lib.write_scan_to_ms1_file(
+                        ms1_file,
+                        scan.scan_number,
+                        scan.retention_time_seconds,
+                        scan.peak_list_mz,
+                        scan.peak_list_intensity,
+                        peak_line_format
+                    )
+
+                elif scan.msn_level == 2:
+                    ms2_lib.write_scan_to_ms2_file(
+                        ms2_file,
+                        scan.scan_number,
+                        scan.precursor_mz,
+                        scan.precursor_charge,
+                        scan.retention_time_seconds,
+                        scan.peak_list_mz,
+                        scan.peak_list_intensity,
+                        peak_line_format
+                    )
+
+        finally:
+            ms2_lib.close_ms2_file(ms2_file)
+
+    finally:
+        ms1_lib.close_ms1_file(ms1_file)
+
+    checkpoint_lib.remove_export_progress(workdir, filenames)
+
+    print('MS1 and MS2 export pipeline stats:', pipeline.get_stats())
@@ -14,7 +14,8 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-from . import spectr_utils, mass_utils, __spectr_batch_size_env_key__, __ms2_file__
+from . import pipeline_utils, peak_format_utils, checkpoint_lib, trace_lib, mass_utils, ms_binary_lib, ms_file_utils,\
+    __spectr_batch_size_env_key__
 from datetime import datetime
 import os
 
@@ -31,7 +32,7 @@ def create_ms2_file(spectr_file_id, ms2_scan_numbers, workdir):
         None
     """
 
-    ms2_file_name = __ms2_file__
+    ms2_file_name = ms_file_utils.get_ms2_file_name()
 
     scan_count_per_call = os.getenv(__spectr_batch_size_env_key__)
     if scan_count_per_call is None:
@@ -41,26 +42,47 @@ def create_ms2_file(spectr_file_id, ms2_scan_numbers, workdir):
 
     scan_sets = [ms2_scan_numbers[i:i + scan_count_per_call] for i in range(0, len(ms2_scan_numbers), scan_count_per_call)]
 
-    ms2_file = initialize_ms2_file(workdir, ms2_file_name)
+    peak_line_format = peak_format_utils.get_peak_line_format()
+
+    # resume an interrupted export after the last scan set it completely wrote
+    progress = checkpoint_lib.get_export_progress(workdir, [ms2_file_name], scan_sets, peak_line_format)
+
+    if progress is None:
+        scan_sets_done = 0
+        ms2_file = initialize_ms2_file(workdir, ms2_file_name)
+    else:
+        scan_sets_done = progress['scan_sets']
+        print('Resuming MS2 export after', scan_sets_done, 'of', len(scan_sets), 'scan sets')
+        ms2_file = reopen_ms2_file(workdir, ms2_file_name, progress['bytes'][ms2_file_name])
+
+    pipeline = pipeline_utils.ScanFetchPipeline(
+        spectr_file_id,
+        scan_sets[scan_sets_done:],
+        checkpoint_lib.get_export_progress_saver(workdir, [ms2_file_name], [ms2_file], scan_sets,
+                                                 peak_line_format, scan_sets_done),
+        trace_lib.get_request_trace(workdir)
+    )
 
     try:
-        for scan_array in scan_sets:
-            scan_data = spectr_utils.get_scan_data_for_scan_numbers(spectr_file_id, scan_array)
-
-            for ms2_scan in scan_data:
-                write_scan_to_ms2_file(
-                    ms2_file,
-                    ms2_scan.scan_number,
-                    ms2_scan.precursor_mz,
-                    ms2_scan.precursor_charge,
-                    ms2_scan.retention_time_seconds,
-                    ms2_scan.peak_list_mz,
-                    ms2_scan.peak_list_intensity
-                )
+        for ms2_scan in pipeline:
+            write_scan_to_ms2_file(
+                ms2_file,
+                ms2_scan.scan_number,
+                ms2_scan.precursor_mz,
+                ms2_scan.precursor_charge,
+                ms2_scan.retention_time_seconds,
+                ms2_scan.peak_list_mz,
+                ms2_scan.peak_list_intensity,
+                peak_line_format
+            )
 
     finally:
         close_ms2_file(ms2_file)
 
+    checkpoint_lib.remove_export_progress(workdir, [ms2_file_name])
+
+    print('MS2 export pipeline stats:', pipeline.get_stats())
+
 
 def write_scan_to_ms2_file(
         ms2_file,
@@ -69,7 +91,8 @@ def write_scan_to_ms2_file(
         charge,
         retention_time_seconds,
         peak_list_mz,
-        peak_list_intensity
+        peak_list_intensity,
+        peak_line_format=peak_format_utils.full_precision_peak_line_format
 ):
     """Write the supplied scan data to the ms2_file
 
@@ -84,13 +107,14 @@ def write_scan_to_ms2_file(
         199.1 12.2
 
     Parameters:
-        ms2_file (filehandle): ms2 file we are writing to
+        ms2_file (filehandle): ms2 file we are writing to, or a ms_binary_lib.BinaryMsFile
         scan_number (int): Scan number of the scan
         precursor_mz (float): Precursor m/z
         charge (int): Charge for this scan
         retention_time_seconds (float): Retention time in seconds
-        peak_list_mz (list): array of m/z values from scan
-        peak_list_intensity (list): array of intensities corresponding to m/z array
+        peak_list_mz (array): array of m/z values from scan
+        peak_list_intensity (array): array of intensities corresponding to m/z array
+        peak_line_format (string): Format for a single peak line, see peak_format_utils.get_peak_line_format()
 
     Returns:
         NoneType
@@ -98,12 +122,18 @@ def write_scan_to_ms2_file(
 
     neutral_mass = mass_utils.get_neutral_mass_from_mz_and_charge(precursor_mz, charge)
 
-    ms2_file.write("S\t" + str(scan_number) + "\t" + str(scan_number) + "\t" + str(precursor_mz) + "\n")
-    ms2_file.write("I\tRTime\t" + str(retention_time_seconds / 60) + "\n")  # write retention time in minutes
-    ms2_file.write("Z\t" + str(charge) + "\t" + str(neutral_mass) + "\n")
+    if isinstance(ms2_file, ms_binary_lib.BinaryMsFile):
+        ms2_file.write_scan(scan_number, retention_time_seconds, peak_list_mz, peak_list_intensity, precursor_mz,
+                            neutral_mass, charge)
+        return
 
-    for mz, intensity in zip(peak_list_mz, peak_list_intensity):
-        ms2_file.write(str(mz) + " " + str(intensity) + "\n")
+    # write the whole scan with a single call
+    ms2_file.write(
+        "S\t" + str(scan_number) + "\t" + str(scan_number) + "\t" + str(precursor_mz) + "\n" +
+        "I\tRTime\t" + str(retention_time_seconds / 60) + "\n" +  # write retention time in minutes
+        "Z\t" + str(charge) + "\t" + str(neutral_mass) + "\n" +
+        peak_format_utils.format_peak_block(peak_list_mz, peak_list_intensity, peak_line_format)
+    )
 
 
 def close_ms2_file(ms2_file):
@@ -117,20 +147,45 @@ def close_ms2_file(ms2_file):
 
 def initialize_ms2_file(path_to_directory, filename):
     """Create a file at path_to_directory, filename and write header (H) lines
-    to it.
+    to it. Binary and compressed files are created for .bms2 and .cms2 file names.
 
     Returns:
-        io.TextIOWrapper: File handle to the created file for subsequent writes of scan data
+        io.TextIOWrapper: File handle to the created file for subsequent writes of scan data,
+                          or a ms_binary_lib.BinaryMsFile
     """
+    header_lines = [
+        ('CreationDate', datetime.now().strftime("%Y%m%d")),
+        ('Extractor', 'Limelight Spectr to MS2'),
+        ('Comments', 'See: https://github.com/yeastrc/limelight-pipeline-feature-detection-service')
+    ]
+
+    if ms_binary_lib.is_binary_file_name(filename):
+        return ms_binary_lib.BinaryMsFile(path_to_directory, filename, header_lines)
+
     ms2_file = open(os.path.join(path_to_directory, filename), 'w')
 
-    write_header_to_ms2_file(ms2_file, 'CreationDate', datetime.now().strftime("%Y%m%d"))
-    write_header_to_ms2_file(ms2_file, 'Extractor', 'Limelight Spectr to MS2')
-    write_header_to_ms2_file(ms2_file, 'Comments', 'See: https://github.com/yeastrc/limelight-pipeline-feature-detection-service')
+    for header_key, header_value in header_lines:
+        write_header_to_ms2_file(ms2_file, header_key, header_value)
 
     return ms2_file
 
 
+def reopen_ms2_file(path_to_directory, filename, size):
+    """Open an existing file at path_to_directory, filename to add more scans to, after cutting
+    it to size. Used to resume an interrupted export.
+
+    Returns:
+        io.TextIOWrapper: File handle to the file for subsequent writes of scan data,
+                          or a ms_binary_lib.BinaryMsFile
+    """
+    if ms_binary_lib.is_binary_file_name(filename):
+        return ms_binary_lib.BinaryMsFile(path_to_directory, filename, [], resume_size=size)
+
+    os.truncate(os.path.join(path_to_directory, filename), size)
+
+    return open(os.path.join(path_to_directory, filename), 'a')
+
+
 def write_header_to_ms2_file(ms2_file, header_key, header_value):
     """Append the supplied key/value pair as a header to the supplied file
     handle
@@ -0,0 +1,253 @@
+"""Methods for reading and writing MSToolkit binary (.bms1/.bms2) and compressed (.cms1/.cms2) files"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import struct
+import zlib
+
+# the file types MSToolkit writes at the start of each file. readers go by the file extension
+_file_types = {
+    '.bms1': 1,
+    '.cms1': 2,
+    '.bms2': 3,
+    '.cms2': 4
+}
+
+# the version of the file layout written
+_file_version = 5
+
+# the file header is 16 lines of text, each padded to 128 bytes
+_header_line_count = 16
+_header_line_size = 128
+_file_header_size = 8 + _header_line_count * _header_line_size
+
+# scan number, scan number, count of precursor m/z values
+_scan_start = struct.Struct('<iii')
+
+# retention time (minutes), base peak intensity and m/z, six conversion factors, total ion current,
+# ion injection time. only the retention time is written, the rest are zero
+_scan_values = struct.Struct('<ffddddddddf')
+
+# count of charge states, count of charge states with extended data, count of peaks
+_scan_counts = struct.Struct('<iii')
+
+# charge state and its M+H mass
+_charge_state = struct.Struct('<id')
+
+# charge state, M+H mass, retention time and area, written by programs such as Bullseye
+_extended_charge_state = struct.Struct('<idff')
+
+# the lengths of the compressed m/z and intensity arrays
+_compressed_lengths = struct.Struct('<ii')
+
+
+class BinaryMsFile:
+    def __init__(self, path_to_directory, filename, header_lines, resume_size=None):
+        """Create a BinaryMsFile object, creating the file and writing its header. The file
+        type, binary or compressed and MS1 or MS2, is chosen by the extension of the file name.
+
+        Parameters:
+            path_to_directory (string): Full path to the directory to create the file in
+            filename (string): Name of the file, ending in .bms1, .bms2, .cms1 or .cms2
+            header_lines (list): (key, value) tuples, at most 16
+            resume_size (int): If set, the file already exists. It is cut to this size and scans
+                               are added after it, the header is not written
+
+        Returns:
+            Populated BinaryMsFile object
+        """
+
+        extension = os.path.splitext(filename)[1]
+        if extension not in _file_types:
+            raise ValueError('Not a binary MS1 or MS2 file name:', filename)
+
+        self._compressed = is_compressed_file_name(filename)
+
+        if resume_size is not None:
+            os.truncate(os.path.join(path_to_directory, filename), resume_size)
+            self._file = open(os.path.join(path_to_directory, filename), 'ab')
+            return
+
+        self._file = open(os.path.join(path_to_directory, filename), 'wb')
+
+        header = struct.pack('<ii', _file_types[extension], _file_version)
+        for line_number in range(_header_line_count):
+            line = b''
+            if line_number < len(header_lines):
+                key, value = header_lines[line_number]
+                line = (key + "\t" + value + "\n").encode('ISO-8859-1')[:_header_line_size - 1]
+
+            header += line.ljust(_header_line_size, b'\0')
+
+        self._file.write(header)
+
+    def write_scan(self, scan_number, retention_time_seconds, peak_list_mz, peak_list_intensity, precursor_mz=None,
+                   precursor_mass=None, charge=None):
+        """Write the supplied scan data to the file. MS1 scans have no precursor.
+
+        Parameters:
+            scan_number (int): Scan number of the scan
+            retention_time_seconds (float): Retention time in seconds
+            peak_list_mz (array): array of m/z values from scan
+            peak_list_intensity (array): array of intensities corresponding to m/z array
+            precursor_mz (float): Precursor m/z, None for MS1 scans
+            precursor_mass (float): Precursor mass written with the charge, as on the Z line of a .ms2 file
+            charge (int): Charge for this scan
+
+        Returns:
+            NoneType
+        """
+
+        peak_count = len(peak_list_mz)
+        precursor_mzs = () if precursor_mz is None else (precursor_mz,)
+        charge_states = () if precursor_mz is None else ((charge or 0, precursor_mass),)
+
+        parts = [
+            _scan_start.pack(scan_number, scan_number, len(precursor_mzs)),
+            struct.pack('<%dd' % len(precursor_mzs), *precursor_mzs),
+            # write retention time in minutes
+            _scan_values.pack(retention_time_seconds / 60, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0),
+            _scan_counts.pack(len(charge_states), 0, peak_count)
+        ]
+
+        parts.extend(_charge_state.pack(*charge_state) for charge_state in charge_states)
+
+        if self._compressed:
+            compressed_mz = zlib.compress(struct.pack('<%dd' % peak_count, *peak_list_mz))
+            compressed_intensity = zlib.compress(struct.pack('<%df' % peak_count, *peak_list_intensity))
+
+            parts.append(_compressed_lengths.pack(len(compressed_mz), len(compressed_intensity)))
+            parts.append(compressed_mz)
+            parts.append(compressed_intensity)
+
+        else:
+            peaks = [value for peak in zip(peak_list_mz, peak_list_intensity) for value in peak]
+            parts.append(struct.pack('<' + 'df' * peak_count, *peaks))
+
+        # write the whole scan with a single call
+        self._file.write(b''.join(parts))
+
+    def flush(self):
+        """Write any buffered scans to the file
+
+        Returns:
+            NoneType
+        """
+
+        self._file.flush()
+
+    def fileno(self):
+        """Get the file descriptor of the file
+
+        Returns:
+            int
+        """
+
+        return self._file.fileno()
+
+    def close(self):
+        """Close the file
+
+        Returns:
+            NoneType
+        """
+
+        self._file.close()
+
+
+def is_binary_file_name(filename):
+    """Whether a file name is that of a binary or compressed MS1 or MS2 file
+
+    Parameters:
+        filename (string): The file name
+
+    Returns:
+        bool
+    """
+
+    return os.path.splitext(filename)[1] in _file_types
+
+
+def is_compressed_file_name(filename):
+    """Whether a file name is that of a compressed MS1 or MS2 file
+
+    Parameters:
+        filename (string): The file name
+
+    Returns:
+        bool
+    """
+
+    return os.path.splitext(filename)[1] in ('.cms1', '.cms2')
+
+
+def read_binary_ms_file(file_path):
+    """Read the header and scans of a binary or compressed MS1 or MS2 file, without decoding
+    the peaks
+
+    Parameters:
+        file_path (string): Full path to the file
+
+    Returns:
+        generator: The file header as bytes, then a (scan number, precursor m/z, bytes of the
+                   scan) tuple for each scan. The precursor m/z is 0 for MS1 scans.
+    """
+
+    with open(file_path, 'rb') as ms_file:
+        header = ms_file.read(_file_header_size)
+        if len(header) < _file_header_size:
+            raise ValueError('Not a binary MS1 or MS2 file:', file_path)
+
+        compressed = is_compressed_file_name(file_path)
+        yield header
+
+        while True:
+            scan_start = ms_file.read(_scan_start.size)
+            if len(scan_start) < 1:
+                return
+
+            scan_number, _, precursor_mz_count = _scan_start.unpack(scan_start)
+
+            precursor_mzs = _read_exactly(ms_file, 8 * precursor_mz_count, file_path)
+            scan_values = _read_exactly(ms_file, _scan_values.size, file_path)
+            scan_counts = _read_exactly(ms_file, _scan_counts.size, file_path)
+            charge_state_count, extended_charge_state_count, peak_count = _scan_counts.unpack(scan_counts)
+
+            charge_states = _read_exactly(
+                ms_file,
+                _charge_state.size * charge_state_count + _extended_charge_state.size * extended_charge_state_count,
+                file_path
+            )
+
+            if compressed:
+                compressed_lengths = _read_exactly(ms_file, _compressed_lengths.size, file_path)
+                peaks = compressed_lengths + _read_exactly(ms_file, sum(_compressed_lengths.unpack(compressed_lengths)),
+                                                           file_path)
+            else:
+                peaks = _read_exactly(ms_file, 12 * peak_count, file_path)
+
+            precursor_mz = struct.unpack_from('<d', precursor_mzs)[0] if precursor_mz_count > 0 else 0.0
+
+            yield scan_number, precursor_mz, b''.join(
+                (scan_start, precursor_mzs, scan_values, scan_counts, charge_states, peaks))
+
+
+def _read_exactly(ms_file, size, file_path):
+    data = ms_file.read(size)
+    if len(data) < size:
+        raise ValueError('Unexpected end of binary MS1 or MS2 file:', file_path)
+
+    return data
@@ -0,0 +1,112 @@
+"""Utility methods for the MS1 and MS2 files, in the format set for this deployment"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+from . import ms_binary_lib, __ms1_file__, __ms2_file__, __ms_file_format_env_key__
+
+# the extensions of the MS1 and MS2 files for each format
+_file_extensions = {
+    'text': ('.ms1', '.ms2'),
+    'binary': ('.bms1', '.bms2'),
+    'compressed': ('.cms1', '.cms2')
+}
+
+
+def get_ms_file_format():
+    """Determine the format to write the ms1 and ms2 files in. Uses the environmental variable,
+    which may be 'text' (.ms1 and .ms2), 'binary' (.bms1 and .bms2) or 'compressed' (.cms1 and
+    .cms2). Defaults to 'text' if not set.
+
+    Returns:
+        string
+    """
+
+    ms_file_format = os.getenv(__ms_file_format_env_key__)
+
+    if ms_file_format is None or not ms_file_format:
+        return 'text'
+
+    if ms_file_format in _file_extensions:
+        return ms_file_format
+
+    raise ValueError('Got unknown value for env var:', __ms_file_format_env_key__)
+
+
+def get_ms1_file_name():
+    """Get the name of the ms1 file in the workdir, e.g., scans.ms1 or scans.cms1
+
+    Returns:
+        string
+    """
+
+    return os.path.splitext(__ms1_file__)[0] + _file_extensions[get_ms_file_format()][0]
+
+
+def get_ms2_file_name():
+    """Get the name of the ms2 file in the workdir, e.g., scans.ms2 or scans.cms2
+
+    Returns:
+        string
+    """
+
+    return os.path.splitext(__ms2_file__)[0] + _file_extensions[get_ms_file_format()][1]
+
+
+def read_ms_file(file_path):
+    """Read the header and scans of a MS1 or MS2 file in any format, without decoding the peaks
+
+    Parameters:
+        file_path (string): Full path to the file
+
+    Returns:
+        generator: The file header as bytes, then a (scan number, precursor m/z, bytes of the
+                   scan) tuple for each scan. The precursor m/z is 0 for MS1 scans. Writing
+                   the header and any of the scans in order makes a valid file of the same format.
+    """
+
+    if ms_binary_lib.is_binary_file_name(file_path):
+        return ms_binary_lib.read_binary_ms_file(file_path)
+
+    return _read_text_ms_file(file_path)
+
+
+def _read_text_ms_file(file_path):
+    with open(file_path, 'rb') as ms_file:
+        header = []
+        scan = None
+
+        for line in ms_file:
+            if line.startswith(b'S\t'):
+                if scan is None:
+                    yield b''.join(header)
+                else:
+                    yield scan[0], scan[1], b''.join(scan[2])
+
+                # S <scan number> <scan number> <precursor m/z, ms2 only>
+                fields = line.split(b'\t')
+                precursor_mz = float(fields[3]) if len(fields) > 3 else 0.0
+                scan = (int(fields[1]), precursor_mz, [line])
+
+            elif scan is None:
+                header.append(line)
+
+            else:
+                scan[2].append(line)
+
+        if scan is None:
+            yield b''.join(header)
+        else:
+            yield scan[0], scan[1], b''.join(scan[2])
@@ -0,0 +1,77 @@
+"""Methods for formatting peak lists for .ms1 and .ms2 files"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+from . import __ms_file_mz_decimal_places_env_key__, __ms_file_intensity_decimal_places_env_key__
+
+# writes each value exactly as str() would, i.e. the full precision of the value
+full_precision_peak_line_format = '%r %r\n'
+
+
+def get_peak_line_format():
+    """Get the %-format string used to write a single peak line, using the number of decimal
+    places for m/z and intensity set in the environment. Values with no decimal places set
+    are written at full precision.
+
+    Returns:
+        string: A format string that takes a (mz, intensity) tuple
+    """
+
+    mz_format = get_value_format(__ms_file_mz_decimal_places_env_key__)
+    intensity_format = get_value_format(__ms_file_intensity_decimal_places_env_key__)
+
+    return mz_format + ' ' + intensity_format + '\n'
+
+
+def get_value_format(env_key):
+    """Get the %-format for a single value using the number of decimal places in the given
+    environmental variable
+
+    Parameters:
+        env_key (string): The environmental variable holding the number of decimal places
+
+    Returns:
+        string
+    """
+
+    decimal_places = os.getenv(env_key)
+    if decimal_places is None or not decimal_places:
+        return '%r'
+
+    if not decimal_places.isdigit():
+        raise ValueError('Expected a non-negative integer for env var:', env_key, decimal_places)
+
+    return '%.' + decimal_places + 'f'
+
+
+def format_peak_block(peak_list_mz, peak_list_intensity, peak_line_format=full_precision_peak_line_format):
+    """Render all the peak lines of a scan as a single string
+
+    Example peak block:
+        400.8635 3028.679
+        402.8361 4437.194
+        402.8603 4638.426
+
+    Parameters:
+        peak_list_mz (array): array of m/z values from scan
+        peak_list_intensity (array): array of intensities corresponding to m/z array
+        peak_line_format (string): Format for a single (mz, intensity) line, see get_peak_line_format()
+
+    Returns:
+        string
+    """
+
+    return ''.join(map(peak_line_format.__mod__, zip(peak_list_mz, peak_list_intensity)))
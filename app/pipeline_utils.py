@@ -0,0 +1,397 @@
+"""Staged pipeline for fetching, parsing and writing scans from spectr at the same time"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from . import spectr_utils, general_utils, __spectr_scan_queue_size_env_key__, __spectr_scan_queue_size_default__
+
+# how long (in seconds) a blocked stage waits before checking whether the pipeline was stopped
+_stop_check_interval = 0.1
+
+# marks the end of the items passed between stages
+_end_of_stream = object()
+
+
+class ScanFetchPipeline:
+    def __init__(self, spectr_file_id, scan_sets, scan_set_done_callback=None, trace=None):
+        """Create a ScanFetchPipeline object. Iterating over it runs three stages at the same time:
+
+            fetch:  sends the batch requests to spectr, several in flight at a time
+            decode: parses each response as it streams in, in the order of scan_sets
+            write:  the caller, which receives the parsed scans one at a time
+
+        The stages are connected by bounded queues, so a slow stage makes the stages before it
+        wait rather than letting memory grow.
+
+        Parameters:
+            spectr_file_id (string): A spectr file id
+            scan_sets (list): A list of lists of scan numbers, one list per request to spectr
+            scan_set_done_callback (function): Called in the write stage with the number of scan
+                                               sets done, once the caller has received every scan
+                                               of a scan set and asked for the next, may be None
+            trace (trace_lib.RequestTrace): Records the latency, size, decode time and write time of
+                                            each batch request to spectr, may be None
+
+        Returns:
+            Populated ScanFetchPipeline object
+        """
+        self._spectr_file_id = spectr_file_id
+        self._scan_sets = scan_sets
+        self._scan_set_done_callback = scan_set_done_callback
+        self._trace = trace
+        self._write_seconds = 0.0
+        self._max_concurrent_requests = spectr_utils.get_max_concurrent_requests()
+        self._stop_event = threading.Event()
+
+        self._response_queue = StageQueue(self._max_concurrent_requests)
+        self._scan_queue = StageQueue(get_scan_queue_size())
+
+    def __iter__(self):
+        executor = ThreadPoolExecutor(max_workers=self._max_concurrent_requests, thread_name_prefix='spectr-fetch')
+        fetch_thread = threading.Thread(target=self._run_fetch_stage, args=(executor,), name='spectr-fetch-stage')
+        decode_thread = threading.Thread(target=self._run_decode_stage, name='spectr-decode-stage')
+
+        fetch_thread.start()
+        decode_thread.start()
+
+        scan_sets_done = 0
+        scan_set_write_seconds = 0.0
+
+        try:
+            while True:
+                item = self._scan_queue.get(self._stop_event)
+
+                if item is _end_of_stream:
+                    break
+
+                if isinstance(item, _EndOfScanSet):
+                    scan_sets_done += 1
+                    if self._scan_set_done_callback is not None:
+                        self._scan_set_done_callback(scan_sets_done)
+
+                    if self._trace is not None:
+                        self._trace.record('spectr_batch', scan_set=scan_sets_done,
+                                           write_seconds=scan_set_write_seconds, **item.stats)
+
+                    self._write_seconds += scan_set_write_seconds
+                    scan_set_write_seconds = 0.0
+                    continue
+
+                if isinstance(item, _StageError):
+                    raise item.exception
+
+                # the time the caller takes to write the scan
+                start_time = time.monotonic()
+                yield item
+                scan_set_write_seconds += time.monotonic() - start_time
+
+        finally:
+            self._stop_event.set()
+
+            fetch_thread.join()
+            decode_thread.join()
+            executor.shutdown(wait=True, cancel_futures=True)
+
+            # release the connections held by responses that will not be read
+            for item in self._response_queue.drain():
+                if not item.cancelled() and item.exception() is None:
+                    item.result().close()
+
+    def get_stats(self):
+        """Get the counters for the queues between the stages of this pipeline. A stage that
+        often stalls putting items is waiting on the next stage, a stage that often stalls
+        getting items is waiting on the previous one.
+
+        Returns:
+            dict: {'fetch_to_decode': dict, 'decode_to_write': dict, 'write_seconds': float}, see
+                  StageQueue.get_stats(). write_seconds is the time the caller took to write the scans
+        """
+
+        return {
+            'fetch_to_decode': self._response_queue.get_stats(),
+            'decode_to_write': self._scan_queue.get_stats(),
+            'write_seconds': round(self._write_seconds, 3)
+        }
+
+    def _run_fetch_stage(self, executor):
+        try:
+            for scan_numbers in self._scan_sets:
+                future = executor.submit(
+                    spectr_utils.request_scan_data_for_scan_numbers,
+                    self._spectr_file_id,
+                    scan_numbers
+                )
+
+                if not self._response_queue.put(future, self._stop_event):
+                    future.cancel()
+                    if not future.cancelled() and future.exception() is None:
+                        future.result().close()
+                    return
+
+            self._response_queue.put(_end_of_stream, self._stop_event)
+
+        except Exception as e:
+            self._response_queue.put(_StageError(e), self._stop_event)
+
+    def _run_decode_stage(self):
+        try:
+            while True:
+                item = self._response_queue.get(self._stop_event)
+
+                if item is None:
+                    return
+
+                if item is _end_of_stream or isinstance(item, _StageError):
+                    self._scan_queue.put(item, self._stop_event)
+                    return
+
+                response = self._wait_for_response(item)
+
+                if response is None:
+                    return
+
+                response_stats = {}
+                start_time = time.monotonic()
+                stall_seconds = self._scan_queue.get_producer_stall_seconds()
+
+                try:
+                    for scan in spectr_utils.iterate_spectr_success(response, self._spectr_file_id, response_stats):
+                        if not self._scan_queue.put(scan, self._stop_event):
+                            return
+                finally:
+                    response.close()
+
+                # time reading and parsing the response, not waiting for the write stage to take the scans
+                decode_seconds = time.monotonic() - start_time - \
+                    (self._scan_queue.get_producer_stall_seconds() - stall_seconds)
+
+                batch_stats = {
+                    'latency_seconds': response.elapsed.total_seconds(),
+                    'bytes': response_stats['bytes'],
+                    'scans': response_stats['scans'],
+                    'decode_seconds': decode_seconds
+                }
+
+                if not self._scan_queue.put(_EndOfScanSet(batch_stats), self._stop_event):
+                    return
+
+        except Exception as e:
+            self._scan_queue.put(_StageError(e), self._stop_event)
+
+    def _wait_for_response(self, future):
+        # time spent waiting on a response that is still in flight is time decode waits on fetch
+        if future.done():
+            return future.result()
+
+        start_time = time.monotonic()
+
+        while True:
+            if self._stop_event.is_set():
+                return None
+
+            try:
+                response = future.result(timeout=_stop_check_interval)
+                break
+            except FutureTimeoutError:
+                pass
+
+        self._response_queue.add_consumer_stall(time.monotonic() - start_time)
+
+        return response
+
+
+class StageQueue:
+    def __init__(self, capacity):
+        """Create a StageQueue object, a bounded queue between two pipeline stages that counts
+        how often and for how long each side had to wait on the other
+
+        Parameters:
+            capacity (int): The maximum number of items in the queue
+
+        Returns:
+            Populated StageQueue object
+        """
+        self._queue = queue.Queue(maxsize=capacity)
+        self._capacity = capacity
+
+        # the stats are updated by the producer and the consumer and read by other threads
+        self._stats_lock = threading.Lock()
+        self._max_depth = 0
+        self._put_count = 0
+        self._put_stalls = 0
+        self._put_stall_seconds = 0.0
+        self._get_stalls = 0
+        self._get_stall_seconds = 0.0
+
+    def put(self, item, stop_event):
+        """Add an item to the queue, waiting while it is full
+
+        Parameters:
+            item: The item to add
+            stop_event (threading.Event): Stop waiting once this is set
+
+        Returns:
+            bool: True if the item was added, False if the pipeline was stopped first
+        """
+
+        try:
+            self._queue.put_nowait(item)
+
+        except queue.Full:
+            start_time = time.monotonic()
+
+            while True:
+                if stop_event.is_set():
+                    return False
+
+                try:
+                    self._queue.put(item, timeout=_stop_check_interval)
+                    break
+                except queue.Full:
+                    pass
+
+            with self._stats_lock:
+                self._put_stalls += 1
+                self._put_stall_seconds += time.monotonic() - start_time
+
+        with self._stats_lock:
+            self._put_count += 1
+            self._max_depth = max(self._max_depth, self._queue.qsize())
+
+        return True
+
+    def get(self, stop_event):
+        """Remove and return the next item in the queue, waiting while it is empty
+
+        Parameters:
+            stop_event (threading.Event): Stop waiting once this is set
+
+        Returns:
+            The next item, or None if the pipeline was stopped first
+        """
+
+        try:
+            return self._queue.get_nowait()
+
+        except queue.Empty:
+            start_time = time.monotonic()
+
+            while True:
+                if stop_event.is_set():
+                    return None
+
+                try:
+                    item = self._queue.get(timeout=_stop_check_interval)
+                    break
+                except queue.Empty:
+                    pass
+
+            self.add_consumer_stall(time.monotonic() - start_time)
+
+            return item
+
+    def get_producer_stall_seconds(self):
+        """Get the total time the producer of this queue has been stalled waiting on the consumer
+
+        Returns:
+            float: Seconds
+        """
+
+        with self._stats_lock:
+            return self._put_stall_seconds
+
+    def add_consumer_stall(self, seconds):
+        """Record that the consumer of this queue was stalled waiting on the producer
+
+        Parameters:
+            seconds (float): How long the consumer waited
+
+        Returns:
+            NoneType
+        """
+
+        with self._stats_lock:
+            self._get_stalls += 1
+            self._get_stall_seconds += seconds
+
+    def drain(self):
+        """Remove and return all items left in the queue, ignoring the end of stream marker
+
+        Returns:
+            list
+        """
+
+        items = []
+
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return items
+
+            if item is not _end_of_stream and not isinstance(item, _StageError):
+                items.append(item)
+
+    def get_stats(self):
+        """Get the counters for this queue
+
+        Returns:
+            dict: the current and maximum depth of the queue, its capacity, the number of items
+                  passed through it, and how many times and for how many seconds the producer
+                  (put) and the consumer (get) were stalled waiting on each other
+        """
+
+        with self._stats_lock:
+            return {
+                'depth': self._queue.qsize(),
+                'max_depth': self._max_depth,
+                'capacity': self._capacity,
+                'items': self._put_count,
+                'producer_stalls': self._put_stalls,
+                'producer_stall_seconds': round(self._put_stall_seconds, 3),
+                'consumer_stalls': self._get_stalls,
+                'consumer_stall_seconds': round(self._get_stall_seconds, 3)
+            }
+
+
+class _EndOfScanSet:
+    """Marks the end of the scans of one scan set, with the stats of its request to spectr"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+
+class _StageError:
+    """Carries an exception raised in one stage to the stages after it"""
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def get_scan_queue_size():
+    """Get the number of parsed scans that may wait to be written at a time
+
+    Returns:
+        int
+    """
+
+    scan_queue_size = general_utils.get_int_env_var(__spectr_scan_queue_size_env_key__, __spectr_scan_queue_size_default__)
+    if scan_queue_size < 1:
+        raise ValueError('Must be at least 1:', __spectr_scan_queue_size_env_key__)
+
+    return scan_queue_size
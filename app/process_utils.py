@@ -0,0 +1,406 @@
+"""Methods for running external programs and following their progress"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import collections
+import os
+import re
+import subprocess
+import threading
+import time
+from . import trace_lib
+
+# the number of lines of output kept from each process to report errors with
+_output_tail_lines = 100
+
+# the number of bytes read from a process's output at a time
+_read_size = 65536
+
+# how often, in seconds, to check whether a process has ended and sample its peak resident set size
+_wait_poll_interval = 0.1
+
+# Hardklor and Bullseye write their progress as a count from 0 to 100, separated by backspaces
+_output_token_pattern = re.compile(r'([^\r\n\b]*)([\r\n\b])')
+_progress_token_pattern = re.compile(r'^(.*?)(\d{1,3})$')
+_final_count_pattern = re.compile(r'^(\d{1,3})(.*)$')
+
+
+def run_process(program_name, command, workdir, timeout=None, progress_callback=None):
+    """Run a process, printing its output line by line as it is written rather than when it ends
+
+    Parameters:
+        program_name (string): The name of the program, used in messages
+        command (list): The command to run, a list of arguments
+        workdir (string): Full path to workdir, the process is run in it
+        timeout (int): Seconds the process may run for, None for no limit
+        progress_callback (function): Called with a ProcessProgress each time the program
+                                      reports more progress, may be None
+
+    Returns:
+        NoneType
+    """
+
+    run_processes_in_parallel(program_name, [command], workdir, timeout, progress_callback)
+
+
+def run_processes_in_parallel(program_name, commands, workdir, timeout=None, progress_callback=None):
+    """Run several processes at the same time, printing their output line by line as it is
+    written. If one fails or the timeout passes, the others are killed. The resource usage of
+    each process is recorded in the trace of the request being processed in the workdir.
+
+    Parameters:
+        program_name (string): The name of the program, used in messages
+        commands (list): The command to run for each process, each a list of arguments
+        workdir (string): Full path to workdir, the processes are run in it
+        timeout (int): Seconds all processes together may run for, None for no limit
+        progress_callback (function): Called with the ProcessProgress of the process that is
+                                      furthest behind each time one reports more progress,
+                                      may be None
+
+    Returns:
+        NoneType
+    """
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    start_time = time.monotonic()
+    trace = trace_lib.get_request_trace(workdir)
+    readers = []
+    progress_lock = threading.Lock()
+
+    def report_progress():
+        if progress_callback is None:
+            return
+
+        with progress_lock:
+            # a reader's threads may report progress before the readers of later processes are started
+            if len(readers) < len(commands):
+                return
+
+            progress_callback(min((reader.progress for reader in readers), key=lambda p: p.get_sort_key()))
+
+    try:
+        for process_number, command in enumerate(commands, start=1):
+            name = program_name if len(commands) < 2 else program_name + ' ' + str(process_number)
+
+            process = subprocess.Popen(
+                command,
+                cwd=workdir,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+
+            readers.append(ProcessOutputReader(name, process, report_progress))
+
+        readers_by_pid = {reader.process.pid: reader for reader in readers}
+        remaining_seconds = None if deadline is None else max(deadline - time.monotonic(), 0)
+
+        for process, usage, max_rss_kb in wait_for_processes([reader.process for reader in readers],
+                                                              remaining_seconds):
+            reader = readers_by_pid[process.pid]
+            reader.join()
+
+            if trace is not None:
+                trace.record(
+                    'process',
+                    name=reader.name,
+                    return_code=process.returncode,
+                    seconds=time.monotonic() - start_time,
+                    user_cpu_seconds=usage.ru_utime,
+                    system_cpu_seconds=usage.ru_stime,
+                    max_rss_kb=max_rss_kb
+                )
+
+            if process.returncode != 0:
+                raise ValueError('Non-zero return code from ' + reader.name + '. Error message:',
+                                 reader.get_error_output())
+
+    finally:
+        for reader in readers:
+            if reader.process.poll() is None:
+                reader.process.kill()
+                reader.process.wait()
+
+            reader.join()
+
+
+def wait_for_processes(processes, timeout=None):
+    """Wait for processes to end, yielding each one as it ends with its CPU time and peak
+    resident set size. The CPU time is that of the process alone, unlike
+    resource.getrusage(resource.RUSAGE_CHILDREN), which adds up all the children of the
+    service, including those run for other requests. The peak resident set size is sampled
+    from /proc while the processes run, as the one reported when a process ends includes the
+    size of the service when it was forked.
+
+    Parameters:
+        processes (list): The processes, each a subprocess.Popen
+        timeout (float): Seconds to wait for all of them, None for no limit
+
+    Returns:
+        generator: Yields (subprocess.Popen, resource.struct_rusage, peak resident set size in
+                   kilobytes or None if the process ended before it was sampled) as each ends
+    """
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    running = list(processes)
+    max_rss_kb = {process.pid: None for process in running}
+
+    while True:
+        for process in list(running):
+            max_rss_kb[process.pid] = _get_peak_rss_kb(process.pid, max_rss_kb[process.pid])
+
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+            if pid == 0:
+                continue
+
+            # the process has been reaped, so popen must not wait for it
+            process.returncode = os.waitstatus_to_exitcode(status)
+            running.remove(process)
+
+            yield process, usage, max_rss_kb[process.pid]
+
+        if len(running) == 0:
+            return
+
+        if deadline is not None and time.monotonic() >= deadline:
+            raise subprocess.TimeoutExpired(running[0].args, timeout)
+
+        time.sleep(_wait_poll_interval)
+
+
+def _get_peak_rss_kb(pid, last_peak_rss_kb):
+    # VmHWM is the peak resident set size of the running program. it is gone once the process
+    # has exited, and /proc only exists on linux, so the last value read is kept
+    try:
+        with open('/proc/' + str(pid) + '/status', 'r') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+
+    return last_peak_rss_kb
+
+
+class ProcessOutputReader:
+    def __init__(self, name, process, progress_callback):
+        """Create a ProcessOutputReader object, which reads the stdout and stderr of a process
+        as they are written. Complete lines are printed and progress counts are parsed. Only
+        the last lines of each are kept, for error messages.
+
+        Parameters:
+            name (string): The name of the process, printed before each line
+            process (subprocess.Popen): The process, started with stdout and stderr as pipes
+            progress_callback (function): Called with no arguments when the progress changes
+
+        Returns:
+            Populated ProcessOutputReader object
+        """
+        self.name = name
+        self.process = process
+        self.progress = ProcessProgress()
+        self._progress_callback = progress_callback
+        self._progress_lock = threading.Lock()
+        self._stdout_tail = collections.deque(maxlen=_output_tail_lines)
+        self._stderr_tail = collections.deque(maxlen=_output_tail_lines)
+
+        self._threads = [
+            threading.Thread(target=self._read, args=(process.stdout, self._stdout_tail), name=name + '-stdout'),
+            threading.Thread(target=self._read, args=(process.stderr, self._stderr_tail), name=name + '-stderr')
+        ]
+
+        for thread in self._threads:
+            thread.start()
+
+    def join(self):
+        """Wait until all the output of the process has been read
+
+        Returns:
+            NoneType
+        """
+
+        for thread in self._threads:
+            thread.join()
+
+    def get_error_output(self):
+        """Get the last lines the process wrote to stderr, or to stdout if it wrote nothing to stderr
+
+        Returns:
+            string
+        """
+
+        return "\n".join(self._stderr_tail if len(self._stderr_tail) > 0 else self._stdout_tail)
+
+    def _read(self, pipe, tail):
+        pending = ''
+        line = ''
+        last_line = ''
+        in_progress = False
+
+        try:
+            while True:
+                chunk = os.read(pipe.fileno(), _read_size)
+                if not chunk:
+                    break
+
+                pending += chunk.decode('ISO-8859-1')
+                end = 0
+
+                for match in _output_token_pattern.finditer(pending):
+                    end = match.end()
+                    token, separator = match.group(1), match.group(2)
+
+                    if separator == '\b':
+                        progress_match = _progress_token_pattern.match(token)
+
+                        if progress_match is not None:
+                            line += progress_match.group(1)
+                            self._update_progress(self._get_step_name(line, last_line), int(progress_match.group(2)))
+                            in_progress = True
+                        else:
+                            line += token
+                        continue
+
+                    # the last count may be followed by more text on the same line
+                    final_count_match = _final_count_pattern.match(token) if in_progress else None
+
+                    if final_count_match is not None:
+                        self._update_progress(self._get_step_name(line, last_line), int(final_count_match.group(1)))
+                        line += final_count_match.group(2)
+                    else:
+                        line += token
+
+                    if line.strip():
+                        tail.append(line)
+                        print(self.name + ':', line, flush=True)
+                        last_line = line
+
+                    line = ''
+                    in_progress = False
+
+                pending = pending[end:]
+
+            line += pending
+            if line.strip():
+                tail.append(line)
+                print(self.name + ':', line, flush=True)
+
+        finally:
+            pipe.close()
+
+    @staticmethod
+    def _get_step_name(line, last_line):
+        # the step is named before the count, on the same line or ending the line before with a ':'
+        if line.strip():
+            return line
+
+        if last_line.rstrip().endswith(':'):
+            return last_line
+
+        return ''
+
+    def _update_progress(self, label, percent):
+        with self._progress_lock:
+            changed = self.progress.update(label.strip().rstrip('.:').strip(), percent)
+
+        if changed:
+            self._progress_callback()
+
+
+class ProcessProgress:
+    def __init__(self):
+        """Create a ProcessProgress object, the percent complete of the step a program is
+        working on and an estimate of the time left in that step
+
+        Returns:
+            Populated ProcessProgress object
+        """
+        self.step = None
+        self.step_number = 0
+        self.percent = None
+        self._step_start_time = None
+        self._step_start_percent = None
+
+    def update(self, step, percent):
+        """Record the progress written by the program
+
+        Parameters:
+            step (string): The text written before the progress count, names the step
+            percent (int): The percent complete of the step
+
+        Returns:
+            bool: True if the progress changed
+        """
+
+        if step != self.step or self.percent is None or percent < self.percent:
+            self.step = step
+            self.step_number += 1
+            self._step_start_time = time.monotonic()
+            self._step_start_percent = percent
+
+        elif percent == self.percent:
+            return False
+
+        self.percent = percent
+
+        return True
+
+    def get_seconds_remaining(self):
+        """Estimate how long the current step will take to finish, from how fast it has gone so far
+
+        Returns:
+            float: Seconds, or None if there is no progress to estimate from yet
+        """
+
+        if self.percent is None or self.percent <= self._step_start_percent:
+            return None
+
+        elapsed_seconds = time.monotonic() - self._step_start_time
+        return elapsed_seconds * (100 - self.percent) / (self.percent - self._step_start_percent)
+
+    def get_sort_key(self):
+        """Sorts processes that are further behind first
+
+        Returns:
+            tuple
+        """
+
+        return self.step_number, -1 if self.percent is None else self.percent
+
+    def get_description(self):
+        """Describe the progress for end users, e.g., 'Matching MS/MS: 45% complete, about 3 minutes remaining'
+
+        Returns:
+            string: The description, or None if no progress has been reported yet
+        """
+
+        if self.percent is None:
+            return None
+
+        description = str(self.percent) + '% complete'
+        if self.step:
+            description = self.step + ': ' + description
+
+        seconds_remaining = self.get_seconds_remaining()
+        if seconds_remaining is not None and self.percent < 100:
+            minutes_remaining = round(seconds_remaining / 60)
+
+            if minutes_remaining < 1:
+                description += ', less than a minute remaining'
+            elif minutes_remaining == 1:
+                description += ', about 1 minute remaining'
+            else:
+                description += ', about ' + str(minutes_remaining) + ' minutes remaining'
+
+        return description
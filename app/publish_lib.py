@@ -0,0 +1,248 @@
+"""Methods for publishing result files to the final location"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import errno
+import gzip
+import hashlib
+import os
+import uuid
+from . import checkpoint_lib, __final_dir_compression_env_key__
+
+# the extension added to the name of a published file for each compression
+_compression_extensions = {
+    'none': '',
+    'gzip': '.gz',
+    'zstd': '.zst'
+}
+
+# the number of bytes read from a result file at a time
+_read_size = 1024 * 1024
+
+# the extension of the file the sha256 of a published file is written to
+_checksum_extension = '.sha256'
+
+# prefix of the files results are written to before being renamed to their published names
+_temp_file_prefix = '.tmp-'
+
+
+def get_final_dir_compression():
+    """Determine how to compress result files published to the final location. Uses the
+    environmental variable, which may be 'none', 'gzip' or 'zstd'. Defaults to 'none' if not set.
+
+    Returns:
+        string
+    """
+
+    compression = os.getenv(__final_dir_compression_env_key__)
+
+    if compression is None or not compression:
+        return 'none'
+
+    if compression in _compression_extensions:
+        return compression
+
+    raise ValueError('Got unknown value for env var:', __final_dir_compression_env_key__)
+
+
+def get_published_file_name(filename):
+    """Get the name a result file is published under, e.g., scans.hk.gz when compressing with gzip
+
+    Parameters:
+        filename (string): The name of the result file in the workdir
+
+    Returns:
+        string
+    """
+
+    return filename + _compression_extensions[get_final_dir_compression()]
+
+
+def get_checksum_file_name(published_file_name):
+    """Get the name of the file the sha256 of a published file is written to, e.g., scans.hk.sha256
+
+    Parameters:
+        published_file_name (string): The name the result file is published under
+
+    Returns:
+        string
+    """
+
+    return published_file_name + _checksum_extension
+
+
+def publish_file(source_path, destination_dir, expected_file=None):
+    """Publish a result file to the destination directory under its published name. Without
+    compression, and with both on the same filesystem, the file is renamed. Otherwise it is
+    streamed, compressed if configured, to a temporary file in the destination directory that
+    is renamed once complete, so a partially written file is never seen under the published
+    name. The source file is checked against the size and sha256 recorded when it was written,
+    if given, and the published file against the size and contents of the source. A renamed
+    file is not read: its recorded sha256 is used, and only a file with none recorded is
+    hashed. A streamed file is hashed as it is read. The sha256 of the published file is
+    written next to it in the format read by sha256sum. The source file is removed once
+    published.
+
+    Parameters:
+        source_path (string): Full path to the result file
+        destination_dir (string): Full path to the directory to publish it in
+        expected_file (dict): {'bytes': size, 'sha256': hex digest} of the result file when it was
+                              written, None if not recorded
+
+    Returns:
+        dict: {'path': full path to the published file, 'bytes': its size, 'sha256': hex digest of its contents}
+    """
+
+    compression = get_final_dir_compression()
+    destination_path = os.path.join(destination_dir, get_published_file_name(os.path.basename(source_path)))
+
+    if compression == 'none':
+        source_bytes = os.path.getsize(source_path)
+        _verify_source(source_path, source_bytes, None, expected_file)
+
+        # only files with no recorded sha256, such as the small Hardklor config and trace, are read to hash them
+        if expected_file is not None:
+            source_sha256 = expected_file['sha256']
+        else:
+            source_sha256 = checkpoint_lib.get_file_sha256(source_path)
+
+        try:
+            os.rename(source_path, destination_path)
+
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+        else:
+            if os.path.getsize(destination_path) != source_bytes:
+                raise ValueError('Published file does not have the size of its source:', destination_path, source_bytes)
+
+            return _write_checksum_file(destination_path, source_bytes, source_sha256)
+
+    temp_path = os.path.join(destination_dir, _temp_file_prefix + uuid.uuid4().hex + '-' +
+                             os.path.basename(destination_path))
+
+    try:
+        source_bytes, source_sha256, written_bytes, sha256 = _stream_file(source_path, temp_path, compression)
+        _verify_source(source_path, source_bytes, source_sha256, expected_file)
+
+        # uncompressed, the published bytes must be exactly those of the source
+        if compression == 'none' and sha256 != source_sha256:
+            raise ValueError('Published file does not have the contents of its source:', source_path)
+
+        os.rename(temp_path, destination_path)
+
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    # the published file must be exactly what was written
+    if os.path.getsize(destination_path) != written_bytes:
+        raise ValueError('Published file does not have the expected size:', destination_path, written_bytes)
+
+    os.remove(source_path)
+
+    return _write_checksum_file(destination_path, written_bytes, sha256)
+
+
+def _verify_source(source_path, source_bytes, source_sha256, expected_file):
+    if expected_file is None:
+        return
+
+    if source_bytes != expected_file['bytes'] or \
+            (source_sha256 is not None and source_sha256 != expected_file['sha256']):
+        raise ValueError('Result file has changed since it was written:', source_path)
+
+
+def _write_checksum_file(published_path, published_bytes, sha256):
+    checksum_path = os.path.join(os.path.dirname(published_path),
+                                 get_checksum_file_name(os.path.basename(published_path)))
+    temp_path = os.path.join(os.path.dirname(published_path), _temp_file_prefix + uuid.uuid4().hex + '-' +
+                             os.path.basename(checksum_path))
+
+    try:
+        with open(temp_path, 'w') as checksum_file:
+            checksum_file.write(sha256 + '  ' + os.path.basename(published_path) + '\n')
+
+        os.rename(temp_path, checksum_path)
+
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return {'path': published_path, 'bytes': published_bytes, 'sha256': sha256}
+
+
+def _stream_file(source_path, temp_path, compression):
+    with open(source_path, 'rb') as source_file, open(temp_path, 'wb') as temp_file:
+        source_bytes = os.fstat(source_file.fileno()).st_size
+        source_sha256 = hashlib.sha256()
+        read_bytes = 0
+
+        # hash the bytes as they are written, so the published file can be checked without reading it back
+        writer = _HashingWriter(temp_file)
+        compressed_file = _open_compressed_writer(writer, compression)
+
+        while True:
+            chunk = source_file.read(_read_size)
+            if not chunk:
+                break
+
+            read_bytes += len(chunk)
+            source_sha256.update(chunk)
+            compressed_file.write(chunk)
+
+        if compressed_file is not writer:
+            compressed_file.close()
+
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+
+    if read_bytes != source_bytes:
+        raise ValueError('Result file changed while being published:', source_path)
+
+    return read_bytes, source_sha256.hexdigest(), writer.bytes, writer.sha256.hexdigest()
+
+
+def _open_compressed_writer(writer, compression):
+    if compression == 'gzip':
+        # no file name or time in the header, so the same results always compress to the same bytes
+        return gzip.GzipFile(filename='', mode='wb', compresslevel=6, fileobj=writer, mtime=0)
+
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError('The zstandard package is required for env var:', __final_dir_compression_env_key__)
+
+        return zstandard.ZstdCompressor().stream_writer(writer, closefd=False)
+
+    return writer
+
+
+class _HashingWriter:
+    def __init__(self, file):
+        self._file = file
+        self.sha256 = hashlib.sha256()
+        self.bytes = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.bytes += len(data)
+
+        return self._file.write(data)
+
+    def flush(self):
+        self._file.flush()
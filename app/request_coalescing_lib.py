@@ -0,0 +1,179 @@
+"""Index of requests that are queued or being processed, used to run identical requests once"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import hashlib
+import json
+
+
+class InFlightRequests:
+    def __init__(self, request_queue):
+        """Create an empty InFlightRequests object. A request submitted with the same spectr file
+        and configs as a request that is queued or being processed becomes a follower of that
+        request (its leader) instead of being queued. The pipeline is only run for the leader,
+        the followers are given copies of its results. Followers are kept in the leader's
+        request dict: {'id': request_id, 'data': {data for job}, 'followers': [requests]}
+
+        All methods hold the request queue's lock, so they are atomic with queue operations.
+
+        Parameters:
+            request_queue (RequestQueue): The request queue leaders are added to
+
+        Returns:
+            Populated InFlightRequests object
+        """
+
+        self._request_queue = request_queue
+        self.lock = request_queue.lock
+
+        # coalescing key -> leader request
+        self._leaders = {}
+
+        # leader request id -> leader request
+        self._leaders_by_id = {}
+
+        # follower request id -> leader request id
+        self._leader_ids = {}
+
+    def submit(self, request):
+        """Add the request to the request queue, or attach it to an identical request that is
+        already queued or being processed
+
+        Parameters:
+            request (dict): A dict: {'id': request_id, 'data': {data for job}}
+
+        Returns:
+            string: The id of the request it was attached to, or None if it was queued
+        """
+
+        with self.lock:
+            coalescing_key = get_coalescing_key(request)
+            leader = self._leaders.get(coalescing_key)
+
+            if leader is None:
+                request['followers'] = []
+                self._leaders[coalescing_key] = request
+                self._leaders_by_id[request['id']] = request
+                self._request_queue.put(request)
+                return None
+
+            leader['followers'].append(request)
+            self._leader_ids[request['id']] = leader['id']
+
+            return leader['id']
+
+    def get_leader_id(self, request_id):
+        """Get the id of the request this request is attached to
+
+        Parameters:
+            request_id (string): The request id
+
+        Returns:
+            string: The leader's request id, or None if this request is not a follower
+        """
+
+        with self.lock:
+            return self._leader_ids.get(request_id)
+
+    def cancel(self, request_id):
+        """Cancel a queued request. A follower is detached from its leader. A leader is removed
+        from the queue, unless it has followers, in which case its first follower takes its
+        place in the queue and becomes the leader of the rest.
+
+        Parameters:
+            request_id (string): The request id
+
+        Returns:
+            bool: True if the request was found and cancelled
+        """
+
+        with self.lock:
+            leader_id = self._leader_ids.pop(request_id, None)
+
+            if leader_id is not None:
+                leader = self._leaders_by_id[leader_id]
+                leader['followers'] = [follower for follower in leader['followers'] if follower['id'] != request_id]
+                return True
+
+            leader = self._leaders_by_id.get(request_id)
+            if leader is None or request_id not in self._request_queue:
+                return False
+
+            coalescing_key = get_coalescing_key(leader)
+            del self._leaders_by_id[request_id]
+
+            if len(leader['followers']) < 1:
+                del self._leaders[coalescing_key]
+                return self._request_queue.remove(request_id)
+
+            new_leader = leader['followers'][0]
+            new_leader['followers'] = leader['followers'][1:]
+
+            del self._leader_ids[new_leader['id']]
+            for follower in new_leader['followers']:
+                self._leader_ids[follower['id']] = new_leader['id']
+
+            self._leaders[coalescing_key] = new_leader
+            self._leaders_by_id[new_leader['id']] = new_leader
+            self._request_queue.replace(request_id, new_leader)
+
+            print('Cancelled request', request_id, 'replaced in queue by identical request', new_leader['id'])
+
+            return True
+
+    def finish(self, request):
+        """Called when the pipeline for a leader is done. Later identical requests will be run
+        again, rather than attached to this one.
+
+        Parameters:
+            request (dict): The leader request
+
+        Returns:
+            list: The follower requests that were attached to this request
+        """
+
+        with self.lock:
+            coalescing_key = get_coalescing_key(request)
+            if self._leaders.get(coalescing_key) is request:
+                del self._leaders[coalescing_key]
+
+            self._leaders_by_id.pop(request['id'], None)
+
+            followers = request.get('followers', [])
+            request['followers'] = []
+
+            for follower in followers:
+                self._leader_ids.pop(follower['id'], None)
+
+            return followers
+
+
+def get_coalescing_key(request):
+    """Get the key identifying requests that would produce the same results
+
+    Parameters:
+        request (dict): A dict: {'id': request_id, 'data': {data for job}}
+
+    Returns:
+        string: sha256 hex digest of the spectr file id, Hardklor config and Bullseye config
+    """
+
+    key_data = [
+        request['data']['spectr_file_id'],
+        request['data']['hardklor_conf'],
+        request['data']['bullseye_conf']
+    ]
+
+    return hashlib.sha256(json.dumps(key_data).encode('utf-8')).hexdigest()
@@ -15,38 +15,156 @@
 #   limitations under the License.
 
 import os
+import resource
+import threading
 import time
 import traceback
-from . import __request_check_delay__, __workdir_env_key__, run_pipeline_methods
+from . import general_utils, metrics_lib, run_pipeline_methods, trace_lib, workdir_lib, __workdir_env_key__, \
+    __request_worker_count_env_key__, __request_worker_count_default__
 
 
-def process_request_queue(request_queue, request_status_dict):
-    """Serially process all requests in the request queue
+def start_request_workers(request_queue, request_status_dict, in_flight_requests):
+    """Start the worker threads that process the request queue. The number of workers, and so
+    the number of requests processed at the same time, is set by an environmental variable.
 
     Parameters:
-        request_queue (list): The request queue, a list of dicts: {'id': request_id, 'data': xml_request}
+        request_queue (RequestQueue): The request queue of dicts: {'id': request_id, 'data': xml_request}
         request_status_dict (dict): The dict that stores the status of requests
+        in_flight_requests (InFlightRequests): The index of queued and processing requests
+
+    Returns:
+        list: The started threading.Thread objects
+    """
+
+    worker_count = general_utils.get_int_env_var(__request_worker_count_env_key__, __request_worker_count_default__)
+    if worker_count < 1:
+        raise ValueError('Must be at least 1:', __request_worker_count_env_key__)
+
+    threads = []
+    for i in range(worker_count):
+        thread = threading.Thread(
+            target=process_request_queue,
+            args=(request_queue, request_status_dict, in_flight_requests),
+            name='request-worker-' + str(i + 1)
+        )
+        thread.start()
+        threads.append(thread)
+
+    print('Started', worker_count, 'request worker(s)')
+
+    return threads
+
+
+def stop_request_workers(threads, request_queue):
+    """Tell the worker threads to stop and wait for them to finish the requests they are
+    processing. Requests still in the queue are not started.
+
+    Parameters:
+        threads (list): The threading.Thread objects returned by start_request_workers()
+        request_queue (RequestQueue): The request queue the workers take requests from
+
+    Returns:
+        NoneType
+    """
+
+    request_queue.close()
+
+    print('Waiting for request workers to finish their current requests...')
+
+    for thread in threads:
+        thread.join()
+
+    print('All request workers have stopped')
+
+
+def requeue_unfinished_requests(job_store, request_status_dict, in_flight_requests):
+    """Queue the requests in the job store that were queued or being processed when the service
+    last stopped, in the order they were submitted. Identical requests are attached to each other
+    again. Requests that were being processed resume from the checkpoints in their work directories.
+
+    Parameters:
+        job_store (JobStore): The job store the requests are kept in
+        request_status_dict (dict): The dict that stores the status of requests
+        in_flight_requests (InFlightRequests): The index of queued and processing requests
+
+    Returns:
+        NoneType
+    """
+
+    unfinished_requests = job_store.get_unfinished_requests()
+
+    for request_id, status in unfinished_requests:
+        if status.get('data') is None:
+            request_status_dict[request_id]['status'] = 'error'
+            request_status_dict[request_id]['message'] = 'Request was interrupted and can not be run again.'
+            continue
+
+        with in_flight_requests.lock:
+            request_status_dict[request_id]['status'] = 'queued'
+            in_flight_requests.submit({'id': request_id, 'data': status['data']})
+
+    print('Queued', len(unfinished_requests), 'unfinished request(s) from the job store')
+
+
+def process_request_queue(request_queue, request_status_dict, in_flight_requests):
+    """Process requests from the request queue, one at a time, until the service shuts down.
+    Several of these may run at the same time in different threads.
+
+    Parameters:
+        request_queue (RequestQueue): The request queue of dicts: {'id': request_id, 'data': xml_request}
+        request_status_dict (dict): The dict that stores the status of requests
+        in_flight_requests (InFlightRequests): The index of queued and processing requests
 
     Returns:
         None
     """
 
     while True:
-        while len(request_queue) > 0:
-            request = request_queue.pop(0)
+        request = get_next_request(request_queue, request_status_dict)
+
+        if request is None:
+            return
+
+        # an error recording the outcome of a request must not stop this worker
+        try:
+            process_request(request, request_status_dict, in_flight_requests)
+
+        except Exception as e:
+            print('Error finishing request:', request['id'])
+            traceback.print_exc()
+
 
-            process_request(request, request_status_dict)
+def get_next_request(request_queue, request_status_dict):
+    """Wait until there is a request in the request queue, then remove it and mark it as
+    processing
 
-        time.sleep(__request_check_delay__)
+    Parameters:
+        request_queue (RequestQueue): The request queue of dicts: {'id': request_id, 'data': xml_request}
+        request_status_dict (dict): The dict that stores the status of requests
+
+    Returns:
+        dict: The request, or None if the service is shutting down
+    """
 
+    with request_queue.lock:
+        request = request_queue.get()
 
-def process_request(request, request_status_dict):
+        if request is not None:
+            request_status_dict[request['id']]['status'] = 'processing'
+
+        return request
+
+
+def process_request(request, request_status_dict, in_flight_requests):
     """Process the given request. Should not ever raise an exception. Will update the
-    request status dict appropriately.
+    request status dict appropriately, for the request and any identical requests that
+    were attached to it while it was in flight. A trace of how the request was processed
+    is published with the results.
 
     Parameters:
         request (dict): A dict: {'id': request_id, 'data': {data for job}}
         request_status_dict (dict): The dict that stores the status of requests
+        in_flight_requests (InFlightRequests): The index of queued and processing requests
 
     Returns:
         None
@@ -57,24 +175,32 @@ def process_request(request, request_status_dict):
     print('\trequest_status_dict', request_status_dict)
 
     workdir = None
+    trace = None
+    success = False
+
+    start_time = time.monotonic()
+    metrics_lib.active_request_workers.inc()
 
     try:
 
         workdir = get_workdir(request)
 
+        trace = trace_lib.start_request_trace(request['id'], workdir)
+        trace.record('request_start', request_id=request['id'], spectr_file_id=request['data'].get('spectr_file_id'),
+                     worker=threading.current_thread().name)
+
         request_status_dict[request['id']]['status'] = 'processing'
         request_status_dict[request['id']]['end_user_message'] = 'Initiating feature detection pipeline run...'
 
-        run_pipeline_methods.export_spectral_data(request, request_status_dict, workdir)
-        run_pipeline_methods.write_hardklor_config_file(request, request_status_dict, workdir)
-        run_pipeline_methods.execute_hardklor(request, request_status_dict, workdir)
-        run_pipeline_methods.execute_bullseye(request, request_status_dict, workdir)
-        run_pipeline_methods.move_data_to_final_destination(request, request_status_dict, workdir)
+        run_pipeline_methods.run_pipeline(request, request_status_dict, workdir)
+
+        end_request_trace(trace, start_time, 'success')
+        run_pipeline_methods.publish_trace_files(request, workdir)
 
         request_status_dict[request['id']]['status'] = 'success'
         request_status_dict[request['id']]['message'] = 'Pipeline complete'
 
-        run_pipeline_methods.clean_workdir(workdir, success=True)
+        success = True
 
     except Exception as e:
         request_status_dict[request['id']]['status'] = 'error'
@@ -83,11 +209,88 @@ def process_request(request, request_status_dict):
         # print stack trace
         traceback.print_exc()
 
-        run_pipeline_methods.clean_workdir(workdir, success=False)
+        if trace is not None:
+            end_request_trace(trace, start_time, 'error', str(e))
+
+    # done even if recording the error failed, so the worker, followers and memory budget are not left waiting
+    finally:
+        metrics_lib.active_request_workers.dec()
+        metrics_lib.request_duration_seconds.observe(time.monotonic() - start_time, 'success' if success else 'error')
+
+        try:
+            finish_followers(request, request_status_dict, in_flight_requests)
+
+        finally:
+            try:
+                run_pipeline_methods.clean_workdir(workdir, success=success)
+
+            finally:
+                workdir_lib.release_workdir(request['id'], workdir)
+                run_pipeline_methods.forget_scan_numbers(request)
+
+
+def end_request_trace(trace, start_time, status, error_message=None):
+    """Record the end of the request in its trace, with the peak memory use of the service,
+    and close the trace
+
+    Parameters:
+        trace (trace_lib.RequestTrace): The trace of the request
+        start_time (float): time.monotonic() when processing the request started
+        status (string): 'success' or 'error'
+        error_message (string): The error, if there was one
+
+    Returns:
+        NoneType
+    """
+
+    trace.record(
+        'request_end',
+        status=status,
+        seconds=time.monotonic() - start_time,
+        service_max_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        error=error_message
+    )
+
+    trace.close()
+
+
+def finish_followers(request, request_status_dict, in_flight_requests):
+    """Give the requests that were attached to this request the same outcome: on success, copy
+    the results to each follower's own final location. Should not ever raise an exception.
+
+    Parameters:
+        request (dict): The request that was processed
+        request_status_dict (dict): The dict that stores the status of requests
+        in_flight_requests (InFlightRequests): The index of queued and processing requests
+
+    Returns:
+        None
+    """
+
+    for follower in in_flight_requests.finish(request):
+        if request_status_dict[request['id']]['status'] != 'success':
+            request_status_dict[follower['id']]['status'] = 'error'
+            request_status_dict[follower['id']]['message'] = request_status_dict[request['id']]['message']
+            continue
+
+        try:
+            run_pipeline_methods.copy_results_to_final_destination(request, follower)
+
+            request_status_dict[follower['id']]['status'] = 'success'
+            request_status_dict[follower['id']]['message'] = 'Pipeline complete'
+
+        except Exception as e:
+            request_status_dict[follower['id']]['status'] = 'error'
+            request_status_dict[follower['id']]['message'] = str(e)
+
+            traceback.print_exc()
 
 
 def get_workdir(request):
-    """Create and return the path to the work directory
+    """Create and return the path to the work directory. It is placed on the memory backed
+    filesystem if one is configured and the request's estimated size fits in its budget. The
+    work directory left by an earlier, interrupted run of the request is used again, so the
+    run can resume.
 
     Parameters:
         request (dict): A dict: {'id': request_id, 'data': xml_request}
@@ -105,9 +308,15 @@ def get_workdir(request):
     if not os.path.isdir(os.getenv(__workdir_env_key__)):
         raise ValueError('Work directory is a file, not a directory:', os.getenv(__workdir_env_key__))
 
-    workdir = os.path.join(os.getenv(__workdir_env_key__), request['id'])
-    if os.path.exists(workdir):
-        raise ValueError('Work directory already exists:', workdir)
+    workdir_parent = workdir_lib.get_workdir_parent(
+        request['id'],
+        lambda: run_pipeline_methods.get_estimated_workdir_size(request)
+    )
+
+    workdir = os.path.join(workdir_parent, request['id'])
+    if os.path.isdir(workdir):
+        print('Resuming in existing work directory:', workdir)
+        return workdir
 
     os.mkdir(workdir)
     if not os.path.exists(workdir):
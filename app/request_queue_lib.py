@@ -0,0 +1,183 @@
+"""Thread-safe request queue with constant time lookup of requests by id"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import bisect
+import threading
+from collections import OrderedDict
+
+
+class RequestQueue:
+    def __init__(self):
+        """Create an empty RequestQueue object. Requests are dicts: {'id': request_id, 'data': {data for job}}
+
+        Each request gets an increasing sequence number when it is added. The queue keeps a
+        sequence number -> request index in queue order, an id -> sequence number index, plus a
+        sorted list of the sequence numbers of requests removed from the middle of the queue that
+        are still behind the head. A request's position is then its distance from the head less
+        the number of removed requests before it:
+
+            add, replace, remove by id, take next:  O(1), plus O(log n) to record a removal
+            position of a request:                  O(log n)
+
+        Returns:
+            Populated RequestQueue object
+        """
+
+        # held for every operation. callers may also hold it to combine queue operations with
+        # other changes, such as updating a request's status, so that they happen atomically
+        self.lock = threading.Condition(threading.RLock())
+
+        self._entries = OrderedDict()
+        self._sequence_numbers = {}
+        self._removed_sequence_numbers = []
+        self._head_sequence_number = 0
+        self._next_sequence_number = 0
+        self._closed = False
+
+    def put(self, request):
+        """Add a request to the end of the queue and wake up one waiting consumer
+
+        Parameters:
+            request (dict): A dict: {'id': request_id, 'data': {data for job}}
+
+        Returns:
+            NoneType
+        """
+
+        with self.lock:
+            if request['id'] in self._sequence_numbers:
+                raise ValueError('Request is already in the queue:', request['id'])
+
+            self._entries[self._next_sequence_number] = request
+            self._sequence_numbers[request['id']] = self._next_sequence_number
+            self._next_sequence_number += 1
+
+            self.lock.notify()
+
+    def get(self):
+        """Wait until the queue has a request, then remove and return the first one
+
+        Returns:
+            dict: The request, or None if the queue has been closed
+        """
+
+        with self.lock:
+            while len(self._entries) < 1 and not self._closed:
+                self.lock.wait()
+
+            if self._closed:
+                return None
+
+            sequence_number, request = self._entries.popitem(last=False)
+            del self._sequence_numbers[request['id']]
+
+            # every request between the old head and this one was removed from the middle
+            del self._removed_sequence_numbers[:bisect.bisect_left(self._removed_sequence_numbers, sequence_number)]
+            self._head_sequence_number = sequence_number + 1
+
+            return request
+
+    def remove(self, request_id):
+        """Remove the request with the given id from the queue
+
+        Parameters:
+            request_id (string): The request id
+
+        Returns:
+            bool: True if the request was found and removed
+        """
+
+        with self.lock:
+            sequence_number = self._sequence_numbers.pop(request_id, None)
+            if sequence_number is None:
+                return False
+
+            del self._entries[sequence_number]
+            bisect.insort(self._removed_sequence_numbers, sequence_number)
+
+            return True
+
+    def replace(self, request_id, new_request):
+        """Put a different request in the place of the request with the given id, keeping its
+        position in the queue
+
+        Parameters:
+            request_id (string): The id of the request to replace
+            new_request (dict): A dict: {'id': request_id, 'data': {data for job}}
+
+        Returns:
+            bool: True if the request was found and replaced
+        """
+
+        with self.lock:
+            if request_id not in self._sequence_numbers:
+                return False
+
+            if new_request['id'] != request_id and new_request['id'] in self._sequence_numbers:
+                raise ValueError('Request is already in the queue:', new_request['id'])
+
+            sequence_number = self._sequence_numbers.pop(request_id)
+            self._sequence_numbers[new_request['id']] = sequence_number
+            self._entries[sequence_number] = new_request
+
+            return True
+
+    def get_position(self, request_id):
+        """Return the position of the request in the queue, starting at 1
+
+        Parameters:
+            request_id (string): The request id
+
+        Returns:
+            int: The 1-based position of the request, or None if it is not in the queue
+        """
+
+        with self.lock:
+            sequence_number = self._sequence_numbers.get(request_id)
+            if sequence_number is None:
+                return None
+
+            removed_ahead = bisect.bisect_left(self._removed_sequence_numbers, sequence_number)
+
+            return sequence_number - self._head_sequence_number - removed_ahead + 1
+
+    def close(self):
+        """Wake up all waiting consumers and make get() return None from now on
+
+        Returns:
+            NoneType
+        """
+
+        with self.lock:
+            self._closed = True
+            self.lock.notify_all()
+
+    def __contains__(self, request_id):
+        with self.lock:
+            return request_id in self._sequence_numbers
+
+    def __len__(self):
+        with self.lock:
+            return len(self._entries)
+
+    def __iter__(self):
+        with self.lock:
+            requests = list(self._entries.values())
+
+        return iter(requests)
+
+    def __repr__(self):
+        return 'RequestQueue(' + repr([request['id'] for request in self]) + ')'
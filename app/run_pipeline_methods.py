@@ -14,13 +14,210 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-from . import ms1_lib, ms2_lib, spectr_utils, general_utils, bullseye_utils
-from . import __hardklor_config_file__, __hardklor_results_file__, __bullseye_results_file__, __ms1_file__,\
-    __ms2_file__, __hardklor_filter_executable_path_env_key__, __bullseye_filter_executable_path_env_key__,\
-    __final_dir_env_key__, __clean_working_directory_env_key__, __hardklor_timeout_env_key__
+from . import ms1_lib, ms2_lib, ms1_ms2_lib, spectr_utils, general_utils, bullseye_utils, http_utils, step_executor,\
+    file_cache_lib, peak_format_utils, hardklor_utils, hardklor_lib, bullseye_lib, process_utils, ms_file_utils,\
+    workdir_lib, publish_lib, checkpoint_lib, trace_lib
+from . import __hardklor_config_file__, __hardklor_results_file__, __bullseye_results_file__,\
+    __trace_file__, __profile_file__,\
+    __hardklor_filter_executable_path_env_key__, __bullseye_filter_executable_path_env_key__,\
+    __final_dir_env_key__, __clean_working_directory_env_key__, __hardklor_timeout_env_key__,\
+    __spectr_export_mode_env_key__
 import os
-import subprocess
 import shutil
+import threading
+import traceback
+
+# the scan numbers of each scan level of a request's spectral file, by (request id, scan level). kept from
+# estimating the size of the work directory until the export uses them, so spectr is only asked once
+_scan_numbers = {}
+_scan_numbers_lock = threading.Lock()
+
+
+def get_pipeline_steps():
+    """Get the steps of the pipeline and the steps each depends on. Hardklor only needs the
+    ms1 file, so when the files are exported separately it runs while the ms2 file is still
+    being exported. The ms2 export starts after the ms1 export, so a request never has more
+    requests to spectr in flight than one export allows. Bullseye starts once both Hardklor
+    and the ms2 export are done. If the Hardklor results are found in the cache, the ms1 file
+    is not exported and Hardklor is not run. Steps that take long record a checkpoint when they
+    complete, so a resumed run skips them.
+
+    Returns:
+        list: An array of step_executor.PipelineStep objects
+    """
+
+    ms1_file_name = ms_file_utils.get_ms1_file_name()
+    ms2_file_name = ms_file_utils.get_ms2_file_name()
+
+    if get_spectr_export_mode() == 'combined':
+        export_steps = [
+            get_checkpointed_step('export spectral data', export_spectral_data, [ms1_file_name, ms2_file_name],
+                                  depends_on=('find cached hardklor results',))
+        ]
+        ms1_step_name = ms2_step_name = 'export spectral data'
+
+    else:
+        export_steps = [
+            get_checkpointed_step('export ms1 data', export_ms1_data, [ms1_file_name],
+                                  depends_on=('find cached hardklor results',)),
+            get_checkpointed_step('export ms2 data', export_ms2_data, [ms2_file_name],
+                                  depends_on=('export ms1 data',))
+        ]
+        ms1_step_name = 'export ms1 data'
+        ms2_step_name = 'export ms2 data'
+
+    return [
+        step_executor.PipelineStep('write hardklor config', write_hardklor_config_file),
+        step_executor.PipelineStep('find cached hardklor results', link_cached_hardklor_results,
+                                   depends_on=('write hardklor config',))
+    ] + export_steps + [
+        get_checkpointed_step('hardklor', execute_hardklor, [__hardklor_results_file__],
+                              depends_on=(ms1_step_name, 'find cached hardklor results'), record_sha256=True),
+        get_checkpointed_step('bullseye', execute_bullseye, [__bullseye_results_file__],
+                              depends_on=(ms2_step_name, 'hardklor'), record_sha256=True),
+        get_checkpointed_step('publish results', move_data_to_final_destination, [], depends_on=('bullseye',))
+    ]
+
+
+def get_checkpointed_step(name, method, output_files, depends_on=(), record_sha256=False):
+    """Get a pipeline step that is skipped if an earlier run of this request completed it and
+    its output files have not changed since, and that records a checkpoint when it completes.
+    The sha256 of the output files is only recorded for the results, which are checked against
+    it when published, so the exported ms1 and ms2 files are not read again before Hardklor starts.
+
+    Parameters:
+        name (string): The unique name of this step
+        method (function): The method to call to run this step
+        output_files (list): The names of the files the step writes to the workdir
+        depends_on (tuple): The names of the steps that must finish before this step starts
+        record_sha256 (bool): Whether to record the sha256 of the output files in the checkpoint
+
+    Returns:
+        step_executor.PipelineStep
+    """
+
+    def run_checkpointed_step(request, request_status_dict, workdir):
+        if checkpoint_lib.is_step_complete(workdir, name):
+            print('Skipping pipeline step completed by an earlier run:', name)
+            return
+
+        method(request, request_status_dict, workdir)
+
+        checkpoint_lib.mark_step_complete(workdir, name, output_files, record_sha256)
+
+    return step_executor.PipelineStep(name, run_checkpointed_step, depends_on=depends_on)
+
+
+def run_pipeline(request, request_status_dict, workdir):
+    """Run all the steps of the pipeline for this request. In the workdir of an earlier,
+    interrupted run, the steps it completed are skipped and an interrupted export resumes.
+
+    Parameters:
+        request (dict): A dict: {'id': request_id, 'data': {data for job}}
+        request_status_dict (dict): The dict that stores the status of requests
+        workdir (string): Full path to workdir
+
+    Returns:
+        NoneType
+    """
+
+    # the results were published before the earlier run was interrupted
+    if checkpoint_lib.is_step_complete(workdir, 'publish results'):
+        print('Results were already published by an earlier run')
+        return
+
+    # partly written results of an interrupted run would be mistaken for finished results
+    for step_name, filename in (('hardklor', __hardklor_results_file__), ('bullseye', __bullseye_results_file__)):
+        if not checkpoint_lib.is_step_complete(workdir, step_name):
+            checkpoint_lib.remove_step_outputs(workdir, step_name, [filename])
+
+    steps = get_pipeline_steps()
+
+    trace = trace_lib.get_request_trace(workdir)
+    if trace is not None:
+        steps = [trace_lib.get_traced_step(step, trace) for step in steps]
+
+    step_executor.run_steps(steps, request, request_status_dict, workdir)
+
+
+def get_estimated_workdir_size(request):
+    """Estimate the size the work directory of this request will reach, from the numbers of
+    ms1 and ms2 scans in its spectral file
+
+    Parameters:
+        request (dict): A dict: {'id': request_id, 'data': {data for job}}
+
+    Returns:
+        int: The estimated size in bytes
+    """
+
+    ms1_scan_count = len(get_scan_numbers(request, 1))
+    ms2_scan_count = len(get_scan_numbers(request, 2))
+
+    return workdir_lib.estimate_workdir_size(ms1_scan_count, ms2_scan_count)
+
+
+def get_scan_numbers(request, scan_level):
+    """Get the scan numbers for a scan level in the spectral file of this request. Spectr is
+    only asked the first time for each request, until forget_scan_numbers() is called.
+
+    Parameters:
+        request (dict): A dict: {'id': request_id, 'data': {data for job}}
+        scan_level (int): The scan level, 1 or 2
+
+    Returns:
+        list: An array of scan numbers
+    """
+
+    key = (request['id'], scan_level)
+
+    with _scan_numbers_lock:
+        if key in _scan_numbers:
+            return _scan_numbers[key]
+
+    scan_numbers = spectr_utils.get_scan_numbers_for_scan_level(get_spectr_file_id(request), scan_level)
+
+    with _scan_numbers_lock:
+        _scan_numbers[key] = scan_numbers
+
+    return scan_numbers
+
+
+def get_ms1_and_ms2_scan_numbers(request):
+    """Get the ms1 and ms2 scan numbers in the spectral file of this request together. Uses
+    those already gotten for each level if there are any, else asks spectr for both with one
+    call.
+
+    Parameters:
+        request (dict): A dict: {'id': request_id, 'data': {data for job}}
+
+    Returns:
+        list: An array of scan numbers
+    """
+
+    with _scan_numbers_lock:
+        ms1_scan_numbers = _scan_numbers.get((request['id'], 1))
+        ms2_scan_numbers = _scan_numbers.get((request['id'], 2))
+
+    if ms1_scan_numbers is not None and ms2_scan_numbers is not None:
+        return ms1_scan_numbers + ms2_scan_numbers
+
+    return spectr_utils.get_scan_numbers_for_scan_levels(get_spectr_file_id(request), [1, 2])
+
+
+def forget_scan_numbers(request):
+    """Drop the scan numbers kept for this request once it is finished
+
+    Parameters:
+        request (dict): A dict: {'id': request_id, 'data': {data for job}}
+
+    Returns:
+        NoneType
+    """
+
+    with _scan_numbers_lock:
+        for scan_level in (1, 2):
+            _scan_numbers.pop((request['id'], scan_level), None)
 
 
 def export_spectral_data(request, request_status_dict, workdir):
@@ -35,23 +232,228 @@ def export_spectral_data(request, request_status_dict, workdir):
         NoneType
     """
 
-    spectr_file_id = request['data']['spectr_file_id']
-    if spectr_file_id is None or not spectr_file_id:
-        raise ValueError("Error running pipeline, could not find spectr_file_id in request.")
+    if get_spectr_export_mode() == 'combined':
+        spectr_file_id = get_spectr_file_id(request)
 
-    # get all ms1 and ms2 scan numbers
-    request_status_dict[request['id']]['end_user_message'] = 'Gathering scan numbers from spectr'
-    ms1_scan_numbers = spectr_utils.get_scan_numbers_for_scan_level(spectr_file_id, 1)
-    ms2_scan_numbers = spectr_utils.get_scan_numbers_for_scan_level(spectr_file_id, 2)
+        # hardklor will not be run, so only the ms2 file is needed
+        if has_hardklor_results(workdir):
+            export_ms2_data(request, request_status_dict, workdir)
+            return
+
+        ms1_cached = link_cached_spectral_file(spectr_file_id, ms_file_utils.get_ms1_file_name(), workdir)
+        ms2_cached = link_cached_spectral_file(spectr_file_id, ms_file_utils.get_ms2_file_name(), workdir)
+
+        if not ms1_cached and not ms2_cached:
+            # get all ms1 and ms2 scan numbers with one call
+            request_status_dict[request['id']]['end_user_message'] = 'Gathering scan numbers from spectr'
+            scan_numbers = get_ms1_and_ms2_scan_numbers(request)
+
+            # build ms1 and ms2 files together
+            request_status_dict[request['id']]['end_user_message'] = 'Creating MS1 and MS2 files'
+            ms1_ms2_lib.create_ms1_and_ms2_files(spectr_file_id, scan_numbers, workdir)
+
+            cache_spectral_file(spectr_file_id, ms_file_utils.get_ms1_file_name(), workdir)
+            cache_spectral_file(spectr_file_id, ms_file_utils.get_ms2_file_name(), workdir)
+
+        elif not ms1_cached:
+            create_ms1_data(request, request_status_dict, workdir)
+
+        elif not ms2_cached:
+            create_ms2_data(request, request_status_dict, workdir)
+
+    else:
+        export_ms1_data(request, request_status_dict, workdir)
+        export_ms2_data(request, request_status_dict, workdir)
+
+    print('spectr connection stats:', http_utils.get_http_client().get_connection_stats())
+
+
+def export_ms1_data(request, request_status_dict, workdir):
+    """Export the ms1 spectral data for this request to disk from spectr, or from the cache
+    if this file was exported before. Not needed if the Hardklor results were cached.
+
+    Parameters:
+        request (dict): A dict: {'id': request_id, 'data': {data for job}}
+        request_status_dict (dict): The dict that stores the status of requests
+        workdir (string): Full path to workdir
+
+    Returns:
+        NoneType
+    """
+
+    if has_hardklor_results(workdir):
+        print('Found cached Hardklor results, not exporting MS1 file')
+        return
+
+    if link_cached_spectral_file(get_spectr_file_id(request), ms_file_utils.get_ms1_file_name(), workdir):
+        request_status_dict[request['id']]['end_user_message'] = 'Using cached MS1 file'
+        return
+
+    create_ms1_data(request, request_status_dict, workdir)
+
+
+def export_ms2_data(request, request_status_dict, workdir):
+    """Export the ms2 spectral data for this request to disk from spectr, or from the cache
+    if this file was exported before
+
+    Parameters:
+        request (dict): A dict: {'id': request_id, 'data': {data for job}}
+        request_status_dict (dict): The dict that stores the status of requests
+        workdir (string): Full path to workdir
+
+    Returns:
+        NoneType
+    """
+
+    if link_cached_spectral_file(get_spectr_file_id(request), ms_file_utils.get_ms2_file_name(), workdir):
+        request_status_dict[request['id']]['end_user_message'] = 'Using cached MS2 file'
+        return
+
+    create_ms2_data(request, request_status_dict, workdir)
+
+
+def create_ms1_data(request, request_status_dict, workdir):
+    """Create the ms1 file for this request from spectr and add it to the cache
+
+    Parameters:
+        request (dict): A dict: {'id': request_id, 'data': {data for job}}
+        request_status_dict (dict): The dict that stores the status of requests
+        workdir (string): Full path to workdir
+
+    Returns:
+        NoneType
+    """
+
+    spectr_file_id = get_spectr_file_id(request)
+
+    request_status_dict[request['id']]['end_user_message'] = 'Gathering MS1 scan numbers from spectr'
+    ms1_scan_numbers = get_scan_numbers(request, 1)
 
-    # build ms1 file
     request_status_dict[request['id']]['end_user_message'] = 'Creating MS1 file'
     ms1_lib.create_ms1_file(spectr_file_id, ms1_scan_numbers, workdir)
 
-    # build ms2 file
+    cache_spectral_file(spectr_file_id, ms_file_utils.get_ms1_file_name(), workdir)
+
+
+def create_ms2_data(request, request_status_dict, workdir):
+    """Create the ms2 file for this request from spectr and add it to the cache
+
+    Parameters:
+        request (dict): A dict: {'id': request_id, 'data': {data for job}}
+        request_status_dict (dict): The dict that stores the status of requests
+        workdir (string): Full path to workdir
+
+    Returns:
+        NoneType
+    """
+
+    spectr_file_id = get_spectr_file_id(request)
+
+    request_status_dict[request['id']]['end_user_message'] = 'Gathering MS2 scan numbers from spectr'
+    ms2_scan_numbers = get_scan_numbers(request, 2)
+
     request_status_dict[request['id']]['end_user_message'] = 'Creating MS2 file'
     ms2_lib.create_ms2_file(spectr_file_id, ms2_scan_numbers, workdir)
 
+    cache_spectral_file(spectr_file_id, ms_file_utils.get_ms2_file_name(), workdir)
+
+
+def link_cached_spectral_file(spectr_file_id, filename, workdir):
+    """If the spectral file cache is enabled and holds this file for this spectr file, place
+    it in the workdir
+
+    Parameters:
+        spectr_file_id (string): The spectr file id (hash key) of the spectral file
+        filename (string): The name of the ms1 or ms2 file
+        workdir (string): Full path to workdir
+
+    Returns:
+        bool: True if the file was found in the cache
+    """
+
+    spectral_file_cache = file_cache_lib.get_spectral_file_cache()
+    if spectral_file_cache is None:
+        return False
+
+    cache_key = get_spectral_file_cache_key(spectr_file_id, filename)
+    found = spectral_file_cache.link_files_into(cache_key, [filename], workdir)
+
+    print('Spectral file cache', 'hit' if found else 'miss', 'for', filename, spectr_file_id)
+    print('Spectral file cache stats:', spectral_file_cache.get_stats())
+
+    return found
+
+
+def cache_spectral_file(spectr_file_id, filename, workdir):
+    """Add a newly exported ms1 or ms2 file to the spectral file cache, if it is enabled
+
+    Parameters:
+        spectr_file_id (string): The spectr file id (hash key) of the spectral file
+        filename (string): The name of the ms1 or ms2 file
+        workdir (string): Full path to workdir
+
+    Returns:
+        NoneType
+    """
+
+    spectral_file_cache = file_cache_lib.get_spectral_file_cache()
+    if spectral_file_cache is None:
+        return
+
+    spectral_file_cache.add_files(get_spectral_file_cache_key(spectr_file_id, filename), workdir, [filename])
+
+
+def get_spectral_file_cache_key(spectr_file_id, filename):
+    """Get the key of an exported file in the spectral file cache. Includes the peak line format
+    so that files written with different precision settings are cached separately.
+
+    Parameters:
+        spectr_file_id (string): The spectr file id (hash key) of the spectral file
+        filename (string): The name of the ms1 or ms2 file
+
+    Returns:
+        string
+    """
+
+    return '\t'.join([spectr_file_id, filename, peak_format_utils.get_peak_line_format()])
+
+
+def get_spectr_file_id(request):
+    """Get the spectr file id from the request
+
+    Parameters:
+        request (dict): A dict: {'id': request_id, 'data': {data for job}}
+
+    Returns:
+        string
+    """
+
+    spectr_file_id = request['data']['spectr_file_id']
+    if spectr_file_id is None or not spectr_file_id:
+        raise ValueError("Error running pipeline, could not find spectr_file_id in request.")
+
+    return spectr_file_id
+
+
+def get_spectr_export_mode():
+    """Determine how the ms1 and ms2 files should be exported from spectr. Uses the
+    environmental variable, which may be 'separate' (one pass over spectr per file) or
+    'combined' (both files from a single pass). Defaults to 'separate' if not set.
+
+    Returns:
+        string
+    """
+
+    export_mode = os.getenv(__spectr_export_mode_env_key__)
+
+    if export_mode is None or not export_mode:
+        return 'separate'
+
+    if export_mode in ('separate', 'combined'):
+        return export_mode
+
+    raise ValueError('Got unknown value for env var:', __spectr_export_mode_env_key__)
+
 
 def write_hardklor_config_file(request, request_status_dict, workdir):
     """Write the Hardklor config file to disk
@@ -79,7 +481,7 @@ def write_hardklor_config_file(request, request_status_dict, workdir):
     if not hardklor_config_data.endswith("\n"):
         hardklor_config_data = hardklor_config_data + "\n"
 
-    endline = __ms1_file__ + "\t" + __hardklor_results_file__ + "\n"
+    endline = ms_file_utils.get_ms1_file_name() + "\t" + __hardklor_results_file__ + "\n"
 
     hardklor_config_data = hardklor_config_data + endline
 
@@ -100,6 +502,10 @@ def execute_hardklor(request, request_status_dict, workdir):
         NoneType
     """
 
+    if has_hardklor_results(workdir):
+        print('Found cached Hardklor results, not running Hardklor')
+        return
+
     request_status_dict[request['id']]['end_user_message'] = 'Running Hardklor'
 
     hardklor_timeout = os.getenv(__hardklor_timeout_env_key__)
@@ -112,20 +518,132 @@ def execute_hardklor(request, request_status_dict, workdir):
     if not os.path.exists(hardklor_filter_executable):
         raise ValueError('Could not find Hardklor executable:', hardklor_filter_executable)
 
-    result = subprocess.run(
-        [hardklor_filter_executable, __hardklor_config_file__],
-        cwd=workdir,
-        capture_output=True,
-        text=True,
-        timeout=hardklor_timeout
-    )
-    print(result.stdout)
-    print(result.stderr)
+    shard_count = hardklor_lib.get_hardklor_shard_count()
+
+    if shard_count > 1:
+        execute_hardklor_shards(hardklor_filter_executable, shard_count, hardklor_timeout, workdir,
+                                get_progress_callback(request, request_status_dict, 'Running Hardklor'))
+
+    else:
+        process_utils.run_process(
+            'Hardklor',
+            [hardklor_filter_executable, __hardklor_config_file__],
+            workdir,
+            hardklor_timeout,
+            get_progress_callback(request, request_status_dict, 'Running Hardklor')
+        )
+
+        general_utils.verify_file_exists(os.path.join(workdir, __hardklor_results_file__))
+
+    hardklor_results_cache = file_cache_lib.get_hardklor_results_cache()
+    if hardklor_results_cache is not None:
+        hardklor_results_cache.add_files(get_hardklor_results_cache_key(request, workdir), workdir,
+                                         [__hardklor_results_file__])
+
+
+def execute_hardklor_shards(hardklor_filter_executable, shard_count, hardklor_timeout, workdir, progress_callback):
+    """Run Hardklor as several processes at the same time, each over its own range of ms1 scans,
+    and merge their results into the Hardklor results file in scan order
+
+    Parameters:
+        hardklor_filter_executable (string): Full path to the Hardklor executable
+        shard_count (int): The number of Hardklor processes to run
+        hardklor_timeout (int): Seconds Hardklor may run for, None for no limit
+        workdir (string): Full path to workdir
+        progress_callback (function): Called with the progress of the shard furthest behind
+
+    Returns:
+        NoneType
+    """
+
+    with open(os.path.join(workdir, __hardklor_config_file__), 'r') as config_file:
+        hardklor_config = config_file.read()
+
+    shards = hardklor_lib.plan_hardklor_shards(hardklor_lib.get_ms1_scan_numbers(workdir), hardklor_config, shard_count)
+    print('Hardklor shard scan ranges:',
+          [(shard.first_scan, shard.last_scan, shard.run_first_scan, shard.run_last_scan) for shard in shards])
+
+    hardklor_lib.write_hardklor_shard_config_files(hardklor_config, shards, workdir)
+    hardklor_lib.run_hardklor_shards(hardklor_filter_executable, shards, workdir, hardklor_timeout, progress_callback)
+    hardklor_lib.merge_hardklor_shard_results(shards, workdir)
 
     general_utils.verify_file_exists(os.path.join(workdir, __hardklor_results_file__))
 
-    if result.returncode != 0:
-        raise ValueError("Non-zero return code from Hardklor. Error message:", result.stderr)
+
+def link_cached_hardklor_results(request, request_status_dict, workdir):
+    """If the Hardklor results cache is enabled and holds results for this spectral file and
+    Hardklor config, place them in the workdir
+
+    Parameters:
+        request (dict): A dict: {'id': request_id, 'data': {data for job}}
+        request_status_dict (dict): The dict that stores the status of requests
+        workdir (string): Full path to workdir
+
+    Returns:
+        NoneType
+    """
+
+    hardklor_results_cache = file_cache_lib.get_hardklor_results_cache()
+    if hardklor_results_cache is None:
+        return
+
+    # completed by an earlier run of this request
+    if has_hardklor_results(workdir):
+        return
+
+    cache_key = get_hardklor_results_cache_key(request, workdir)
+    found = hardklor_results_cache.link_files_into(cache_key, [__hardklor_results_file__], workdir)
+
+    print('Hardklor results cache', 'hit' if found else 'miss', 'for', get_spectr_file_id(request))
+    print('Hardklor results cache stats:', hardklor_results_cache.get_stats())
+
+    if found:
+        request_status_dict[request['id']]['end_user_message'] = 'Using cached Hardklor results'
+
+
+def has_hardklor_results(workdir):
+    """Check whether the Hardklor results are already in the workdir, i.e., they were found
+    in the cache before Hardklor was run
+
+    Parameters:
+        workdir (string): Full path to workdir
+
+    Returns:
+        bool
+    """
+
+    return os.path.exists(os.path.join(workdir, __hardklor_results_file__))
+
+
+def get_hardklor_results_cache_key(request, workdir):
+    """Get the key of this request's Hardklor results in the Hardklor results cache. Made from
+    the spectr file id, a hash of the written Hardklor config that ignores whitespace, comments
+    and parameter order, the format of the ms1 file and of its peaks, the number of Hardklor
+    processes the scans are split over and the Hardklor executable. The results of each are
+    expected to be the same, but are cached separately so a difference never goes unnoticed.
+
+    Parameters:
+        request (dict): A dict: {'id': request_id, 'data': {data for job}}
+        workdir (string): Full path to workdir
+
+    Returns:
+        string
+    """
+
+    with open(os.path.join(workdir, __hardklor_config_file__), 'r') as config_file:
+        hardklor_config_hash = hardklor_utils.get_hardklor_config_hash(config_file.read())
+
+    hardklor_executable = os.getenv(__hardklor_filter_executable_path_env_key__)
+
+    return '\t'.join([
+        get_spectr_file_id(request),
+        hardklor_config_hash,
+        peak_format_utils.get_peak_line_format(),
+        ms_file_utils.get_ms_file_format(),
+        str(hardklor_lib.get_hardklor_shard_count()),
+        hardklor_executable,
+        str(os.path.getmtime(hardklor_executable))
+    ])
 
 
 def execute_bullseye(request, request_status_dict, workdir):
@@ -153,15 +671,23 @@ def execute_bullseye(request, request_status_dict, workdir):
     bullseye_config_dict = bullseye_utils.convert_bullseye_config_to_dict(bullseye_config_data)
     print('Bullseye config:', bullseye_config_dict)
 
-    # the array to build for the executable passed to subprocess.run
-    execute_array = [bullseye_filter_executable]
-
-    # add any user CLI params
+    # the user's CLI params
+    bullseye_parameters = []
     for key, value in bullseye_config_dict.items():
         if value == 'true':
-            execute_array.extend(['-' + key])
+            bullseye_parameters.extend(['-' + key])
         elif value != 'false':
-            execute_array.extend(['-' + key, value])
+            bullseye_parameters.extend(['-' + key, value])
+
+    shard_count = bullseye_lib.get_bullseye_shard_count()
+
+    if shard_count > 1:
+        execute_bullseye_shards(bullseye_filter_executable, bullseye_parameters, shard_count, workdir,
+                                get_progress_callback(request, request_status_dict, 'Running Bullseye'))
+        return
+
+    # the array to build for the executable
+    execute_array = [bullseye_filter_executable] + bullseye_parameters
 
     # add rest of required CLI params
     execute_array.extend(
@@ -169,33 +695,75 @@ def execute_bullseye(request, request_status_dict, workdir):
             '-o',
             __bullseye_results_file__,
             __hardklor_results_file__,
-            __ms2_file__,
-            'matches.ms2',
-            'nomatches.ms2'
+            ms_file_utils.get_ms2_file_name(),
+            bullseye_lib.bullseye_matches_file,
+            bullseye_lib.bullseye_no_matches_file
         ]
     )
 
     print('Bullseye exec arr:', execute_array)
 
     # run bullseye
-    result = subprocess.run(
+    process_utils.run_process(
+        'Bullseye',
         execute_array,
-        cwd=workdir,
-        capture_output=True,
-        text=True,
-        encoding="ISO-8859-1"
+        workdir,
+        progress_callback=get_progress_callback(request, request_status_dict, 'Running Bullseye')
     )
-    print(result.stdout)
-    print(result.stderr)
 
     general_utils.verify_file_exists(os.path.join(workdir, __bullseye_results_file__))
 
-    if result.returncode != 0:
-        raise ValueError("Non-zero return code from Bullseye. Error message:", result.stderr)
+
+def execute_bullseye_shards(bullseye_filter_executable, bullseye_parameters, shard_count, workdir, progress_callback):
+    """Run Bullseye as several processes at the same time, each over the ms2 scans in its own
+    precursor m/z range and the Hardklor peaks they could match, and merge their results
+
+    Parameters:
+        bullseye_filter_executable (string): Full path to the Bullseye executable
+        bullseye_parameters (list): The user's command line parameters for Bullseye
+        shard_count (int): The number of Bullseye processes to run
+        workdir (string): Full path to workdir
+        progress_callback (function): Called with the progress of the shard furthest behind
+
+    Returns:
+        NoneType
+    """
+
+    shards = bullseye_lib.plan_bullseye_shards(workdir, shard_count)
+    print('Bullseye shard precursor m/z ranges:',
+          [(shard.min_precursor_mz, shard.max_precursor_mz) for shard in shards])
+
+    bullseye_lib.write_bullseye_shard_input_files(shards, workdir)
+    bullseye_lib.run_bullseye_shards(bullseye_filter_executable, bullseye_parameters, shards, workdir, progress_callback)
+    bullseye_lib.merge_bullseye_shard_results(shards, workdir)
+
+    general_utils.verify_file_exists(os.path.join(workdir, __bullseye_results_file__))
+
+
+def get_progress_callback(request, request_status_dict, message):
+    """Get a method that shows the progress of an external program in the request's status
+
+    Parameters:
+        request (dict): A dict: {'id': request_id, 'data': {data for job}}
+        request_status_dict (dict): The dict that stores the status of requests
+        message (string): The status message, e.g., 'Running Hardklor'
+
+    Returns:
+        function: Takes a process_utils.ProcessProgress
+    """
+
+    def show_progress(progress):
+        description = progress.get_description()
+        if description is not None:
+            request_status_dict[request['id']]['end_user_message'] = message + ' (' + description + ')'
+
+    return show_progress
 
 
 def move_data_to_final_destination(request, request_status_dict, workdir):
-    """Run Bullseye persistent feature detection
+    """Publish the Hardklor and Bullseye results and the Hardklor config to the final location.
+    Each file is checked against the sha256 recorded when it was written and is only seen under
+    its published name once complete. The sha256 of each published file is written next to it.
 
     Parameters:
         request (dict): A dict: {'id': request_id, 'data': {data for job}}
@@ -223,6 +791,100 @@ def move_data_to_final_destination(request, request_status_dict, workdir):
         raise ValueError('Attempting to move bullseye results that don\'t not exist:',
                          os.path.join(workdir, __bullseye_results_file__))
 
+    final_destination_dir = make_final_destination_dir(request)
+
+    # publish the result files to the final location, renamed if possible, else streamed and compressed if configured.
+    # the results are checked against the size and sha256 recorded when the step that wrote them completed
+    for step_name, filename in (('hardklor', __hardklor_results_file__), (None, __hardklor_config_file__),
+                                ('bullseye', __bullseye_results_file__)):
+        expected_file = None if step_name is None else \
+            checkpoint_lib.get_recorded_file(workdir, step_name, filename)
+
+        published_file = publish_lib.publish_file(os.path.join(workdir, filename), final_destination_dir,
+                                                  expected_file)
+
+        print('Published', published_file['path'], published_file['bytes'], 'bytes, sha256:',
+              published_file['sha256'])
+
+
+def publish_trace_files(request, workdir):
+    """Publish the trace of how the request was processed, and the profile if the profiler was
+    on, to the final location with the results. Swallows all exceptions but prints out error message
+
+    Parameters:
+        request (dict): A dict: {'id': request_id, 'data': {data for job}}
+        workdir (string): Full path to workdir
+
+    Returns:
+        NoneType
+    """
+
+    try:
+        final_destination_dir = make_final_destination_dir(request)
+
+        for filename in (__trace_file__, __profile_file__):
+            if os.path.exists(os.path.join(workdir, filename)):
+                published_file = publish_lib.publish_file(os.path.join(workdir, filename), final_destination_dir)
+                print('Published', published_file['path'], published_file['bytes'], 'bytes')
+
+    except Exception as e:
+        print('Error publishing trace files for request:', request['id'])
+        traceback.print_exc()
+
+
+def copy_results_to_final_destination(source_request, request):
+    """Copy the published results of one request to the final location of another, identical
+    request. Files are hardlinked if both are on the same filesystem.
+
+    Parameters:
+        source_request (dict): The request whose results were published
+        request (dict): The request to copy the results to
+
+    Returns:
+        NoneType
+    """
+
+    source_dir = make_final_destination_dir(source_request)
+    final_destination_dir = make_final_destination_dir(request)
+
+    for filename in (__hardklor_results_file__, __hardklor_config_file__, __bullseye_results_file__):
+        filename = publish_lib.get_published_file_name(filename)
+
+        for copied_filename in (filename, publish_lib.get_checksum_file_name(filename)):
+            file_cache_lib.link_or_copy_file(
+                os.path.join(source_dir, copied_filename),
+                os.path.join(final_destination_dir, copied_filename)
+            )
+
+            general_utils.verify_file_exists(os.path.join(final_destination_dir, copied_filename))
+
+    # the trace of how the results were made, if it was published
+    for filename in (__trace_file__, __profile_file__):
+        filename = publish_lib.get_published_file_name(filename)
+
+        for copied_filename in (filename, publish_lib.get_checksum_file_name(filename)):
+            if os.path.exists(os.path.join(source_dir, copied_filename)):
+                file_cache_lib.link_or_copy_file(
+                    os.path.join(source_dir, copied_filename),
+                    os.path.join(final_destination_dir, copied_filename)
+                )
+
+
+def make_final_destination_dir(request):
+    """Get the directory the results of a request are placed in, final_destination_dir/project_id/request_id/,
+    creating it if needed
+
+    Parameters:
+        request (dict): A dict: {'id': request_id, 'data': {data for job}}
+
+    Returns:
+        string
+    """
+
+    project_id = request['data']['project_id']
+    if project_id is None or not project_id:
+        raise ValueError("No project id found.")
+
     if os.getenv(__final_dir_env_key__) is None:
         raise ValueError('Final destination dir env var not defined:', __final_dir_env_key__)
 
@@ -233,31 +895,13 @@ def move_data_to_final_destination(request, request_status_dict, workdir):
     # place the resulting data in the final_destination_dir/project_id/
     final_destination_dir = os.path.join(final_destination_dir, str(project_id))
     if not os.path.exists(final_destination_dir):
-        os.mkdir(final_destination_dir)
+        os.makedirs(final_destination_dir, exist_ok=True)
 
     final_destination_dir = os.path.join(final_destination_dir, request['id'])
     if not os.path.exists(final_destination_dir):
         os.mkdir(final_destination_dir)
 
-    # move the result files to the final location
-    shutil.move(
-        os.path.join(workdir, __hardklor_results_file__),
-        os.path.join(final_destination_dir, __hardklor_results_file__)
-    )
-
-    shutil.move(
-        os.path.join(workdir, __hardklor_config_file__),
-        os.path.join(final_destination_dir, __hardklor_config_file__)
-    )
-
-    shutil.move(
-        os.path.join(workdir, __bullseye_results_file__),
-        os.path.join(final_destination_dir, __bullseye_results_file__)
-    )
-
-    general_utils.verify_file_exists(os.path.join(workdir, os.path.join(final_destination_dir, __hardklor_results_file__)))
-    general_utils.verify_file_exists(os.path.join(workdir, os.path.join(final_destination_dir, __hardklor_config_file__)))
-    general_utils.verify_file_exists(os.path.join(workdir, os.path.join(final_destination_dir, __bullseye_results_file__)))
+    return final_destination_dir
 
 
 def clean_workdir(workdir, success):
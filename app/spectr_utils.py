@@ -15,23 +15,34 @@
 #   limitations under the License.
 
 import os
-import requests
 import json
-from . import __spectr_get_scan_data_env_key__, __spectr_get_scan_numbers_env_key__
+import time
+from array import array
+from operator import itemgetter
+from . import general_utils, http_utils, json_stream_utils, metrics_lib
+from . import __spectr_get_scan_data_env_key__, __spectr_get_scan_numbers_env_key__, \
+    __spectr_max_concurrent_requests_env_key__, __spectr_max_concurrent_requests_default__
 
+# how many bytes of a scan data response to read from the network at a time
+_response_chunk_size = 65536
 
-def generate_ob_for_get_scan_numbers_post_request(scan_file_hash_key, scan_level):
-    """Generate the JSON to send to spectr to get the scan numbers for a scan level
+# accessors for the values of a parsed peak element
+_get_intensity = itemgetter('intensity')
+_get_mz = itemgetter('mz')
+
+
+def generate_ob_for_get_scan_numbers_post_request(scan_file_hash_key, scan_levels):
+    """Generate the JSON to send to spectr to get the scan numbers for one or more scan levels
 
     Parameters:
         scan_file_hash_key (string): The spectral file hash key for the spectral file
-        scan_level (int): The scan numbers in the file we want to get
+        scan_levels (list): The scan levels in the file we want to get the scan numbers for
 
     Returns:
         dict: A dict to send to spectr as JSON
     """
 
-    ob = {'scanFileAPIKey': scan_file_hash_key, 'scanLevelsToInclude': [scan_level]}
+    ob = {'scanFileAPIKey': scan_file_hash_key, 'scanLevelsToInclude': scan_levels}
 
     return ob
 
@@ -47,17 +58,32 @@ def get_scan_numbers_for_scan_level(scan_file_hash_key, scan_level):
         list: An array of scan numbers
     """
 
+    return get_scan_numbers_for_scan_levels(scan_file_hash_key, [scan_level])
+
+
+def get_scan_numbers_for_scan_levels(scan_file_hash_key, scan_levels):
+    """Get all scan numbers for any of the given scan levels in a given scan file, with a
+    single request to spectr
+
+    Parameters:
+        scan_file_hash_key (string): The spectral file hash key for the spectral file
+        scan_levels (list): The scan levels in the file we want to get the scan numbers for
+
+    Returns:
+        list: An array of scan numbers
+    """
+
     # request the scan data from spectr
     spectr_url = os.environ.get(__spectr_get_scan_numbers_env_key__)
     if spectr_url is None:
         raise ValueError('No ' + __spectr_get_scan_numbers_env_key__ + ' env variable is set.')
 
     # the json we're sending in the post request
-    ob_for_post = generate_ob_for_get_scan_numbers_post_request(scan_file_hash_key, scan_level)
+    ob_for_post = generate_ob_for_get_scan_numbers_post_request(scan_file_hash_key, scan_levels)
 
     # send the post request
     headers = {'Content-Type': 'application/json'}
-    response = requests.post(spectr_url, json=ob_for_post, headers=headers)
+    response = http_utils.get_http_client().post(spectr_url, json=ob_for_post, headers=headers)
 
     return parse_spectr_get_scan_numbers_response(response, scan_file_hash_key)
 
@@ -70,7 +96,7 @@ def parse_spectr_get_scan_numbers_response(response, scan_file_hash_key):
         scan_file_hash_key (string): The spectral file hash key for the spectral file
 
     Returns:
-        list: An array of MS2ScanData objects, one for each scan
+        list: An array of ScanData objects, one for each scan
     """
 
     # whoopsie, we got an error.
@@ -137,7 +163,27 @@ def get_scan_data_for_scan_numbers(scan_file_hash_key, scan_numbers):
         scan_numbers (list): The scan numbers in the file we want to get
 
     Returns:
-        list: An array of MS2ScanData objects, one for each scan
+        list: An array of ScanData objects, one for each scan
+    """
+
+    response = request_scan_data_for_scan_numbers(scan_file_hash_key, scan_numbers)
+
+    try:
+        return handle_spectr_success(response, scan_file_hash_key)
+    finally:
+        response.close()
+
+
+def request_scan_data_for_scan_numbers(scan_file_hash_key, scan_numbers):
+    """Send the request for scan data to spectr and wait for the response headers. The
+    body of the response is left unread so it may be parsed as it streams in.
+
+    Parameters:
+        scan_file_hash_key (string): The spectral file hash key for the spectral file
+        scan_numbers (list): The scan numbers in the file we want to get
+
+    Returns:
+        requests.Response: A successful response whose body has not been read yet
     """
 
     # request the scan data from spectr
@@ -150,9 +196,36 @@ def get_scan_data_for_scan_numbers(scan_file_hash_key, scan_numbers):
 
     # send the post request
     headers = {'Content-Type': 'application/json'}
-    response = requests.post(spectr_url, json=ob_for_post, headers=headers)
+    start_time = time.monotonic()
+    response = http_utils.get_http_client().post(spectr_url, json=ob_for_post, headers=headers, stream=True)
+    metrics_lib.spectr_batch_latency_seconds.observe(time.monotonic() - start_time)
+
+    # whoopsie, we got an error.
+    if response.status_code != 200:
+        try:
+            handle_spectr_error(response, scan_file_hash_key)
+        finally:
+            response.close()
+
+    return response
+
+
+def get_max_concurrent_requests():
+    """Get the number of batch requests that may be in flight to spectr at a time
+
+    Returns:
+        int
+    """
+
+    max_concurrent_requests = general_utils.get_int_env_var(
+        __spectr_max_concurrent_requests_env_key__,
+        __spectr_max_concurrent_requests_default__
+    )
 
-    return parse_spectr_response(response, scan_file_hash_key)
+    if max_concurrent_requests < 1:
+        raise ValueError('Must be at least 1:', __spectr_max_concurrent_requests_env_key__)
+
+    return max_concurrent_requests
 
 
 def parse_spectr_response(response, scan_file_hash_key):
@@ -163,7 +236,7 @@ def parse_spectr_response(response, scan_file_hash_key):
         scan_file_hash_key (string): The spectral file hash key for the spectral file
 
     Returns:
-        list: An array of MS2ScanData objects, one for each scan
+        list: An array of ScanData objects, one for each scan
     """
 
     # whoopsie, we got an error.
@@ -176,6 +249,21 @@ def parse_spectr_response(response, scan_file_hash_key):
 def handle_spectr_success(response, scan_file_hash_key):
     """Handle a response that is a spectr success
 
+    Parameters:
+        response (requests.Response): The requests.Response from the spectr get data query
+        scan_file_hash_key (string): The spectral file hash key for the spectral file
+
+    Returns:
+        list: An array of ScanData objects, one for each scan
+    """
+
+    return list(iterate_spectr_success(response, scan_file_hash_key))
+
+
+def iterate_spectr_success(response, scan_file_hash_key, response_stats=None):
+    """Incrementally parse a response that is a spectr success, yielding each scan as soon
+    as it has been read. Only one scan is held in memory at a time.
+
     example of successful response:
         {
             "status_scanFileAPIKeyNotFound":null,
@@ -203,57 +291,84 @@ def handle_spectr_success(response, scan_file_hash_key):
     Parameters:
         response (requests.Response): The requests.Response from the spectr get data query
         scan_file_hash_key (string): The spectral file hash key for the spectral file
+        response_stats (dict): If not None, 'bytes' and 'scans' are set to the size of the response
+                               body and the number of scans in it, once it has been read
 
     Returns:
-        list: An array of MS2ScanData objects, one for each scan
+        generator: Yields a ScanData object for each scan
     """
 
-    ms2_scan_data_objects = []
+    scan_count = 0
+    fetched_bytes = [0]
+    chunks = count_fetched_bytes(response.iter_content(chunk_size=_response_chunk_size), fetched_bytes)
 
-    response_ob = json.loads(response.text)
+    try:
+        for scan_ob in json_stream_utils.iterate_array_in_object(chunks, 'scans'):
+            scan_count += 1
+
+            ms2_scan_data = create_scan_data_from_scan_ob(scan_ob, scan_file_hash_key)
+
+            # if this scan has no peaks, do not include it
+            if ms2_scan_data is not None:
+                yield ms2_scan_data
+
+    finally:
+        metrics_lib.spectr_fetched_scans_total.inc(scan_count)
+
+        if response_stats is not None:
+            response_stats['bytes'] = fetched_bytes[0]
+            response_stats['scans'] = scan_count
+
+    if scan_count < 1:
+        raise ValueError('Got spectr success, but found no scan elements in response')
 
-    if 'scans' not in response_ob:
-        raise ValueError('Got spectr success, but found no scan elements in response', response.content)
 
-    scans = response_ob['scans']
+def count_fetched_bytes(chunks, fetched_bytes):
+    """Count the bytes of a response read from spectr, as they are read
 
-    if len(scans) < 1:
-        raise ValueError('Got spectr success, but found no scan elements in response', response.content)
+    Parameters:
+        chunks (iterable): The chunks of the response body, as bytes
+        fetched_bytes (list): A list of one int, the bytes are added to it
 
-    # parse each scan element, add it to the list of MS2ScanData objects we're returning
-    for scan_ob in scans:
-        msn_level = scan_ob['level']
-        scan_number = scan_ob['scanNumber']
-        retention_time_seconds = scan_ob['retentionTime']
-        precursor_charge = scan_ob['precursorCharge']
-        precursor_mz = scan_ob['precursor_M_Over_Z']
-        peak_list_intensity = []
-        peak_list_mz = []
+    Returns:
+        generator: Yields each chunk
+    """
 
-        peaks = scan_ob['peaks']
+    for chunk in chunks:
+        metrics_lib.spectr_fetched_bytes_total.inc(len(chunk))
+        fetched_bytes[0] += len(chunk)
+        yield chunk
 
-        # if this scan has no peaks, do not include it
-        if peaks is None or len(peaks) < 1:
-            continue
 
-        for peak_ob in peaks:
-            peak_list_intensity.append(peak_ob['intensity'])
-            peak_list_mz.append(peak_ob['mz'])
+def create_scan_data_from_scan_ob(scan_ob, scan_file_hash_key):
+    """Create a ScanData object from a parsed scan element of a spectr response
+
+    Parameters:
+        scan_ob (dict): A single parsed element of the scans array of a spectr response
+        scan_file_hash_key (string): The spectral file hash key for the spectral file
+
+    Returns:
+        ScanData: The scan data, or None if the scan has no peaks
+    """
 
-        ms2_scan_data = MS2ScanData(
-            scan_file_hash_key=scan_file_hash_key,
-            scan_number=scan_number,
-            msn_level=msn_level,
-            precursor_charge=precursor_charge,
-            precursor_mz=precursor_mz,
-            retention_time_seconds=retention_time_seconds,
-            peak_list_intensity=peak_list_intensity,
-            peak_list_mz=peak_list_mz
-        )
+    peaks = scan_ob['peaks']
 
-        ms2_scan_data_objects.append(ms2_scan_data)
+    if peaks is None or len(peaks) < 1:
+        return None
 
-    return ms2_scan_data_objects
+    peak_list_intensity = list(map(_get_intensity, peaks))
+    peak_list_mz = list(map(_get_mz, peaks))
+
+    return ScanData(
+        scan_file_hash_key=scan_file_hash_key,
+        scan_number=scan_ob['scanNumber'],
+        msn_level=scan_ob['level'],
+        precursor_charge=scan_ob['precursorCharge'],
+        precursor_mz=scan_ob['precursor_M_Over_Z'],
+        retention_time_seconds=scan_ob['retentionTime'],
+        peak_list_intensity=peak_list_intensity,
+        peak_list_mz=peak_list_mz
+    )
 
 
 def handle_spectr_error(response, scan_file_hash_key):
@@ -281,7 +396,23 @@ def handle_spectr_error(response, scan_file_hash_key):
     raise ValueError(error_text)
 
 
-class MS2ScanData:
+class ScanData:
+    """Compact container for the data of a single scan. Uses __slots__ rather than a per-instance
+    __dict__, and holds the peak list in contiguous arrays of doubles rather than lists of floats.
+    A peak list with integer values, which spectr sends for whole number intensities, is kept as
+    a list so the values are written as spectr sent them, e.g., 5292 rather than 5292.0."""
+
+    __slots__ = (
+        'scan_file_hash_key',
+        'scan_number',
+        'msn_level',
+        'retention_time_seconds',
+        'precursor_charge',
+        'precursor_mz',
+        'peak_list_intensity',
+        'peak_list_mz'
+    )
+
     def __init__(self,
                  scan_file_hash_key,
                  scan_number,
@@ -291,89 +422,40 @@ class MS2ScanData:
                  precursor_mz,
                  peak_list_intensity,
                  peak_list_mz):
-        """Create a MS2ScanData object
+        """Create a ScanData object
 
         Parameters:
             scan_file_hash_key (string): The spectral file hash key for the spectral file
             scan_number (int): Scan number for this scan
+            msn_level (int): The MSn level of this scan, e.g. 1 or 2
             retention_time_seconds (float): Retention time of this scan in seconds
             precursor_charge (int): Estimated charge of precursor ion
             precursor_mz (float): Measured m/z of precursor ion
-            peak_list_intensity (list): An array of peak list intensities
-            peak_list_mz (list): An array of peak list mz values
+            peak_list_intensity (iterable): The peak list intensities, stored as array('d') if all are floats
+            peak_list_mz (iterable): The peak list mz values, stored as array('d') if all are floats
 
         Returns:
-            Populated MS2ScanData object
+            Populated ScanData object
         """
-        self._scan_file_hash_key = scan_file_hash_key
-        self._scan_number = scan_number
-        self._msn_level = msn_level
-        self._precursor_charge = precursor_charge
-        self._precursor_mz = precursor_mz
-        self._retention_time_seconds = retention_time_seconds
-        self._peak_list_intensity = peak_list_intensity
-        self._peak_list_mz = peak_list_mz
-
-    @property
-    def scan_file_hash_key(self):
-        return self._scan_file_hash_key
-
-    @scan_file_hash_key.setter
-    def scan_file_hash_key(self, value):
-        self._scan_file_hash_key = value
-
-    @property
-    def scan_number(self):
-        return self._scan_number
-
-    @scan_number.setter
-    def scan_number(self, value):
-        self._scan_number = value
-
-    @property
-    def precursor_charge(self):
-        return self._precursor_charge
-
-    @precursor_charge.setter
-    def precursor_charge(self, value):
-        self._precursor_charge = value
-
-    @property
-    def precursor_mz(self):
-        return self._precursor_mz
-
-    @precursor_mz.setter
-    def precursor_mz(self, value):
-        self._precursor_mz = value
-
-    @property
-    def msn_level(self):
-        return self._msn_level
-
-    @msn_level.setter
-    def msn_level(self, value):
-        self._msn_level = value
-
-    @property
-    def retention_time_seconds(self):
-        return self._retention_time_seconds
-
-    @retention_time_seconds.setter
-    def retention_time_seconds(self, value):
-        self._retention_time_seconds = value
-
-    @property
-    def peak_list_intensity(self):
-        return self._peak_list_intensity
-
-    @peak_list_intensity.setter
-    def peak_list_intensity(self, value):
-        self._peak_list_intensity = value
-
-    @property
-    def peak_list_mz(self):
-        return self._peak_list_mz
-
-    @peak_list_mz.setter
-    def peak_list_mz(self, value):
-        self._peak_list_mz = value
+        self.scan_file_hash_key = scan_file_hash_key
+        self.scan_number = scan_number
+        self.msn_level = msn_level
+        self.retention_time_seconds = retention_time_seconds
+        self.precursor_charge = precursor_charge
+        self.precursor_mz = precursor_mz
+        self.peak_list_intensity = _as_peak_array(peak_list_intensity)
+        self.peak_list_mz = _as_peak_array(peak_list_mz)
+
+
+def _as_peak_array(values):
+    if isinstance(values, array) and values.typecode == 'd':
+        return values
+
+    if not isinstance(values, list):
+        values = list(values)
+
+    # array('d') would write integers with a trailing .0, unlike the files written from spectr's values
+    if set(map(type, values)) <= {float}:
+        return array('d', values)
+
+    return values
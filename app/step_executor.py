@@ -0,0 +1,126 @@
+"""Run the steps of the pipeline as a dependency graph, running independent steps at the same time"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from . import metrics_lib
+
+
+class PipelineStep:
+    def __init__(self, name, method, depends_on=()):
+        """Create a PipelineStep object
+
+        Parameters:
+            name (string): The unique name of this step
+            method (function): The method to call to run this step
+            depends_on (tuple): The names of the steps that must finish before this step starts
+
+        Returns:
+            Populated PipelineStep object
+        """
+        self.name = name
+        self.method = method
+        self.depends_on = tuple(depends_on)
+
+
+def run_steps(steps, *args):
+    """Run the supplied steps, each as soon as all the steps it depends on have finished.
+    If a step raises an exception no new steps are started, the steps already running are
+    allowed to finish and then the first exception is raised.
+
+    Parameters:
+        steps (list): The PipelineStep objects to run
+        args: The arguments passed to the method of every step
+
+    Returns:
+        NoneType
+    """
+
+    validate_steps(steps)
+
+    waiting_steps = list(steps)
+    finished_step_names = set()
+    running_futures = {}
+    first_exception = None
+
+    with ThreadPoolExecutor(max_workers=len(steps), thread_name_prefix='pipeline-step') as executor:
+        while True:
+            if first_exception is None:
+                for step in [s for s in waiting_steps if finished_step_names.issuperset(s.depends_on)]:
+                    waiting_steps.remove(step)
+                    running_futures[executor.submit(_run_step, step, args)] = step
+
+            if len(running_futures) < 1:
+                break
+
+            done_futures, _ = wait(running_futures, return_when=FIRST_COMPLETED)
+
+            for future in done_futures:
+                step = running_futures.pop(future)
+
+                if future.exception() is not None:
+                    if first_exception is None:
+                        first_exception = future.exception()
+                else:
+                    finished_step_names.add(step.name)
+
+    if first_exception is not None:
+        raise first_exception
+
+
+def validate_steps(steps):
+    """Ensure step names are unique, all dependencies exist and there are no cycles
+
+    Parameters:
+        steps (list): The PipelineStep objects to run
+
+    Returns:
+        NoneType
+    """
+
+    step_names = [step.name for step in steps]
+    if len(set(step_names)) != len(step_names):
+        raise ValueError('Duplicate pipeline step names:', step_names)
+
+    for step in steps:
+        for dependency in step.depends_on:
+            if dependency not in step_names:
+                raise ValueError('Pipeline step ' + step.name + ' depends on unknown step:', dependency)
+
+    # repeatedly remove the steps whose dependencies have all been removed, anything left is in a cycle
+    remaining_steps = list(steps)
+    removed_step_names = set()
+
+    while len(remaining_steps) > 0:
+        ready_steps = [s for s in remaining_steps if removed_step_names.issuperset(s.depends_on)]
+        if len(ready_steps) < 1:
+            raise ValueError('Pipeline steps have a dependency cycle:', [s.name for s in remaining_steps])
+
+        for step in ready_steps:
+            remaining_steps.remove(step)
+            removed_step_names.add(step.name)
+
+
+def _run_step(step, args):
+    start_time = time.monotonic()
+    print('Starting pipeline step:', step.name)
+
+    step.method(*args)
+
+    duration_seconds = time.monotonic() - start_time
+    metrics_lib.pipeline_step_duration_seconds.observe(duration_seconds, step.name)
+
+    print('Finished pipeline step:', step.name, 'in', round(duration_seconds, 1), 'seconds')
@@ -0,0 +1,258 @@
+"""A structured trace of how a request was processed, written to its workdir as JSON lines"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import collections
+import json
+import os
+import sys
+import threading
+import time
+from . import general_utils, step_executor, __trace_file__, __profile_file__, \
+    __trace_profile_interval_ms_env_key__, __trace_profile_interval_ms_default__
+
+# the traces of the requests being processed, by workdir
+_traces = {}
+_traces_lock = threading.Lock()
+
+
+def start_request_trace(request_id, workdir):
+    """Start the trace of a request, appending to the trace file in its workdir so an interrupted
+    run and its resumption are in the same trace. Starts the sampling profiler if it is configured.
+
+    Parameters:
+        request_id (string): The id of the request
+        workdir (string): Full path to workdir
+
+    Returns:
+        RequestTrace
+    """
+
+    trace = RequestTrace(request_id, workdir)
+
+    with _traces_lock:
+        _traces[workdir] = trace
+
+    return trace
+
+
+def get_request_trace(workdir):
+    """Get the trace of the request being processed in a workdir
+
+    Parameters:
+        workdir (string): Full path to workdir
+
+    Returns:
+        RequestTrace: The trace, or None if the request is not being traced
+    """
+
+    with _traces_lock:
+        return _traces.get(workdir)
+
+
+def get_traced_step(step, trace):
+    """Get a pipeline step that records when it starts and ends in the trace, with the size of
+    each file in the workdir when it ends
+
+    Parameters:
+        step (step_executor.PipelineStep): The step to trace
+        trace (RequestTrace): The trace to record to
+
+    Returns:
+        step_executor.PipelineStep
+    """
+
+    def run_traced_step(request, request_status_dict, workdir):
+        trace.record('step_start', step=step.name)
+        start_time = time.monotonic()
+
+        try:
+            step.method(request, request_status_dict, workdir)
+
+        except Exception as e:
+            trace.record('step_end', step=step.name, seconds=time.monotonic() - start_time, error=str(e))
+            raise
+
+        trace.record('step_end', step=step.name, seconds=time.monotonic() - start_time,
+                     file_sizes=get_file_sizes(workdir))
+
+    return step_executor.PipelineStep(step.name, run_traced_step, step.depends_on)
+
+
+def get_file_sizes(workdir):
+    """Get the size of each file in the workdir, not including those in subdirectories
+
+    Parameters:
+        workdir (string): Full path to workdir
+
+    Returns:
+        dict: filename -> size in bytes
+    """
+
+    file_sizes = {}
+
+    with os.scandir(workdir) as entries:
+        for entry in entries:
+            if entry.is_file():
+                file_sizes[entry.name] = entry.stat().st_size
+
+    return file_sizes
+
+
+def get_profile_interval_ms():
+    """Get how often the sampling profiler samples the stacks of the Python threads, 0 if it is off
+
+    Returns:
+        int
+    """
+
+    profile_interval_ms = general_utils.get_int_env_var(__trace_profile_interval_ms_env_key__,
+                                                        __trace_profile_interval_ms_default__)
+    if profile_interval_ms < 0:
+        raise ValueError('Must be at least 0:', __trace_profile_interval_ms_env_key__)
+
+    return profile_interval_ms
+
+
+class RequestTrace:
+    def __init__(self, request_id, workdir):
+        """Create a RequestTrace object. Each event is a line of JSON with the time it happened,
+        the event name and its values, written as it is recorded so the trace of a run that
+        died is complete up to that point.
+
+        Parameters:
+            request_id (string): The id of the request
+            workdir (string): Full path to workdir
+
+        Returns:
+            Populated RequestTrace object
+        """
+        self.request_id = request_id
+        self.workdir = workdir
+        self._lock = threading.Lock()
+        self._trace_file = open(os.path.join(workdir, __trace_file__), 'a', buffering=1)
+
+        profile_interval_ms = get_profile_interval_ms()
+        self._profiler = None if profile_interval_ms < 1 else SamplingProfiler(profile_interval_ms / 1000)
+
+    def record(self, event, **values):
+        """Record an event
+
+        Parameters:
+            event (string): The name of the event, e.g., 'step_start'
+            values: The values of the event, must be JSON serializable
+
+        Returns:
+            NoneType
+        """
+
+        line = json.dumps(dict({'time': time.time(), 'event': event}, **values)) + '\n'
+
+        with self._lock:
+            if not self._trace_file.closed:
+                self._trace_file.write(line)
+
+    def close(self):
+        """Stop tracing the request. The stacks sampled by the profiler are written to the
+        profile file in the workdir, one line per stack with the number of times it was seen.
+
+        Returns:
+            NoneType
+        """
+
+        with _traces_lock:
+            if _traces.get(self.workdir) is self:
+                del _traces[self.workdir]
+
+        if self._profiler is not None:
+            self._profiler.stop()
+            self._profiler.write(os.path.join(self.workdir, __profile_file__))
+
+        with self._lock:
+            self._trace_file.close()
+
+
+class SamplingProfiler:
+    def __init__(self, interval_seconds):
+        """Create a SamplingProfiler object, which samples the stack of every Python thread at a
+        fixed interval in a thread of its own until stopped. The stacks of all threads in the
+        service are sampled, so those of other requests being processed at the same time are
+        included.
+
+        Parameters:
+            interval_seconds (float): The time between samples
+
+        Returns:
+            Populated SamplingProfiler object
+        """
+        self._interval_seconds = interval_seconds
+        self._stop_event = threading.Event()
+
+        # the folded stack, root first and separated by ';' -> the number of times it was sampled
+        self._stack_counts = collections.Counter()
+
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling
+
+        Returns:
+            NoneType
+        """
+
+        self._stop_event.set()
+        self._thread.join()
+
+    def write(self, profile_path):
+        """Write the sampled stacks in the folded format read by flame graph tools
+
+        Parameters:
+            profile_path (string): Full path to the file to write
+
+        Returns:
+            NoneType
+        """
+
+        with open(profile_path, 'w') as profile_file:
+            for stack, count in self._stack_counts.most_common():
+                profile_file.write(stack + ' ' + str(count) + '\n')
+
+    def _run(self):
+        thread_names = {}
+        own_thread_id = threading.get_ident()
+
+        while not self._stop_event.wait(self._interval_seconds):
+            for thread in threading.enumerate():
+                thread_names[thread.ident] = thread.name
+
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+
+                self._stack_counts[self._get_folded_stack(thread_names.get(thread_id, str(thread_id)), frame)] += 1
+
+    @staticmethod
+    def _get_folded_stack(thread_name, frame):
+        stack = []
+
+        while frame is not None:
+            code = frame.f_code
+            stack.append(os.path.basename(code.co_filename) + ':' + code.co_name)
+            frame = frame.f_back
+
+        stack.append(thread_name)
+
+        return ';'.join(reversed(stack))
@@ -48,13 +48,15 @@ def _generate_json_for_status_request(request_id, status_text, message_text=None
     return response_json
 
 
-def get_json_for_status_request(status_request_data, request_queue, request_status_dict):
-    """Return the JSON to respond to a status request
+def get_json_for_status_request(status_request_data, request_queue, request_status_dict, in_flight_requests):
+    """Return the JSON to respond to a status request. A request attached to an identical
+    request reports the status of that request until it is finished.
 
     Parameters:
         status_request_data (dict): A string containing the request as json
-        request_queue (list): The request queue, an array of dicts: {'id': request_id, 'data': xml_request}
+        request_queue (RequestQueue): The request queue of dicts: {'id': request_id, 'data': xml_request}
         request_status_dict (dict): A dict containing status information
+        in_flight_requests (InFlightRequests): The index of queued and processing requests
 
     Returns:
         dict: A dict representing the assembled JSON object
@@ -63,27 +65,36 @@ def get_json_for_status_request(status_request_data, request_queue, request_stat
     request_id = status_request_data['request_id']
     project_id = status_request_data['project_id']
 
-    if request_id not in request_status_dict:
-        return _generate_json_for_status_request(request_id, 'not found')
+    # hold the lock so a worker can not take the request off the queue while we look for it
+    with request_queue.lock:
+        if request_id not in request_status_dict:
+            return _generate_json_for_status_request(request_id, 'not found')
 
-    if project_id != request_status_dict[request_id]['project_id']:
-        return _generate_json_for_status_request(request_id, 'error', 'Project id does not match.')
+        if project_id != request_status_dict[request_id]['project_id']:
+            return _generate_json_for_status_request(request_id, 'error', 'Project id does not match.')
 
-    if request_status_dict[request_id]['status'] == 'queued':
-        queue_position = get_queue_position(request_id, request_queue)
-        request_status_dict[request_id]['message'] = str(queue_position)
+        # the id of the request that is actually being run for this request
+        run_request_id = in_flight_requests.get_leader_id(request_id) or request_id
 
-    if request_status_dict[request_id]['status'] == 'processing':
-        if 'end_user_message' in request_status_dict[request_id]:
-            request_status_dict[request_id]['message'] = request_status_dict[request_id]['end_user_message']
-        else:
-            request_status_dict[request_id]['message'] = 'Processing request'
+        if request_status_dict[run_request_id]['status'] == 'queued':
+            queue_position = get_queue_position(run_request_id, request_queue)
+            request_status_dict[run_request_id]['message'] = str(queue_position)
 
-    return _generate_json_for_status_request(
-        request_id,
-        request_status_dict[request_id]['status'],
-        request_status_dict[request_id]['message']
-    )
+        if request_status_dict[run_request_id]['status'] == 'processing':
+            if 'end_user_message' in request_status_dict[run_request_id]:
+                request_status_dict[run_request_id]['message'] = request_status_dict[run_request_id]['end_user_message']
+            else:
+                request_status_dict[run_request_id]['message'] = 'Processing request'
+
+        # the results of the request that was run are still being copied to this request's final location
+        if run_request_id != request_id and request_status_dict[run_request_id]['status'] in ('success', 'error'):
+            return _generate_json_for_status_request(request_id, 'processing', 'Copying data to final location')
+
+        return _generate_json_for_status_request(
+            request_id,
+            request_status_dict[run_request_id]['status'],
+            request_status_dict[run_request_id]['message']
+        )
 
 
 def get_queue_position(request_id, request_queue):
@@ -91,14 +102,14 @@ def get_queue_position(request_id, request_queue):
 
     Parameters:
         request_id (string): The request id
-        request_queue (list): The request queue, an array of dicts: {'id': request_id, 'data': xml_request}
+        request_queue (RequestQueue): The request queue of dicts: {'id': request_id, 'data': xml_request}
 
     Returns:
         int: The 1-based position of the request_id in the request queue
     """
-    for idx, request_ob in enumerate(request_queue):
-        if request_ob['id'] == request_id:
-            return idx + 1
+    queue_position = request_queue.get_position(request_id)
+    if queue_position is not None:
+        return queue_position
 
     print('Error getting queue position:')
     print('request_id', request_id)
@@ -107,13 +118,16 @@ def get_queue_position(request_id, request_queue):
     raise ValueError('Did not find request in request queue')
 
 
-def cancel_conversion_request(cancel_request_data, request_queue, request_status_dict):
-    """Remove the supplied request_id from the request_queue and request_status_dict
+def cancel_conversion_request(cancel_request_data, request_queue, request_status_dict, in_flight_requests):
+    """Remove the supplied request_id from the request_queue and request_status_dict. A request
+    attached to an identical request is detached from it. A queued request with other requests
+    attached is replaced in the queue by the first of them.
 
     Parameters:
         cancel_request_data (dict): The cancel request: {'request_id': request_id, 'project_id': project_id}
-        request_queue (list): The request queue, an array of dicts: {'id': request_id, 'data': xml_request}
+        request_queue (RequestQueue): The request queue of dicts: {'id': request_id, 'data': xml_request}
         request_status_dict (dict): The dict that stores the status of requests
+        in_flight_requests (InFlightRequests): The index of queued and processing requests
 
     Returns:
         dict: A simple dict in the form of {'cancel_message': <cancel message>}
@@ -122,27 +136,16 @@ def cancel_conversion_request(cancel_request_data, request_queue, request_status
     request_id = cancel_request_data['request_id']
     project_id = cancel_request_data['project_id']
 
-    if request_id not in request_status_dict:
-        return {'cancel_message': 'Request id not found.'}
-
-    if project_id != request_status_dict[request_id]['project_id']:
-        return {'cancel_message': 'Project id does not match.'}
-
-    # get index of request to remove
-    idx = 0
-    found = False
-    for request in request_queue:
-        if request['id'] == request_id:
-            found = True
-            break
+    with request_queue.lock:
+        if request_id not in request_status_dict:
+            return {'cancel_message': 'Request id not found.'}
 
-        idx += 1
+        if project_id != request_status_dict[request_id]['project_id']:
+            return {'cancel_message': 'Project id does not match.'}
 
-    if not found:
-        return {'cancel_message': 'Request id not found.'}
-    else:
-        request_queue.pop(idx)
+        if not in_flight_requests.cancel(request_id):
+            return {'cancel_message': 'Request id not found.'}
 
-    del request_status_dict[request_id]
+        del request_status_dict[request_id]
 
     return {'cancel_message': 'Removed.'}
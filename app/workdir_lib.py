@@ -0,0 +1,273 @@
+"""Methods for placing the working directory of each request on disk or on a memory backed filesystem"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import threading
+import traceback
+from . import general_utils, hardklor_lib, bullseye_lib, ms_file_utils, __workdir_env_key__, \
+    __ram_workdir_env_key__, __ram_workdir_max_size_mb_env_key__, __ram_workdir_max_size_mb_default__, \
+    __ram_workdir_ms1_peaks_per_scan_env_key__, __ram_workdir_ms1_peaks_per_scan_default__, \
+    __ram_workdir_ms2_peaks_per_scan_env_key__, __ram_workdir_ms2_peaks_per_scan_default__
+
+# estimated bytes per peak in the ms1 and ms2 files of each format. text assumes full precision values
+_bytes_per_peak = {
+    'text': 32,
+    'binary': 12,
+    'compressed': 10
+}
+
+# estimated bytes per scan in the ms1 and ms2 files, besides the peaks
+_bytes_per_scan = 128
+
+# estimated bytes of Hardklor results per ms1 scan
+_hardklor_results_bytes_per_ms1_scan = 4096
+
+# the memory budget shared by all threads, created on first use
+_ram_workdir_budget = None
+_ram_workdir_budget_lock = threading.Lock()
+
+
+def get_ram_workdir_budget():
+    """Get the shared budget for work directories on the memory backed filesystem
+
+    Returns:
+        RamWorkdirBudget: The budget, or None if no memory backed work directory is configured
+    """
+
+    global _ram_workdir_budget
+
+    ram_workdir_parent = os.getenv(__ram_workdir_env_key__)
+    if ram_workdir_parent is None or not ram_workdir_parent:
+        return None
+
+    with _ram_workdir_budget_lock:
+        if _ram_workdir_budget is None:
+            max_size_mb = general_utils.get_int_env_var(__ram_workdir_max_size_mb_env_key__,
+                                                        __ram_workdir_max_size_mb_default__)
+            if max_size_mb < 1:
+                raise ValueError('Must be at least 1:', __ram_workdir_max_size_mb_env_key__)
+
+            _ram_workdir_budget = RamWorkdirBudget(ram_workdir_parent, max_size_mb * 1024 * 1024)
+
+        return _ram_workdir_budget
+
+
+class RamWorkdirBudget:
+    def __init__(self, ram_workdir_parent, max_bytes):
+        """Create a RamWorkdirBudget object, which shares a fixed amount of space on a memory
+        backed filesystem among the work directories of the requests being processed. Each
+        request reserves its estimated size up front and releases it when it is finished.
+
+        Parameters:
+            ram_workdir_parent (string): Full path to the directory to create work directories in, created if needed
+            max_bytes (int): The maximum total estimated size of all work directories in memory
+
+        Returns:
+            Populated RamWorkdirBudget object
+        """
+        self.ram_workdir_parent = ram_workdir_parent
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+        # request id -> reserved bytes
+        self._reservations = {}
+        self._reserved_bytes = 0
+
+        self._ram_workdirs = 0
+        self._disk_workdirs = 0
+
+        os.makedirs(ram_workdir_parent, exist_ok=True)
+
+    def reserve(self, request_id, estimated_bytes):
+        """Reserve space for a request's work directory if its estimated size fits in what is
+        left of the budget and in the free space of the memory backed filesystem
+
+        Parameters:
+            request_id (string): The id of the request
+            estimated_bytes (int): The estimated size of the request's work directory
+
+        Returns:
+            bool: True if the space was reserved and the work directory should be placed in memory
+        """
+
+        with self._lock:
+            fits = self._reserved_bytes + estimated_bytes <= self._max_bytes and \
+                estimated_bytes <= shutil.disk_usage(self.ram_workdir_parent).free
+
+            if not fits:
+                self._disk_workdirs += 1
+                return False
+
+            self._reservations[request_id] = estimated_bytes
+            self._reserved_bytes += estimated_bytes
+            self._ram_workdirs += 1
+
+            return True
+
+    def release(self, request_id):
+        """Release the space reserved for a request's work directory
+
+        Parameters:
+            request_id (string): The id of the request
+
+        Returns:
+            bool: True if space was reserved for the request
+        """
+
+        with self._lock:
+            if request_id not in self._reservations:
+                return False
+
+            self._reserved_bytes -= self._reservations.pop(request_id)
+
+            return True
+
+    def get_stats(self):
+        """Get the counters for this budget
+
+        Returns:
+            dict: {'ram_workdirs', 'disk_workdirs', 'reservations', 'reserved_bytes', 'max_bytes'}
+        """
+
+        with self._lock:
+            return {
+                'ram_workdirs': self._ram_workdirs,
+                'disk_workdirs': self._disk_workdirs,
+                'reservations': len(self._reservations),
+                'reserved_bytes': self._reserved_bytes,
+                'max_bytes': self._max_bytes
+            }
+
+
+def estimate_workdir_size(ms1_scan_count, ms2_scan_count):
+    """Estimate the largest size the work directory of a request reaches, from its numbers of
+    scans and the configured average numbers of peaks per scan. Counts the ms1 and ms2 files,
+    the Hardklor results, the matches and no matches files Bullseye writes and the copies
+    made to run Hardklor and Bullseye as several processes.
+
+    Parameters:
+        ms1_scan_count (int): The number of ms1 scans in the spectral file
+        ms2_scan_count (int): The number of ms2 scans in the spectral file
+
+    Returns:
+        int: The estimated size in bytes
+    """
+
+    ms1_peaks_per_scan = general_utils.get_int_env_var(__ram_workdir_ms1_peaks_per_scan_env_key__,
+                                                       __ram_workdir_ms1_peaks_per_scan_default__)
+    ms2_peaks_per_scan = general_utils.get_int_env_var(__ram_workdir_ms2_peaks_per_scan_env_key__,
+                                                       __ram_workdir_ms2_peaks_per_scan_default__)
+    bytes_per_peak = _bytes_per_peak[ms_file_utils.get_ms_file_format()]
+
+    ms1_file_bytes = ms1_scan_count * (_bytes_per_scan + ms1_peaks_per_scan * bytes_per_peak)
+    ms2_file_bytes = ms2_scan_count * (_bytes_per_scan + ms2_peaks_per_scan * bytes_per_peak)
+    hardklor_results_bytes = ms1_scan_count * _hardklor_results_bytes_per_ms1_scan
+
+    # bullseye writes every ms2 scan to either the matches or the no matches file, as text
+    bullseye_output_bytes = ms2_scan_count * (_bytes_per_scan + ms2_peaks_per_scan * _bytes_per_peak['text'])
+
+    estimated_bytes = ms1_file_bytes + ms2_file_bytes + hardklor_results_bytes + bullseye_output_bytes
+
+    # shard inputs and outputs are on disk alongside the merged files until the merge finishes
+    if hardklor_lib.get_hardklor_shard_count() > 1:
+        estimated_bytes += hardklor_results_bytes
+
+    if bullseye_lib.get_bullseye_shard_count() > 1:
+        estimated_bytes += ms2_file_bytes + hardklor_results_bytes + bullseye_output_bytes
+
+    return estimated_bytes
+
+
+def get_workdir_parent(request_id, get_estimated_bytes):
+    """Choose the directory to create a request's work directory in: the memory backed work
+    directory if it is configured and the estimated size of the request's work directory fits
+    in the memory budget, else the disk work directory. If an earlier, interrupted run of the
+    request left its work directory, the disk work directory is chosen without estimating the
+    size. One left in memory is moved to disk, as no memory was reserved for it in this run.
+    If the size cannot be estimated, the disk work directory is chosen.
+
+    Parameters:
+        request_id (string): The id of the request
+        get_estimated_bytes (function): Takes no arguments and returns the estimated size of the
+                                        work directory, only called if memory backed work
+                                        directories are configured and the request has no work
+                                        directory yet
+
+    Returns:
+        string: Full path to the directory
+    """
+
+    disk_workdir_parent = os.getenv(__workdir_env_key__)
+    ram_workdir_budget = get_ram_workdir_budget()
+
+    if os.path.exists(os.path.join(disk_workdir_parent, request_id)) or ram_workdir_budget is None:
+        return disk_workdir_parent
+
+    ram_workdir = os.path.join(ram_workdir_budget.ram_workdir_parent, request_id)
+    if os.path.exists(ram_workdir):
+        print('Moving work directory of interrupted request from memory to disk:', ram_workdir)
+        shutil.move(ram_workdir, os.path.join(disk_workdir_parent, request_id))
+
+        return disk_workdir_parent
+
+    try:
+        estimated_bytes = get_estimated_bytes()
+
+    except Exception as e:
+        print('Error estimating the size of the work directory, placing it on disk')
+        traceback.print_exc()
+
+        return disk_workdir_parent
+
+    if ram_workdir_budget.reserve(request_id, estimated_bytes):
+        print('Placing work directory in memory, estimated size:', estimated_bytes, 'bytes')
+        print('Memory work directory stats:', ram_workdir_budget.get_stats())
+
+        return ram_workdir_budget.ram_workdir_parent
+
+    print('Placing work directory on disk, estimated size', estimated_bytes, 'bytes does not fit in memory')
+
+    return disk_workdir_parent
+
+
+def release_workdir(request_id, workdir):
+    """Release the memory reserved for a request's work directory. A work directory still in
+    memory, because work directories are being kept, is moved to the disk work directory so it
+    stops using memory. Swallows all exceptions but prints out error message
+
+    Parameters:
+        request_id (string): The id of the request
+        workdir (string): Full path to the request's work directory, may be None
+
+    Returns:
+        NoneType
+    """
+
+    try:
+        ram_workdir_budget = get_ram_workdir_budget()
+        if ram_workdir_budget is None or not ram_workdir_budget.release(request_id):
+            return
+
+        if workdir is not None and os.path.exists(workdir):
+            disk_workdir = os.path.join(os.getenv(__workdir_env_key__), os.path.basename(workdir))
+            print('Moving kept work directory from memory to disk:', disk_workdir)
+
+            shutil.move(workdir, disk_workdir)
+
+    except Exception as e:
+        print('Error releasing work directory:', workdir)
+        traceback.print_exc()
@@ -15,12 +15,13 @@
 #   limitations under the License.
 
 import os
-from flask import Flask, request
+import signal
+import sys
+from flask import Flask, Response, request
 from flask_restful import Resource, Api
 from datetime import datetime
-import threading
-from app import general_utils, web_service_utils, request_handler, request_status_dict, request_queue, \
-    request_queue_status, __webapp_port_env_key__
+from app import general_utils, metrics_lib, web_service_utils, request_handler, request_status_dict, request_queue, \
+    in_flight_requests, job_store, __webapp_port_env_key__
 
 app = Flask(__name__)
 api = Api(app)
@@ -35,7 +36,12 @@ class CancelFeatureDetectionRunRequest(Resource):
         if 'request_id' not in json_data or 'project_id' not in json_data:
             return 'Required data not present', 400
 
-        return web_service_utils.cancel_conversion_request(json_data, request_queue, request_status_dict), 200
+        return web_service_utils.cancel_conversion_request(
+            json_data,
+            request_queue,
+            request_status_dict,
+            in_flight_requests
+        ), 200
 
 
 class RequestFeatureDetectionRunStatus(Resource):
@@ -47,7 +53,12 @@ class RequestFeatureDetectionRunStatus(Resource):
         if 'request_id' not in json_data or 'project_id' not in json_data:
             return 'Required data not present', 400
 
-        return web_service_utils.get_json_for_status_request(json_data, request_queue, request_status_dict), 200
+        return web_service_utils.get_json_for_status_request(
+            json_data,
+            request_queue,
+            request_status_dict,
+            in_flight_requests
+        ), 200
 
 
 class RequestFeatureDetectionRun(Resource):
@@ -80,33 +91,69 @@ class RequestFeatureDetectionRun(Resource):
         request_data['bullseye_conf'] = bullseye_conf
         request_data['project_id'] = project_id
 
-        request_queue.append({'id': request_id, 'data': request_data})
-        request_status_dict[request_id] = {
-            'project_id': project_id,
-            'status': 'queued',
-            'message': None
-        }
+        with request_queue.lock:
+            request_status_dict[request_id] = {
+                'project_id': project_id,
+                'status': 'queued',
+                'message': None,
+                'data': request_data
+            }
+            leader_id = in_flight_requests.submit({'id': request_id, 'data': request_data})
 
-        if not request_queue_status['started']:
-            request_queue_status['started'] = True
-
-            # start request processor in a separate thread
-            thread = threading.Thread(
-                target=request_handler.process_request_queue,
-                args=(request_queue, request_status_dict)
-            )
-            thread.start()
+        if leader_id is not None:
+            print('\tattached to identical request:', leader_id)
 
         return {'request_id': request_id}, 200
 
 
+class Metrics(Resource):
+    """Web service for retrieving metrics in the Prometheus text format"""
+
+    def get(self):
+        return Response(metrics_lib.render_metrics(), content_type=metrics_lib.content_type)
+
+
 api.add_resource(RequestFeatureDetectionRun, '/requestFeatureDetectionRun')
 api.add_resource(RequestFeatureDetectionRunStatus, '/requestFeatureDetectionRunStatus')
 api.add_resource(CancelFeatureDetectionRunRequest, '/cancelFeatureDetectionRunRequest')
+api.add_resource(Metrics, '/metrics')
+
+metrics_lib.request_queue_depth.set_function(lambda: {(): len(request_queue)})
+
+
+def handle_shutdown_signal(signal_number, frame):
+    """Stop serving web requests when the container is stopped, so the request workers can
+    finish the requests they are processing before the service exits
+
+    Parameters:
+        signal_number (int): The signal that was received
+        frame (frame): The current stack frame
+
+    Returns:
+        NoneType
+    """
+    print('Got signal', signal_number, 'shutting down')
+    sys.exit(0)
+
 
 if __name__ == '__main__':
 
     port = os.getenv(__webapp_port_env_key__)
     if port is None:
         raise ValueError('No port is defined by env. var.: ' + __webapp_port_env_key__)
-    app.run(debug=False, host="0.0.0.0", port=int(port))
+
+    # queue the requests that had not finished when the service last stopped
+    if job_store is not None:
+        request_handler.requeue_unfinished_requests(job_store, request_status_dict, in_flight_requests)
+
+    # start request processors in separate threads
+    worker_threads = request_handler.start_request_workers(request_queue, request_status_dict, in_flight_requests)
+
+    signal.signal(signal.SIGTERM, handle_shutdown_signal)
+    signal.signal(signal.SIGINT, handle_shutdown_signal)
+
+    try:
+        app.run(debug=False, host="0.0.0.0", port=int(port))
+    finally:
+        # let the requests being processed finish before exiting
+        request_handler.stop_request_workers(worker_threads, request_queue)
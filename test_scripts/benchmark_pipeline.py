@@ -0,0 +1,477 @@
+"""Benchmark the entire pipeline against a local stand-in for spectr that serves synthetic scans"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# Usage, from the root of the repository:
+#
+#   python test_scripts/benchmark_pipeline.py --ms1-scans 500 --latency-ms 20 --output benchmark.json
+#
+# Each run submits a request and processes it with request_handler.process_request, as a request
+# worker would, then reads the trace the request published to report scans/sec, MB/sec, spectr batch
+# latency, peak RSS and the wall time of each pipeline step. Settings of the service not given on the
+# command line are read from the environment, e.g., MS_FILE_FORMAT or HARDKLOR_SHARDS, so the same
+# benchmark can be compared across settings and across commits. The caches and the job store are
+# turned off so every run does all the work.
+
+import argparse
+import bisect
+import functools
+import gzip
+import http.server
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+test_scripts_dir = os.path.dirname(os.path.abspath(__file__))
+
+# the paths the stand-in for spectr serves scan numbers and scan data on
+scan_numbers_path = '/getScanNumbers'
+scan_data_path = '/getScanData'
+
+# the number of bytes of a response written at a time
+response_chunk_size = 65536
+
+# synthetic peptide features: how long each elutes for, in seconds, and how many isotope peaks each has
+feature_elution_seconds = 30.0
+feature_isotope_count = 4
+seconds_per_scan = 0.2
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--ms1-scans', type=int, default=500, help='Number of MS1 scans in the synthetic file')
+    parser.add_argument('--ms2-per-ms1', type=int, default=4, help='Number of MS2 scans after each MS1 scan')
+    parser.add_argument('--ms1-peaks', type=int, default=2000, help='Number of peaks in each MS1 scan')
+    parser.add_argument('--ms2-peaks', type=int, default=200, help='Number of peaks in each MS2 scan')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Delay before spectr responds to each request')
+    parser.add_argument('--batch-size', type=int, default=100, help='Value of SPECTR_BATCH_SIZE')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of times to run the pipeline')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for the synthetic scans')
+    parser.add_argument('--hardklor', default=os.getenv('HARDKLOR_EXEC_PATH', os.path.join(repo_dir, 'bin', 'hardklor')),
+                        help='Path to the Hardklor executable')
+    parser.add_argument('--bullseye', default=os.getenv('BULLSEYE_EXEC_PATH', os.path.join(repo_dir, 'bin', 'bullseye')),
+                        help='Path to the Bullseye executable')
+    parser.add_argument('--output', default='benchmark_results.json', help='File to write the results to, as JSON')
+
+    return parser.parse_args()
+
+
+class SyntheticSpectralFile:
+    def __init__(self, ms1_scans, ms2_per_ms1, ms1_peaks, ms2_peaks, seed):
+        """Create a SyntheticSpectralFile object, a spectral file made up from a seed. Every
+        ms2_per_ms1 + 1 scans there is a MS1 scan with the isotope peaks of the peptide features
+        eluting at that time, and noise. The MS2 scans after it fragment those features.
+
+        Returns:
+            Populated SyntheticSpectralFile object
+        """
+        self.ms1_peaks = ms1_peaks
+        self.ms2_peaks = ms2_peaks
+        self.seed = seed
+        self.ms2_per_ms1 = ms2_per_ms1
+        self.scan_count = ms1_scans * (ms2_per_ms1 + 1)
+
+        # enough features that about a third of each MS1 scan's peaks are isotope peaks
+        run_seconds = self.scan_count * seconds_per_scan
+        features_per_scan = max(1, ms1_peaks // 3 // feature_isotope_count)
+        feature_count = max(1, int(features_per_scan * run_seconds / feature_elution_seconds))
+
+        rng = random.Random(seed)
+        self._features = sorted(
+            (rng.uniform(0, run_seconds), rng.uniform(400, 1400), rng.choice((2, 2, 3, 4)), rng.uniform(1e4, 1e7))
+            for _ in range(feature_count)
+        )
+        self._feature_apex_times = [feature[0] for feature in self._features]
+
+    def get_level(self, scan_number):
+        return 1 if (scan_number - 1) % (self.ms2_per_ms1 + 1) == 0 else 2
+
+    def get_scan_numbers(self, scan_levels):
+        return [n for n in range(1, self.scan_count + 1) if self.get_level(n) in scan_levels]
+
+    def get_scan(self, scan_number):
+        rng = random.Random(self.seed * 1000003 + scan_number)
+        retention_time = scan_number * seconds_per_scan
+        features = self._get_eluting_features(retention_time)
+        level = self.get_level(scan_number)
+
+        scan = {
+            'level': level,
+            'scanNumber': scan_number,
+            'retentionTime': retention_time,
+            'totalIonCurrent_ForScan': None,
+            'ionInjectionTime': 50.0,
+            'isCentroid': 1,
+            'parentScanNumber': None,
+            'precursorCharge': None,
+            'precursor_M_Over_Z': None
+        }
+
+        if level == 1:
+            peaks = []
+            for apex_time, mz, charge, intensity in features:
+                # a gaussian elution profile and a falling isotope distribution
+                elution = 2.0 ** (-((retention_time - apex_time) / (feature_elution_seconds / 4)) ** 2)
+                for isotope in range(feature_isotope_count):
+                    peaks.append((mz + isotope * 1.00335 / charge, intensity * elution * 0.6 ** isotope))
+
+            while len(peaks) < self.ms1_peaks:
+                peaks.append((rng.uniform(350, 1500), rng.uniform(100, 5e3)))
+
+            peaks = sorted(peaks[:self.ms1_peaks])
+
+        else:
+            _, precursor_mz, charge, _ = rng.choice(features) if features else (0, rng.uniform(400, 1400), 2, 0)
+            scan['parentScanNumber'] = scan_number - (scan_number - 1) % (self.ms2_per_ms1 + 1)
+            scan['precursorCharge'] = charge
+            scan['precursor_M_Over_Z'] = precursor_mz
+
+            peaks = sorted((rng.uniform(100, precursor_mz * charge), rng.uniform(10, 1e5)) for _ in range(self.ms2_peaks))
+
+        scan['peaks'] = [{'mz': mz, 'intensity': intensity} for mz, intensity in peaks]
+
+        return scan
+
+    @functools.lru_cache(maxsize=1024)
+    def get_scan_data_response(self, scan_numbers):
+        return json.dumps({
+            'status_scanFileAPIKeyNotFound': None,
+            'scans': [self.get_scan(scan_number) for scan_number in scan_numbers]
+        }).encode('utf-8')
+
+    def _get_eluting_features(self, retention_time):
+        first = bisect.bisect_left(self._feature_apex_times, retention_time - feature_elution_seconds / 2)
+        last = bisect.bisect_right(self._feature_apex_times, retention_time + feature_elution_seconds / 2)
+
+        return self._features[first:last]
+
+
+def run_spectr_stand_in(spectral_file, latency_seconds, port_queue):
+    """Serve the scan numbers and scan data of the synthetic spectral file the way spectr does,
+    until the process is terminated. Run in its own process, so making up the scans does not
+    take time from the pipeline being measured.
+    """
+
+    class SpectrRequestHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            request_ob = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+
+            if self.path == scan_numbers_path:
+                body = json.dumps({
+                    'status_scanFileAPIKeyNotFound': None,
+                    'scanNumbers': spectral_file.get_scan_numbers(request_ob['scanLevelsToInclude'])
+                }).encode('utf-8')
+
+            elif self.path == scan_data_path:
+                body = spectral_file.get_scan_data_response(tuple(request_ob['scanNumbers']))
+
+            else:
+                self.send_error(404)
+                return
+
+            time.sleep(latency_seconds)
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+
+            for start in range(0, len(body), response_chunk_size):
+                self.wfile.write(body[start:start + response_chunk_size])
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), SpectrRequestHandler)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def configure_environment(args, spectr_port, workdir, final_dir):
+    """Set the environmental variables the service reads, before the app package is imported"""
+
+    for executable in (args.hardklor, args.bullseye):
+        if not os.access(executable, os.X_OK):
+            raise ValueError('Not an executable file, use --hardklor and --bullseye or chmod 755:', executable)
+
+    spectr_url = 'http://127.0.0.1:' + str(spectr_port)
+
+    os.environ.update({
+        'SPECTR_GET_SCAN_NUMBERS_URL': spectr_url + scan_numbers_path,
+        'SPECTR_GET_SCAN_DATA_URL': spectr_url + scan_data_path,
+        'SPECTR_BATCH_SIZE': str(args.batch_size),
+        'WEBAPP_PORT': '0',
+        'APP_WORKDIR': workdir,
+        'FINAL_DIR': final_dir,
+        'HARDKLOR_EXEC_PATH': os.path.abspath(args.hardklor),
+        'BULLSEYE_EXEC_PATH': os.path.abspath(args.bullseye),
+        'HARDKLOR_TIMEOUT': os.getenv('HARDKLOR_TIMEOUT', '0'),
+        'APP_CLEAN_WORKDIR': 'yes'
+    })
+
+    # every run must fetch the scans and run Hardklor, and not pick up requests from another run
+    for env_key in ('SPECTRAL_FILE_CACHE_DIR', 'HARDKLOR_RESULTS_CACHE_DIR', 'APP_JOB_STORE_FILE'):
+        os.environ.pop(env_key, None)
+
+
+def run_benchmark_request(app, spectral_file_id, project_id):
+    """Submit a request and process it as a request worker would
+
+    Returns:
+        dict: The request, and the wall time and final status of processing it
+    """
+
+    from app import general_utils, request_handler
+
+    request_id = general_utils.generate_request_id()
+    request_data = {
+        'spectr_file_id': spectral_file_id,
+        'hardklor_conf': read_conf_file('test_hardklor.conf'),
+        'bullseye_conf': read_conf_file('test_bullseye.conf'),
+        'project_id': project_id
+    }
+
+    with app.request_queue.lock:
+        app.request_status_dict[request_id] = {
+            'project_id': project_id,
+            'status': 'queued',
+            'message': None,
+            'data': request_data
+        }
+        app.in_flight_requests.submit({'id': request_id, 'data': request_data})
+
+    request = request_handler.get_next_request(app.request_queue, app.request_status_dict)
+
+    start_time = time.monotonic()
+    request_handler.process_request(request, app.request_status_dict, app.in_flight_requests)
+    wall_seconds = time.monotonic() - start_time
+
+    return {
+        'request': request,
+        'wall_seconds': wall_seconds,
+        'status': app.request_status_dict[request_id]['status'],
+        'message': app.request_status_dict[request_id]['message']
+    }
+
+
+def read_trace(results_dir):
+    """Read the events of the trace published with the results, which may be compressed"""
+
+    from app import publish_lib, __trace_file__
+
+    trace_path = os.path.join(results_dir, publish_lib.get_published_file_name(__trace_file__))
+
+    if trace_path.endswith('.gz'):
+        with gzip.open(trace_path, 'rt') as trace_file:
+            return [json.loads(line) for line in trace_file]
+
+    if trace_path.endswith('.zst'):
+        import zstandard
+        with open(trace_path, 'rb') as trace_file:
+            text = zstandard.ZstdDecompressor().stream_reader(trace_file).read().decode('utf-8')
+        return [json.loads(line) for line in text.splitlines()]
+
+    with open(trace_path, 'r') as trace_file:
+        return [json.loads(line) for line in trace_file]
+
+
+def summarize_trace(events):
+    """Get the measurements of one run from the events of its trace"""
+
+    step_starts = {}
+    step_seconds = {}
+    export_times = []
+
+    for event in events:
+        if event['event'] == 'step_start':
+            step_starts[event['step']] = event['time']
+
+        elif event['event'] == 'step_end':
+            step_seconds[event['step']] = event['seconds']
+
+            # the export takes from the start of the first export step to the end of the last
+            if event['step'].startswith('export'):
+                export_times.extend([step_starts[event['step']], event['time']])
+
+    batches = [event for event in events if event['event'] == 'spectr_batch']
+    processes = [event for event in events if event['event'] == 'process']
+    request_end = [event for event in events if event['event'] == 'request_end'][-1]
+
+    export_seconds = max(export_times) - min(export_times) if export_times else None
+    fetched_scans = sum(batch['scans'] for batch in batches)
+    fetched_bytes = sum(batch['bytes'] for batch in batches)
+    latencies = sorted(batch['latency_seconds'] for batch in batches)
+
+    return {
+        'export_seconds': export_seconds,
+        'fetched_scans': fetched_scans,
+        'fetched_bytes': fetched_bytes,
+        'scans_per_second': fetched_scans / export_seconds if export_seconds else None,
+        'mb_per_second': fetched_bytes / 1e6 / export_seconds if export_seconds else None,
+        'batches': len(batches),
+        'batch_latency_seconds': {
+            'p50': get_percentile(latencies, 0.5),
+            'p90': get_percentile(latencies, 0.9),
+            'p99': get_percentile(latencies, 0.99)
+        },
+        'decode_seconds': sum(batch['decode_seconds'] for batch in batches),
+        'write_seconds': sum(batch['write_seconds'] for batch in batches),
+        'step_seconds': step_seconds,
+        'service_max_rss_kb': request_end['service_max_rss_kb'],
+        'process_max_rss_kb': max((process['max_rss_kb'] for process in processes
+                                   if process['max_rss_kb'] is not None), default=None),
+        'process_cpu_seconds': sum(process['user_cpu_seconds'] + process['system_cpu_seconds']
+                                   for process in processes)
+    }
+
+
+def get_percentile(sorted_values, percentile):
+    if len(sorted_values) < 1:
+        return None
+
+    # nearest rank
+    return sorted_values[max(0, math.ceil(percentile * len(sorted_values)) - 1)]
+
+
+def get_medians(runs):
+    """Get the median of each measurement over the runs, including those nested one level down"""
+
+    medians = {}
+
+    for key, value in runs[0].items():
+        if isinstance(value, dict):
+            medians[key] = get_medians([run[key] for run in runs])
+
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values = [run.get(key) for run in runs if isinstance(run.get(key), (int, float))]
+            medians[key] = statistics.median(values) if values else None
+
+    return medians
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_service_settings(app):
+    """Get the value of every environmental variable the service reads, from the names in the app package"""
+
+    env_keys = sorted(value for name, value in vars(app).items() if name.endswith('_env_key__'))
+
+    return {env_key: os.getenv(env_key) for env_key in env_keys}
+
+
+def read_conf_file(conf_filename):
+    with open(os.path.join(test_scripts_dir, conf_filename), 'r') as conf_file:
+        return conf_file.read()
+
+
+def main():
+    args = parse_args()
+
+    spectral_file = SyntheticSpectralFile(args.ms1_scans, args.ms2_per_ms1, args.ms1_peaks, args.ms2_peaks, args.seed)
+
+    port_queue = multiprocessing.Queue()
+    spectr_process = multiprocessing.Process(
+        target=run_spectr_stand_in,
+        args=(spectral_file, args.latency_ms / 1000, port_queue),
+        daemon=True
+    )
+    spectr_process.start()
+
+    benchmark_dir = tempfile.mkdtemp(prefix='feature-detection-benchmark-')
+    workdir = os.path.join(benchmark_dir, 'workdir')
+    final_dir = os.path.join(benchmark_dir, 'finaldir')
+    os.mkdir(workdir)
+    os.mkdir(final_dir)
+
+    try:
+        configure_environment(args, port_queue.get(timeout=30), workdir, final_dir)
+
+        # the app package reads the environment when it is imported
+        sys.path.insert(0, repo_dir)
+        import app
+
+        runs = []
+        for run_number in range(1, args.repeat + 1):
+            print('Benchmark run', run_number, 'of', args.repeat, flush=True)
+
+            result = run_benchmark_request(app, 'synthetic-' + str(args.seed), 1)
+            run = {'wall_seconds': result['wall_seconds'], 'status': result['status']}
+
+            if result['status'] != 'success':
+                run['message'] = result['message']
+            else:
+                run.update(summarize_trace(read_trace(os.path.join(final_dir, '1', result['request']['id']))))
+
+            runs.append(run)
+
+            # each run starts with an empty final directory
+            shutil.rmtree(os.path.join(final_dir, '1'), ignore_errors=True)
+
+        successful_runs = [run for run in runs if run['status'] == 'success']
+
+        results = {
+            'git_commit': get_git_commit(),
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'synthetic_file': {
+                'ms1_scans': args.ms1_scans,
+                'ms2_per_ms1': args.ms2_per_ms1,
+                'ms1_peaks': args.ms1_peaks,
+                'ms2_peaks': args.ms2_peaks,
+                'latency_ms': args.latency_ms,
+                'seed': args.seed
+            },
+            'settings': get_service_settings(app),
+            'runs': runs,
+            'median': get_medians(successful_runs) if successful_runs else None
+        }
+
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+        print(json.dumps(results['median'], indent=2))
+        print('Wrote results to', args.output)
+
+        if len(successful_runs) < len(runs):
+            sys.exit(1)
+
+    finally:
+        spectr_process.terminate()
+        shutil.rmtree(benchmark_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()